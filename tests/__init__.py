@@ -1,10 +1,20 @@
 import unittest
 
+from .test_backup import *
+from .test_backup_artifact import *
+from .test_cache import *
 from .test_client import *
 from .test_db import *
+from .test_db_create import *
 from .test_db_module import *
+from .test_db_pool import *
+from .test_db_readiness import *
+from .test_db_swap import *
 from .test_db_management import *
+from .test_filestore import *
+from .test_jobs import *
 from .test_server import *
+from .test_utils import *
 
 
 if __name__ == '__main__':
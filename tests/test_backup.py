@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import odoo
+
+from yodoo_client import backup
+
+BLOB_HASH_1 = 'ab' + '1' * 38
+BLOB_HASH_2 = 'cd' + '2' * 38
+
+
+class TestBlobStoreRestore(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tmp_dir, True)
+        self._blob_store = os.path.join(self._tmp_dir, 'blobs')
+        self._filestore = os.path.join(self._tmp_dir, 'filestore')
+        self._write(self._blob_store, 'ab/' + BLOB_HASH_1, b'blob-1')
+        self._write(self._blob_store, 'cd/' + BLOB_HASH_2, b'blob-2')
+
+        options = {'yodoo_blob_store': self._blob_store}
+        patcher = mock.patch.object(
+            odoo.tools.config, 'get',
+            side_effect=lambda name, default=None: options.get(
+                name, default))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write(self, root, relpath, data):
+        path = os.path.join(root, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_01_fill_filestore_from_blob_store(self):
+        filestore_index = {
+            'files': ['ab/' + BLOB_HASH_1, 'cd/' + BLOB_HASH_2],
+        }
+        # File included in backup is not taken from blob store
+        blob_files = backup._get_blob_store_files(
+            filestore_index, self._filestore,
+            included={'cd/' + BLOB_HASH_2})
+        self.assertEqual(blob_files, [(
+            os.path.join(self._blob_store, 'ab', BLOB_HASH_1),
+            os.path.join(self._filestore, 'ab', BLOB_HASH_1))])
+
+        self._write(self._filestore, 'cd/' + BLOB_HASH_2, b'backup-2')
+        backup._fill_filestore_from_blob_store(
+            filestore_index, self._filestore)
+
+        # Blob is linked directly into filestore
+        self.assertTrue(os.path.samefile(
+            os.path.join(self._blob_store, 'ab', BLOB_HASH_1),
+            os.path.join(self._filestore, 'ab', BLOB_HASH_1)))
+        with open(os.path.join(self._filestore, 'cd', BLOB_HASH_2),
+                  'rb') as f:
+            self.assertEqual(f.read(), b'backup-2')
+
+    def test_02_fill_filestore_from_blob_store_missing(self):
+        filestore_index = {
+            'files': ['ab/' + BLOB_HASH_1, 'ef/' + 'ef' * 20],
+        }
+        with self.assertRaises(Exception):
+            backup._get_blob_store_files(
+                filestore_index, self._filestore, included=set())
+        with self.assertRaises(Exception):
+            backup._fill_filestore_from_blob_store(
+                filestore_index, self._filestore)
+        self.assertFalse(os.path.exists(self._filestore))
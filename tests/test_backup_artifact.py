@@ -0,0 +1,94 @@
+import unittest
+from unittest import mock
+
+from yodoo_client import backup_artifact
+
+
+class FakeCursor(object):
+    """ Cursor, that returns statistic of database and state of its
+        sessions
+    """
+
+    def __init__(self, version, idle, stat=(1, None, 10, 5, 1, 1000)):
+        self._version = version
+        # List of results of checks, that sessions are idle
+        self._idle = list(idle)
+        self._stat = stat
+        self._result = None
+
+    def execute(self, query, params=None):
+        query = ' '.join(query.split())
+        if 'server_version_num' in query:
+            self._result = (self._version,)
+        elif 'pg_current_wal_insert_lsn' in query:
+            self._result = ('0/16B3748',)
+        elif 'pg_stat_activity' in query:
+            self._result = (self._idle.pop(0),)
+        elif 'pg_stat_database' in query:
+            self._result = self._stat
+        else:
+            self._result = None
+
+    def fetchone(self):
+        return self._result
+
+
+class TestDbFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        options = {}
+        self._options = options
+        patcher = mock.patch.object(
+            backup_artifact, 'config',
+            new=mock.Mock(get=lambda name, default=None: options.get(
+                name, default)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(backup_artifact.time, 'sleep')
+        self._sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_01_db_stat_signature(self):
+        signature = backup_artifact._get_db_state_signature(
+            FakeCursor(150000, [True]), 'test_db')
+        self.assertEqual(signature, 'db_stat:1,None,10,5,1,1000')
+
+        # Other database changed, but statistic of this one is same
+        self.assertEqual(
+            backup_artifact._get_db_state_signature(
+                FakeCursor(150000, [True]), 'test_db'),
+            signature)
+
+    def test_02_db_stat_wait_for_idle_sessions(self):
+        signature = backup_artifact._get_db_state_signature(
+            FakeCursor(150000, [False, False, True]), 'test_db')
+        self.assertEqual(signature, 'db_stat:1,None,10,5,1,1000')
+        self.assertEqual(self._sleep.call_count, 2)
+
+    def test_03_db_stat_sessions_not_idle(self):
+        # Statistic could be not flushed, so fingerprint is unknown
+        with mock.patch.object(
+                backup_artifact, 'DB_STAT_FLUSH_WAIT', 0):
+            self.assertIsNone(backup_artifact._get_db_state_signature(
+                FakeCursor(150000, [False] * 10), 'test_db'))
+
+    def test_04_db_stat_old_postgresql(self):
+        self.assertEqual(
+            backup_artifact._get_db_state_signature(
+                FakeCursor(130000, []), 'test_db'),
+            'wal:0/16B3748')
+
+    def test_05_wal_mode(self):
+        self._options['yodoo_backup_fingerprint'] = 'wal'
+        self.assertEqual(
+            backup_artifact._get_db_state_signature(
+                FakeCursor(150000, []), 'test_db'),
+            'wal:0/16B3748')
+
+    def test_06_unknown_fingerprint_not_reused(self):
+        store = backup_artifact.BackupArtifactStore('/nonexistent', 3600)
+        with mock.patch.object(
+                store, '_iter_artifacts',
+                return_value=[{'key': 'key', 'fingerprint': None,
+                               'expires': 0}]):
+            self.assertIsNone(store._find('key', None))
@@ -0,0 +1,169 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from yodoo_client import cache as cache_module
+from yodoo_client import utils
+from yodoo_client.cache import CachedValue, invalidate_db_lifecycle_caches
+
+
+class TestCachedValue(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        patcher = mock.patch.object(
+            cache_module, '_get_db_lifecycle_stamp_path',
+            return_value=os.path.join(tmp_dir, 'db_lifecycle.stamp'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _make_cache(self, ttl, **kwargs):
+        """ Return cache, that value is number of computations
+        """
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        return CachedValue('test', compute, ttl, **kwargs)
+
+    def _make_blocking_cache(self, ttl):
+        """ Return cache, that blocks on computation of second and next
+            values until 'release' event is set
+        """
+        calls = []
+        computing = threading.Event()
+        release = threading.Event()
+
+        def compute():
+            calls.append(1)
+            if len(calls) > 1:
+                computing.set()
+                release.wait(5)
+            return len(calls)
+
+        return CachedValue('test', compute, ttl), computing, release
+
+    def test_01_cached_value_ttl(self):
+        cache = self._make_cache(0.2)
+        self.assertEqual(cache.get(), 1)
+        self.assertEqual(cache.get(), 1)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 1)
+
+        # Value is recomputed after it expired
+        time.sleep(0.3)
+        self.assertEqual(cache.get(), 2)
+        self.assertEqual(cache.get(), 2)
+        self.assertEqual(cache.misses, 2)
+
+    def test_02_cached_value_invalidate(self):
+        cache = self._make_cache(3600)
+        self.assertEqual(cache.get(), 1)
+        cache.invalidate()
+        self.assertEqual(cache.get(), 2)
+
+    def test_03_cached_value_db_lifecycle(self):
+        cache = self._make_cache(3600, db_lifecycle=True)
+        other_cache = self._make_cache(3600)
+        self.assertEqual(cache.get(), 1)
+        self.assertEqual(other_cache.get(), 1)
+
+        # Only caches, that depend on list of databases, are invalidated
+        invalidate_db_lifecycle_caches()
+        self.assertEqual(cache.get(), 2)
+        self.assertEqual(other_cache.get(), 1)
+
+    def test_04_cached_value_stale_while_computing(self):
+        cache, computing, release = self._make_blocking_cache(0.1)
+        self.assertEqual(cache.get(), 1)
+        time.sleep(0.2)
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(cache.get()))
+        thread.start()
+        self.assertTrue(computing.wait(5))
+
+        # Other thread computes new value, so expired one is returned
+        self.assertEqual(cache.get(), 1)
+        release.set()
+        thread.join(5)
+        self.assertEqual(results, [2])
+        self.assertEqual(cache.get(), 2)
+
+    def test_05_cached_value_invalidate_while_computing(self):
+        cache, computing, release = self._make_blocking_cache(0.1)
+        self.assertEqual(cache.get(), 1)
+        time.sleep(0.2)
+
+        thread = threading.Thread(target=cache.get)
+        thread.start()
+        self.assertTrue(computing.wait(5))
+
+        # Invalidation waits until computation finished, and value
+        # computed before invalidation is never returned after it
+        invalidator = threading.Thread(target=cache.invalidate)
+        invalidator.start()
+        release.set()
+        thread.join(5)
+        invalidator.join(5)
+        self.assertEqual(cache.get(), 3)
+
+    def test_06_cached_value_db_lifecycle_other_worker(self):
+        cache = self._make_cache(3600, db_lifecycle=True)
+        other_cache = self._make_cache(3600)
+        self.assertEqual(cache.get(), 1)
+        self.assertEqual(other_cache.get(), 1)
+
+        # Other worker changed databases: it replaces stamp file, but
+        # cannot invalidate caches of this process
+        cache_module._update_db_lifecycle_stamp()
+        self.assertEqual(cache.get(), 2)
+        self.assertEqual(cache.get(), 2)
+        self.assertEqual(other_cache.get(), 1)
+
+        cache_module._update_db_lifecycle_stamp()
+        self.assertEqual(cache.get(), 3)
+
+
+class TestServerSlowStatisticCache(unittest.TestCase):
+
+    def test_01_server_slow_statistic_cached(self):
+        db_count_cache = utils._server_db_count_cache
+        platform_cache = utils._server_platform_cache
+        db_count_cache.invalidate()
+        platform_cache.invalidate()
+        platform_data = {
+            'system': 'Linux',
+            'machine': 'x86_64',
+            'version': '1',
+            'node': 'test',
+        }
+        with mock.patch.object(db_count_cache, '_func',
+                               side_effect=[5, 6]) as db_count_func, \
+                mock.patch.object(platform_cache, '_func',
+                                  return_value=platform_data) as platform_func:
+            data = utils.prepare_server_slow_statistic_data()
+            self.assertEqual(data['db_count'], 5)
+            self.assertEqual(data['os_node'], 'test')
+
+            # Values are cached
+            data = utils.prepare_server_slow_statistic_data()
+            self.assertEqual(data['db_count'], 5)
+            self.assertEqual(db_count_func.call_count, 1)
+
+            # Number of databases is recomputed when databases are
+            # changed, but platform info is still cached
+            invalidate_db_lifecycle_caches()
+            data = utils.prepare_server_slow_statistic_data()
+            self.assertEqual(data['db_count'], 6)
+            self.assertEqual(db_count_func.call_count, 2)
+            self.assertEqual(platform_func.call_count, 1)
+        db_count_cache.invalidate()
+        platform_cache.invalidate()
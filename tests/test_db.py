@@ -83,6 +83,65 @@ class TestClientDBStatistic(TestOdooInfrastructureClient):
         self.assertEqual(response.status_code, 440)
 
 
+class TestClientDBStatisticBulk(TestOdooInfrastructureClient):
+
+    def setUp(self):
+        self._db_statistic_bulk_url = self.create_url(
+            '/saas/client/db/stat/bulk')
+        self._db_statistic_bulk_data = {
+            'token_hash': self._hash_token,
+        }
+
+    def _parse_ndjson(self, response):
+        return {
+            d['db']: d
+            for d in (json.loads(line)
+                      for line in response.text.splitlines() if line)
+        }
+
+    def test_01_controller_db_statistic_bulk(self):
+        response = requests.post(
+            self._db_statistic_bulk_url, self._db_statistic_bulk_data)
+        self.assertEqual(response.status_code, 200)
+        data = self._parse_ndjson(response)
+        self.assertIn(self._client.dbname, data)
+        db_data = data[self._client.dbname]
+        self.assertNotIn('error', db_data)
+        self.assertIsInstance(db_data['db_storage'], int)
+        self.assertIsInstance(db_data['file_storage'], int)
+        self.assertIsInstance(db_data['users_total_count'], int)
+        self.assertIsInstance(db_data['installed_modules_db_count'], int)
+
+    def test_02_controller_db_statistic_bulk_dbs(self):
+        response = requests.post(
+            self._db_statistic_bulk_url,
+            dict(self._db_statistic_bulk_data,
+                 dbs='%s,abracadabra' % self._client.dbname))
+        self.assertEqual(response.status_code, 200)
+        data = self._parse_ndjson(response)
+        self.assertEqual(
+            set(data), {self._client.dbname, 'abracadabra'})
+        self.assertIn('error', data['abracadabra'])
+
+        # Result must be same as for single database statistic
+        response = requests.post(
+            self.create_url('/saas/client/db/stat'),
+            dict(self._db_statistic_bulk_data, db=self._client.dbname))
+        single_data = response.json()
+        bulk_data = data[self._client.dbname]
+        for key in ('users_total_count', 'users_internal_count',
+                    'users_external_count', 'installed_apps_db_count',
+                    'installed_modules_db_count', 'login_date'):
+            self.assertEqual(bulk_data[key], single_data[key])
+
+    def test_03_controller_db_statistic_bulk(self):
+        # test incorrect request with bad token_hash
+        data = dict(self._db_statistic_bulk_data, token_hash='abracadabra')
+
+        response = requests.post(self._db_statistic_bulk_url, data)
+        self.assertEqual(response.status_code, 403)
+
+
 class TestDBModuleInfo(TestOdooInfrastructureClient):
     def setUp(self):
         self._db_info_url = self.create_url('/saas/client/db/module/info')
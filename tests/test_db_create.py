@@ -0,0 +1,56 @@
+import unittest
+from unittest import mock
+
+from yodoo_client import db_management
+
+
+class TestCreateDbCleanup(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(db_management, 'drop_db')
+        self._drop_db = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_01_create_db_from_template_configure_failed(self):
+        with mock.patch.object(
+                db_management, 'create_db_from_template') as create, \
+                mock.patch.object(
+                    db_management, 'configure_new_db',
+                    side_effect=Exception("Cannot configure")):
+            with self.assertRaisesRegex(Exception, "Cannot configure"):
+                db_management.create_db(
+                    None, 'test_db', template_dbname='test_template',
+                    use_pool=False)
+        create.assert_called_once_with('test_db', 'test_template')
+        self._drop_db.assert_called_once_with('test_db')
+
+    def test_02_create_db_from_template_exists(self):
+        # Database was not created, so it must not be dropped
+        with mock.patch.object(
+                db_management, 'create_db_from_template',
+                side_effect=Exception("Database exists")), \
+                mock.patch.object(
+                    db_management, 'configure_new_db') as configure:
+            with self.assertRaisesRegex(Exception, "Database exists"):
+                db_management.create_db(
+                    None, 'test_db', template_dbname='test_template',
+                    use_pool=False)
+        configure.assert_not_called()
+        self._drop_db.assert_not_called()
+
+    def test_03_create_db_from_template_clone_failed(self):
+        cursor = mock.MagicMock()
+        with mock.patch.object(db_management, 'db_connect') as db_connect, \
+                mock.patch.object(db_management.odoo.sql_db, 'close_db'), \
+                mock.patch.object(db_management.service_db, '_drop_conn'), \
+                mock.patch.object(
+                    db_management.os.path, 'exists',
+                    side_effect=lambda path: path.endswith('test_template')), \
+                mock.patch.object(
+                    db_management, 'clone_filestore',
+                    side_effect=OSError("No space left on device")):
+            db_connect.return_value.cursor.return_value = cursor
+            with self.assertRaises(OSError):
+                db_management.create_db_from_template(
+                    'test_db', 'test_template')
+        self._drop_db.assert_called_once_with('test_db')
@@ -1,4 +1,7 @@
 import io
+import json
+import time
+import hashlib
 import zipfile
 import requests
 from requests_toolbelt import MultipartEncoder
@@ -61,6 +64,10 @@ class TestDBManagement(TestOdooInfrastructureClient):
             db='test_db',
             backup_file="test",
         )
+        self._restore_db_data_stream = dict(
+            self._data_base,
+            db='test_db',
+        )
 
     def test_01_controller_create_db_no_demo(self):
         # Ensure database does not exists
@@ -211,6 +218,183 @@ class TestDBManagement(TestOdooInfrastructureClient):
             self._odoo_admin_pass, 'test_db')
         self.assertFalse(self._odoo_instance.services.db.db_exist('test_db'))
 
+    def test_01_controller_backup_db_stream(self):
+        response = requests.post(
+            self._create_db_url, dict(self._create_db_data, demo=False))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self._odoo_instance.services.db.db_exist('test_db'))
+
+        # Backup database in streaming mode
+        response = requests.post(
+            self._backup_db_url, dict(self._backup_db_data, stream=True),
+            stream=True)
+        self.assertEqual(response.status_code, 200)
+        backup_data = b''.join(response.iter_content(chunk_size=65536))
+        self.assertTrue(zipfile.is_zipfile(io.BytesIO(backup_data)))
+        with zipfile.ZipFile(io.BytesIO(backup_data)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertIn('dump.sql', zf.namelist())
+            self.assertIn('manifest.json', zf.namelist())
+
+        # Drop database
+        self._odoo_instance.services.db.drop_db(
+            self._odoo_admin_pass, 'test_db')
+        self.assertFalse(self._odoo_instance.services.db.db_exist('test_db'))
+
+        # Restore database from streamed backup
+        data = MultipartEncoder(
+            fields=dict(
+                self._restore_db_data,
+                backup_file=(
+                    'filename',
+                    io.BytesIO(backup_data),
+                    'application/octet-stream'),
+            )
+        )
+        response = requests.post(
+            self._restore_db_url,
+            data=data,
+            headers={'Content-Type': data.content_type},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self._odoo_instance.services.db.db_exist('test_db'))
+
+        # Drop database
+        self._odoo_instance.services.db.drop_db(
+            self._odoo_admin_pass, 'test_db')
+        self.assertFalse(self._odoo_instance.services.db.db_exist('test_db'))
+
+        # Restore database from request body, without multipart encoding
+        response = requests.post(
+            self._restore_db_url,
+            params=self._restore_db_data_stream,
+            data=io.BytesIO(backup_data),
+            headers={'Content-Type': 'application/octet-stream'},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self._odoo_instance.services.db.db_exist('test_db'))
+
+        # Drop database
+        self._odoo_instance.services.db.drop_db(
+            self._odoo_admin_pass, 'test_db')
+        self.assertFalse(self._odoo_instance.services.db.db_exist('test_db'))
+
+    def test_01_controller_backup_db_directory(self):
+        response = requests.post(
+            self._create_db_url, dict(self._create_db_data, demo=False))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self._odoo_instance.services.db.db_exist('test_db'))
+
+        # Backup database in directory format
+        response = requests.post(
+            self._backup_db_url,
+            dict(self._backup_db_data, backup_format='directory'))
+        self.assertEqual(response.status_code, 200)
+        backup_data = response.content
+        with zipfile.ZipFile(io.BytesIO(backup_data)) as zf:
+            self.assertIn('dump/toc.dat', zf.namelist())
+            self.assertIn('manifest.json', zf.namelist())
+
+        # Drop database
+        self._odoo_instance.services.db.drop_db(
+            self._odoo_admin_pass, 'test_db')
+        self.assertFalse(self._odoo_instance.services.db.db_exist('test_db'))
+
+        # Restore database using parallel pg_restore
+        data = MultipartEncoder(
+            fields=dict(
+                self._restore_db_data,
+                backup_file=(
+                    'filename',
+                    io.BytesIO(backup_data),
+                    'application/octet-stream'),
+            )
+        )
+        response = requests.post(
+            self._restore_db_url,
+            data=data,
+            headers={'Content-Type': data.content_type},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self._odoo_instance.services.db.db_exist('test_db'))
+
+        # Drop database
+        self._odoo_instance.services.db.drop_db(
+            self._odoo_admin_pass, 'test_db')
+        self.assertFalse(self._odoo_instance.services.db.db_exist('test_db'))
+
+    def _restore_db_from_backup(self, backup_data):
+        data = MultipartEncoder(
+            fields=dict(
+                self._restore_db_data,
+                backup_file=(
+                    'filename',
+                    io.BytesIO(backup_data),
+                    'application/octet-stream'),
+            )
+        )
+        return requests.post(
+            self._restore_db_url,
+            data=data,
+            headers={'Content-Type': data.content_type},
+        )
+
+    def _get_backup_filestore_names(self, backup_data):
+        with zipfile.ZipFile(io.BytesIO(backup_data)) as zf:
+            return sorted(
+                n for n in zf.namelist()
+                if n.startswith('filestore/') and not n.endswith('/'))
+
+    def test_01_controller_backup_db_delta_restore(self):
+        response = requests.post(
+            self._create_db_url, dict(self._create_db_data, demo=False))
+        self.assertEqual(response.status_code, 200)
+
+        response = requests.post(self._backup_db_url, self._backup_db_data)
+        self.assertEqual(response.status_code, 200)
+        filestore_names = self._get_backup_filestore_names(response.content)
+        self.assertTrue(filestore_names)
+        hashes = [n.split('/')[-1] for n in filestore_names]
+
+        # Delta backup, that contains all files (none of them is known)
+        response = requests.post(
+            self._backup_db_url,
+            dict(self._backup_db_data, known_hashes='0' * 40))
+        self.assertEqual(response.status_code, 200)
+        delta_backup_full = response.content
+
+        # Delta backup without files. Blob store is not configured, so
+        # files cannot be restored
+        response = requests.post(
+            self._backup_db_url,
+            dict(self._backup_db_data, known_hashes='\n'.join(hashes)))
+        self.assertEqual(response.status_code, 200)
+        delta_backup_empty = response.content
+        self.assertFalse(self._get_backup_filestore_names(delta_backup_empty))
+
+        self._odoo_instance.services.db.drop_db(
+            self._odoo_admin_pass, 'test_db')
+        self.assertFalse(self._odoo_instance.services.db.db_exist('test_db'))
+
+        # Missing files are detected before database is created
+        response = self._restore_db_from_backup(delta_backup_empty)
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(self._odoo_instance.services.db.db_exist('test_db'))
+
+        # Filestore is restored from delta backup
+        response = self._restore_db_from_backup(delta_backup_full)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self._odoo_instance.services.db.db_exist('test_db'))
+        response = requests.post(self._backup_db_url, self._backup_db_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self._get_backup_filestore_names(response.content),
+            filestore_names)
+
+        self._odoo_instance.services.db.drop_db(
+            self._odoo_admin_pass, 'test_db')
+        self.assertFalse(self._odoo_instance.services.db.db_exist('test_db'))
+
     def test_01_controller_create_db_demo_contry_code_none(self):
         response = requests.post(
             self._create_db_url,
@@ -410,6 +594,358 @@ class TestDBManagement(TestOdooInfrastructureClient):
         response = requests.post(self._backup_db_url, data)
         self.assertEqual(response.status_code, 440)
 
+    def test_04_controller_db_backup_bad_compression(self):
+        # test request with unsupported compression
+        data = dict(
+            self._backup_db_data,
+            db=self._client.dbname,
+            compression='abracadabra')
+
+        response = requests.post(self._backup_db_url, data)
+        self.assertEqual(response.status_code, 400)
+
+    def test_05_controller_db_backup_compression(self):
+        for compression in ('stored', 'deflate:1'):
+            data = dict(
+                self._backup_db_data,
+                db=self._client.dbname,
+                compression=compression)
+
+            response = requests.post(self._backup_db_url, data)
+            self.assertEqual(response.status_code, 200)
+            with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertIn('dump.sql', zf.namelist())
+
+    def test_05_controller_db_backup_delta(self):
+        response = requests.post(
+            self._backup_db_url,
+            dict(self._backup_db_data, db=self._client.dbname))
+        self.assertEqual(response.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+            hashes = [
+                n.split('/')[-1] for n in zf.namelist()
+                if n.startswith('filestore/')]
+
+        # Make delta backup, that have not to contain known files
+        response = requests.post(
+            self._backup_db_url,
+            dict(self._backup_db_data,
+                 db=self._client.dbname,
+                 known_hashes='\n'.join(hashes)))
+        self.assertEqual(response.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+            self.assertIn('dump.sql', zf.namelist())
+            self.assertIn('filestore.json', zf.namelist())
+            filestore_index = json.loads(zf.read('filestore.json'))
+            for fhash in hashes:
+                self.assertNotIn(
+                    'filestore/%s/%s' % (fhash[:2], fhash), zf.namelist())
+                self.assertIn(
+                    '%s/%s' % (fhash[:2], fhash), filestore_index['files'])
+
+    def test_04_controller_db_backup_bad_known_hashes(self):
+        data = dict(
+            self._backup_db_data,
+            db=self._client.dbname,
+            known_hashes='abracadabra')
+
+        response = requests.post(self._backup_db_url, data)
+        self.assertEqual(response.status_code, 400)
+
+    def test_05_controller_db_backup_artifact(self):
+        response = requests.post(
+            self._backup_db_url,
+            dict(self._backup_db_data, db=self._client.dbname, artifact=True))
+        self.assertEqual(response.status_code, 200)
+        artifact = response.json()
+        self.assertTrue(artifact['artifact_id'])
+        self.assertTrue(artifact['size'])
+
+        # Artifact of unchanged database is reused. Fingerprint of
+        # database could be changed in background (for example by
+        # autovacuum, or by changes in other databases on PostgreSQL
+        # before 15), so few attempts are made
+        for __ in range(5):
+            response = requests.post(
+                self._backup_db_url,
+                dict(self._backup_db_data,
+                     db=self._client.dbname, artifact=True))
+            self.assertEqual(response.status_code, 200)
+            if response.json()['reused']:
+                break
+            artifact = response.json()
+        self.assertTrue(response.json()['reused'])
+        self.assertEqual(
+            response.json()['artifact_id'], artifact['artifact_id'])
+
+        download_url = self.create_url('/saas/client/db/backup/download')
+        download_data = dict(
+            self._data_base, artifact_id=artifact['artifact_id'])
+        download_params = {'artifact_id': artifact['artifact_id']}
+        download_headers = {'X-YODOO-TOKEN': self._hash_token}
+
+        # Download whole artifact
+        response = requests.get(
+            download_url, params=download_params, headers=download_headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.content), artifact['size'])
+        self.assertEqual(
+            hashlib.sha256(response.content).hexdigest(),
+            artifact['sha256'])
+        self.assertTrue(zipfile.is_zipfile(io.BytesIO(response.content)))
+
+        # Download part of artifact
+        response_part = requests.get(
+            download_url, params=download_params,
+            headers=dict(download_headers, Range='bytes=10-19'))
+        self.assertEqual(response_part.status_code, 206)
+        self.assertEqual(response_part.content, response.content[10:20])
+
+        # Download part of artifact with token in body of POST request
+        response_part = requests.post(
+            download_url, download_data,
+            headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response_part.status_code, 206)
+        self.assertEqual(response_part.content, response.content[10:20])
+
+        # Token in query string is not accepted
+        response = requests.get(download_url, params=download_data)
+        self.assertEqual(response.status_code, 400)
+
+        # Unknown artifact
+        response = requests.post(
+            download_url, dict(download_data, artifact_id='abc'))
+        self.assertEqual(response.status_code, 404)
+
+        # Bad token
+        response = requests.post(
+            download_url, dict(download_data, token_hash='abracadabra'))
+        self.assertEqual(response.status_code, 403)
+
+    def test_06_controller_create_db_from_template(self):
+        response = requests.post(self._create_db_url, self._create_db_data)
+        self.assertEqual(response.status_code, 200)
+
+        # Template with demo data mismatch
+        response = requests.post(
+            self._create_db_url,
+            dict(self._create_db_data, dbname='test_db_from_template',
+                 template_dbname='test_db', demo=True))
+        self.assertEqual(response.status_code, 400)
+
+        # Unknown template
+        response = requests.post(
+            self._create_db_url,
+            dict(self._create_db_data, dbname='test_db_from_template',
+                 template_dbname='test_db_unknown'))
+        self.assertEqual(response.status_code, 400)
+
+        response = requests.post(
+            self._create_db_url,
+            dict(self._create_db_data,
+                 dbname='test_db_from_template',
+                 template_dbname='test_db',
+                 user_login='test_user_2',
+                 user_password='test_password_2',
+                 country_code='UA'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(
+            self._odoo_instance.services.db.db_exist('test_db_from_template'))
+
+        cl_template = self._client.login(
+            'test_db', 'test_user', 'test_password')
+        cl = self._client.login(
+            'test_db_from_template', 'test_user_2', 'test_password_2')
+        self.assertNotEqual(
+            cl['ir.config_parameter'].get_param('database.uuid'),
+            cl_template['ir.config_parameter'].get_param('database.uuid'))
+        self.assertEqual(cl['res.company'].browse(1).country_id.code, 'UA')
+
+        for db in ('test_db', 'test_db_from_template'):
+            self._odoo_instance.services.db.drop_db(
+                self._odoo_admin_pass, db)
+
+    def test_06_controller_restore_db_swap(self):
+        response = requests.post(self._create_db_url, self._create_db_data)
+        self.assertEqual(response.status_code, 200)
+
+        response = requests.post(self._backup_db_url, self._backup_db_data)
+        self.assertEqual(response.status_code, 200)
+        backup_data = response.content
+
+        # Change database after backup
+        cl = self._client.login('test_db', 'test_user', 'test_password')
+        cl['res.partner'].create({'name': 'Created after backup'})
+
+        # Restore backup in place of existing database
+        response = requests.post(
+            self._restore_db_url,
+            params=dict(self._restore_db_data_stream, swap=True),
+            data=backup_data,
+            headers={'Content-Type': 'application/octet-stream'},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self._odoo_instance.services.db.db_exist('test_db'))
+
+        cl = self._client.login('test_db', 'test_user', 'test_password')
+        self.assertFalse(
+            cl['res.partner'].search(
+                [('name', '=', 'Created after backup')]))
+
+        # Staging databases are not visible
+        response = requests.post(self._list_db_url, self._list_db_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(
+            [d for d in response.json() if d.startswith('tmp-')])
+
+        self._odoo_instance.services.db.drop_db(
+            self._odoo_admin_pass, 'test_db')
+
+    def test_06_controller_restore_db_postprocess_async(self):
+        response = requests.post(self._create_db_url, self._create_db_data)
+        self.assertEqual(response.status_code, 200)
+        response = requests.post(self._backup_db_url, self._backup_db_data)
+        self.assertEqual(response.status_code, 200)
+        backup_data = response.content
+        self._odoo_instance.services.db.drop_db(
+            self._odoo_admin_pass, 'test_db')
+
+        response = requests.post(
+            self._restore_db_url,
+            params=dict(self._restore_db_data_stream, postprocess_async=True),
+            data=backup_data,
+            headers={'Content-Type': 'application/octet-stream'},
+        )
+        self.assertEqual(response.status_code, 200)
+        job_id = response.json()['reconcile_job_id']
+        self.assertTrue(self._odoo_instance.services.db.db_exist('test_db'))
+
+        status_url = self.create_url('/saas/client/db/reconcile/status')
+        response = requests.post(
+            status_url, dict(self._data_base, db='test_db'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['job']['id'], job_id)
+
+        job = self._wait_job(job_id)
+        self.assertEqual(job['state'], 'done', job['error'])
+
+        response = requests.post(
+            status_url, dict(self._data_base, db='test_db'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['ready'])
+        self.assertIsNone(response.json()['reason'])
+        self.assertTrue(
+            self._client.login('test_db', 'test_user', 'test_password'))
+
+        self._odoo_instance.services.db.drop_db(
+            self._odoo_admin_pass, 'test_db')
+
+    def _wait_job(self, job_id, timeout=600):
+        job_url = self.create_url('/saas/client/job/%s' % job_id)
+        for __ in range(timeout):
+            response = requests.post(job_url, self._data_base)
+            self.assertEqual(response.status_code, 200)
+            job = response.json()
+            self.assertEqual(job['id'], job_id)
+            if job['state'] in ('done', 'failed'):
+                return job
+            time.sleep(1)
+        self.fail("Job %s is not finished in %s seconds" % (job_id, timeout))
+
+    def test_07_controller_db_async_operations(self):
+        # Create database in background
+        response = requests.post(
+            self._create_db_url,
+            dict(self._create_db_data, run_async=True))
+        self.assertEqual(response.status_code, 202)
+        job = self._wait_job(response.json()['job_id'])
+        self.assertEqual(job['state'], 'done', job['error'])
+        self.assertEqual(job['operation'], 'create')
+        self.assertTrue(job['started_at'])
+        self.assertTrue(job['finished_at'])
+        self.assertTrue(self._odoo_instance.services.db.db_exist('test_db'))
+        self.assertTrue(
+            self._client.login('test_db', 'test_user', 'test_password'))
+
+        # Duplicate database in background
+        response = requests.post(
+            self._duplicate_db_url,
+            dict(self._duplicate_db_data, run_async=True))
+        self.assertEqual(response.status_code, 202)
+        job = self._wait_job(response.json()['job_id'])
+        self.assertEqual(job['state'], 'done', job['error'])
+        self.assertTrue(
+            self._odoo_instance.services.db.db_exist('test_db_copy'))
+
+        # Backup database in background
+        response = requests.post(
+            self._backup_db_url,
+            dict(self._backup_db_data, run_async=True))
+        self.assertEqual(response.status_code, 202)
+        job = self._wait_job(response.json()['job_id'])
+        self.assertEqual(job['state'], 'done', job['error'])
+        response = requests.post(
+            self.create_url('/saas/client/db/backup/download'),
+            dict(self._data_base, artifact_id=job['result']['artifact_id']))
+        self.assertEqual(response.status_code, 200)
+        backup_data = response.content
+        self.assertTrue(zipfile.is_zipfile(io.BytesIO(backup_data)))
+
+        # Restore database in background
+        self._odoo_instance.services.db.drop_db(
+            self._odoo_admin_pass, 'test_db')
+        response = requests.post(
+            self._restore_db_url,
+            params=dict(self._restore_db_data_stream, run_async=True),
+            data=backup_data,
+            headers={'Content-Type': 'application/octet-stream'},
+        )
+        self.assertEqual(response.status_code, 202)
+        job = self._wait_job(response.json()['job_id'])
+        self.assertEqual(job['state'], 'done', job['error'])
+        self.assertTrue(self._odoo_instance.services.db.db_exist('test_db'))
+
+        # Failed job reports error
+        response = requests.post(
+            self._restore_db_url,
+            params=dict(
+                self._restore_db_data_stream, db='test_db_bad',
+                run_async=True),
+            data=b'abracadabra',
+            headers={'Content-Type': 'application/octet-stream'},
+        )
+        self.assertEqual(response.status_code, 202)
+        job = self._wait_job(response.json()['job_id'])
+        self.assertEqual(job['state'], 'failed')
+        self.assertTrue(job['error'])
+
+        for db in ('test_db', 'test_db_copy'):
+            self._odoo_instance.services.db.drop_db(
+                self._odoo_admin_pass, db)
+
+    def test_08_controller_job_unknown(self):
+        response = requests.post(
+            self.create_url('/saas/client/job/abc'), self._data_base)
+        self.assertEqual(response.status_code, 404)
+
+    def test_09_controller_job_bad_token(self):
+        response = requests.post(
+            self.create_url('/saas/client/job/abc'),
+            dict(self._data_base, token_hash='abracadabra'))
+        self.assertEqual(response.status_code, 403)
+
+    def test_10_controller_db_pool_stat(self):
+        url = self.create_url('/saas/client/db/pool/stat')
+        response = requests.post(url, self._data_base)
+        self.assertEqual(response.status_code, 200)
+        for stat in response.json().values():
+            self.assertLessEqual(stat['ready'], stat['size'])
+
+        response = requests.post(
+            url, dict(self._data_base, token_hash='abracadabra'))
+        self.assertEqual(response.status_code, 403)
+
     def test_03_controller_db_restore_bad_token(self):
         # test incorrect request with bad token_hash
         data = dict(self._restore_db_data, token_hash='abracadabra')
@@ -417,6 +953,16 @@ class TestDBManagement(TestOdooInfrastructureClient):
         response = requests.post(self._restore_db_url, data)
         self.assertEqual(response.status_code, 403)
 
+    def test_04_controller_db_restore_stream_bad_data(self):
+        response = requests.post(
+            self._restore_db_url,
+            params=self._restore_db_data_stream,
+            data=b'abracadabra',
+            headers={'Content-Type': 'application/octet-stream'},
+        )
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(self._odoo_instance.services.db.db_exist('test_db'))
+
     def test_04_controller_db_restore_no_dbname(self):
         # test request without dbname
         data = dict(self._restore_db_data, db=None)
@@ -254,3 +254,40 @@ class TestDBModuleInstallUpgradeUninstall(TestOdooInfrastructureClient):
             self._db_module_uninstall_url,
             self._db_module_data_multi)
         self.assertEqual(response.status_code, 200)
+
+
+class TestDBModuleDiff(TestOdooInfrastructureClient):
+    def setUp(self):
+        self._db_module_diff_url = self.create_url(
+            '/saas/client/db/module/diff')
+
+    def test_01_controller_db_module_diff(self):
+        response = requests.post(
+            self._db_module_diff_url,
+            {
+                'token_hash': self._hash_token,
+                'dbs': '%s,unknown-db' % self._client.dbname,
+            })
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['dbs'], [self._client.dbname, 'unknown-db'])
+        self.assertIn('unknown-db', data['errors'])
+        self.assertNotIn(self._client.dbname, data['errors'])
+
+        # yodoo_client is installed and up to date in test database
+        yodoo_client = data['modules'].get('yodoo_client', {})
+        self.assertNotIn(0, yodoo_client.get('to_install', []))
+        self.assertNotIn(0, yodoo_client.get('to_update', []))
+
+    def test_02_controller_db_module_diff_all_dbs(self):
+        response = requests.post(
+            self._db_module_diff_url,
+            {'token_hash': self._hash_token})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self._client.dbname, response.json()['dbs'])
+
+    def test_03_controller_db_module_diff_bad_token(self):
+        response = requests.post(
+            self._db_module_diff_url,
+            {'token_hash': 'abracadabra'})
+        self.assertEqual(response.status_code, 403)
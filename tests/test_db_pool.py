@@ -0,0 +1,185 @@
+import re
+import tempfile
+import contextlib
+import unittest
+from unittest import mock
+
+from yodoo_client import db_pool
+from yodoo_client.db_pool import DatabasePool, DatabasePoolProfile
+
+
+class FakeCursor(object):
+    """ Cursor, that emulates pool queries against set of databases
+    """
+
+    def __init__(self, dbs, stat):
+        self._dbs = dbs
+        self._stat = stat
+        self._result = []
+
+    def execute(self, query, params=None):
+        query = ' '.join(query.split())
+        if 'FROM pg_database' in query:
+            pattern = re.compile(params[0])
+            self._result = [
+                (d,) for d in sorted(self._dbs) if pattern.match(d)]
+        elif 'pg_try_advisory_lock' in query:
+            self._result = [(True,)]
+        elif 'INSERT INTO yodoo_client_db_pool_stat' in query:
+            profile, hits, misses = params
+            old_hits, old_misses = self._stat.get(profile, (0, 0))
+            self._stat[profile] = (old_hits + hits, old_misses + misses)
+        elif 'FROM yodoo_client_db_pool_stat' in query:
+            self._result = [
+                (p,) + tuple(v) for p, v in self._stat.items()]
+        else:
+            self._result = []
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return list(self._result)
+
+
+class TestDatabasePool(unittest.TestCase):
+
+    def setUp(self):
+        self._dbs = set()
+        self._stat = {}
+        self._filled = []
+        self._dropped = []
+
+        @contextlib.contextmanager
+        def postgres_cursor():
+            yield FakeCursor(self._dbs, self._stat)
+
+        def rename(old, new):
+            self._dbs.remove(old)
+            self._dbs.add(new)
+
+        self._free_space = 10 * 1024 * 1024
+        disk_usage = mock.MagicMock()
+        disk_usage.side_effect = lambda path: mock.Mock(
+            free=self._free_space)
+        for obj, attr, kwargs in [
+                (db_pool, '_postgres_cursor', {'new': postgres_cursor}),
+                (db_pool.service_db, 'exp_rename', {'side_effect': rename}),
+                (db_pool.service_db, 'exp_db_exist',
+                 {'side_effect': lambda db: db in self._dbs}),
+                (db_pool.shutil, 'disk_usage', {'new': disk_usage}),
+                (db_pool, 'config', {'new': {'data_dir': '/data'}}),
+                (db_pool, 'invalidate_db_lifecycle_caches', {})]:
+            patcher = mock.patch.object(obj, attr, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _make_pool(self, **profiles):
+        def fill(dbname, profile):
+            self._filled.append((dbname, profile.name))
+            self._dbs.add(dbname)
+
+        def drop(dbname):
+            self._dropped.append(dbname)
+            self._dbs.discard(dbname)
+
+        return DatabasePool(
+            {name: DatabasePoolProfile(name, **params)
+             for name, params in profiles.items()},
+            fill, drop, interval=3600, min_free_space=1024 * 1024,
+            pg_data_dir=tempfile.gettempdir())
+
+    def _pool_dbs(self, pool, profile_name):
+        pattern = re.compile(pool.profiles[profile_name].get_ready_db_re())
+        return sorted(d for d in self._dbs if pattern.match(d))
+
+    def test_01_fill(self):
+        pool = self._make_pool(default={'size': 2})
+        leftover = db_pool.DB_POOL_FILL_PREFIX + 'default-0-0-tmp'
+        removed = db_pool.DB_POOL_READY_PREFIX + 'removed-0-0-tmp'
+        self._dbs.update([leftover, removed, 'other_db'])
+
+        pool.fill()
+        self.assertEqual(len(self._pool_dbs(pool, 'default')), 2)
+        self.assertEqual(len(self._filled), 2)
+        # Leftovers of interrupted fills and databases of removed
+        # profiles are dropped
+        self.assertEqual(sorted(self._dropped), sorted([leftover, removed]))
+        self.assertIn('other_db', self._dbs)
+
+        # Pool is full
+        pool.fill()
+        self.assertEqual(len(self._filled), 2)
+
+    def test_02_fill_no_free_space(self):
+        pool = self._make_pool(default={'size': 2})
+        self._free_space = 1024
+        pool.fill()
+        self.assertEqual(self._filled, [])
+
+    def test_03_fill_failed(self):
+        pool = self._make_pool(default={'size': 2})
+
+        def fill(dbname, profile):
+            self._dbs.add(dbname)
+            raise Exception("Cannot create database")
+
+        pool._fill_func = fill
+        pool.fill()
+        # Incomplete database is dropped, and filling of profile stopped
+        self.assertEqual(len(self._dropped), 1)
+        self.assertEqual(self._pool_dbs(pool, 'default'), [])
+        self.assertFalse(self._dbs)
+
+    def test_04_claim(self):
+        pool = self._make_pool(
+            default={'size': 1},
+            fr={'size': 1, 'lang': 'fr_FR'},
+            crm={'size': 1, 'addons': ['crm']})
+        pool.fill()
+
+        with mock.patch.object(pool, 'ensure_running'):
+            self.assertEqual(pool.claim('test_db'), 'default')
+            self.assertIn('test_db', self._dbs)
+            self.assertEqual(self._pool_dbs(pool, 'default'), [])
+
+            # Pool of profile is empty
+            self.assertIsNone(pool.claim('test_db_2'))
+            self.assertEqual(
+                pool.get_statistic()['default'],
+                {'size': 1, 'ready': 0, 'hits': 1, 'misses': 1,
+                 'hit_rate': 0.5})
+
+            # Profiles with addons are used only if selected explicitly,
+            # and only for databases with same params
+            self.assertIsNone(pool.claim('test_db_crm', demo=True))
+            self.assertIsNone(pool.claim(
+                'test_db_crm', lang='fr_FR', profile_name='crm'))
+            self.assertEqual(
+                pool.claim('test_db_crm', profile_name='crm'), 'crm')
+            self.assertIsNone(pool.claim('test_db_fr', profile_name='fr'))
+            self.assertEqual(pool.claim('test_db_fr', lang='fr_FR'), 'fr')
+
+        self.assertEqual(self._stat['crm'], (1, 0))
+
+    def test_05_check_free_space_pg_data_dir(self):
+        pool = self._make_pool(default={'size': 1})
+        checked = []
+        pg_data_dir = tempfile.gettempdir()
+        db_pool.shutil.disk_usage.side_effect = lambda path: (
+            checked.append(path) or
+            mock.Mock(free=1024 if path == pg_data_dir else self._free_space))
+        self.assertFalse(pool._check_free_space(FakeCursor(set(), {})))
+        self.assertEqual(checked, ['/data', pg_data_dir])
+
+    def test_06_check_free_space_pg_data_dir_not_available(self):
+        # PostgreSQL runs on other host, so only data dir is checked
+        pool = self._make_pool(default={'size': 1})
+        pool.pg_data_dir = None
+        checked = []
+        db_pool.shutil.disk_usage.side_effect = lambda path: (
+            checked.append(path) or mock.Mock(free=self._free_space))
+        cr = FakeCursor(set(), {})
+        self.assertTrue(pool._check_free_space(cr))
+        self.assertTrue(pool._check_free_space(cr))
+        self.assertEqual(checked, ['/data', '/data'])
@@ -0,0 +1,223 @@
+import contextlib
+import unittest
+from unittest import mock
+
+from yodoo_client import db_management
+from yodoo_client import db_readiness
+
+
+class FakeCursor(object):
+    """ Cursor, that emulates table of not ready databases
+    """
+
+    def __init__(self, markers, queries):
+        self._markers = markers
+        self._queries = queries
+        self._result = []
+
+    def execute(self, query, params=None):
+        query = ' '.join(query.split())
+        self._queries.append(query)
+        self._result = []
+        if 'to_regclass' in query:
+            self._result = [(True,)]
+        elif query.startswith('INSERT INTO yodoo_client_db_not_ready'):
+            self._markers[params[0]] = params[1]
+        elif query.startswith('DELETE FROM yodoo_client_db_not_ready'):
+            self._markers.pop(params[0], None)
+        elif query.startswith('UPDATE yodoo_client_db_not_ready'):
+            if params[1] in self._markers:
+                self._markers[params[0]] = self._markers.pop(params[1])
+        elif query == 'SELECT db FROM yodoo_client_db_not_ready':
+            self._result = [(db,) for db in self._markers]
+        elif query.startswith('SELECT reason'):
+            if params[0] in self._markers:
+                self._result = [(self._markers[params[0]],)]
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return list(self._result)
+
+
+class TestDbReadiness(unittest.TestCase):
+
+    def setUp(self):
+        self._markers = {}
+        self._queries = []
+
+        @contextlib.contextmanager
+        def postgres_cursor():
+            yield FakeCursor(self._markers, self._queries)
+
+        patcher = mock.patch.object(
+            db_readiness, '_postgres_cursor', new=postgres_cursor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        db_readiness._not_ready_dbs_cache.invalidate()
+        self.addCleanup(db_readiness._not_ready_dbs_cache.invalidate)
+
+    def test_01_mark_db_not_ready(self):
+        self.assertTrue(db_readiness.is_db_ready('test_db'))
+        db_readiness.mark_db_not_ready('test_db', 'restore')
+        self.assertFalse(db_readiness.is_db_ready('test_db'))
+        self.assertTrue(db_readiness.is_db_ready('test_db_2'))
+        self.assertEqual(
+            db_readiness.get_db_not_ready_reason('test_db'), 'restore')
+
+        db_readiness.rename_db_readiness('test_db', 'test_db_new')
+        self.assertTrue(db_readiness.is_db_ready('test_db'))
+        self.assertFalse(db_readiness.is_db_ready('test_db_new'))
+
+        db_readiness.mark_db_ready('test_db_new')
+        self.assertTrue(db_readiness.is_db_ready('test_db_new'))
+
+    def test_02_ready_dbs_checked_from_cache(self):
+        db_readiness.mark_db_not_ready('test_db', 'restore')
+        self.assertFalse(db_readiness.is_db_ready('test_db'))
+        del self._queries[:]
+
+        # Only databases, that are not ready, are checked in database
+        self.assertTrue(db_readiness.is_db_ready('test_db_2'))
+        self.assertEqual(self._queries, [])
+
+        # Marker could be cleared by other worker, so cached state of not
+        # ready database is not trusted
+        del self._markers['test_db']
+        self.assertTrue(db_readiness.is_db_ready('test_db'))
+
+    def test_03_ready_if_cannot_check(self):
+        with mock.patch.object(
+                db_readiness, '_postgres_cursor',
+                side_effect=Exception("Cannot connect")):
+            self.assertTrue(db_readiness.is_db_ready('test_db'))
+
+
+class TestRestoreReadiness(unittest.TestCase):
+
+    def setUp(self):
+        self._calls = []
+        self._dbs = set()
+
+        def restore(db):
+            self._calls.append(('restore', db))
+            self._dbs.add(db)
+
+        self._restore = restore
+        for obj, attr, kwargs in [
+                (db_management, 'mark_db_not_ready',
+                 {'side_effect': lambda db, reason: self._calls.append(
+                     ('not_ready', db, reason))}),
+                (db_management, 'mark_db_ready',
+                 {'side_effect': lambda db: self._calls.append(
+                     ('ready', db))}),
+                (db_management.service_db, 'exp_db_exist',
+                 {'side_effect': lambda db: db in self._dbs}),
+                (db_management, 'postprocess_restored_db',
+                 {'side_effect': lambda db: self._calls.append(
+                     ('postprocess', db))}),
+                (db_management, 'invalidate_db_lifecycle_caches', {}),
+                (db_management, 'drop_db',
+                 {'side_effect': lambda db: self._calls.append(
+                     ('drop', db)) or self._dbs.discard(db)})]:
+            patcher = mock.patch.object(obj, attr, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_01_restore_not_ready_until_reconciled(self):
+        db_management.restore_and_postprocess_db(
+            None, 'test_db', self._restore)
+        self.assertEqual(self._calls, [
+            ('not_ready', 'test_db', 'restore'),
+            ('restore', 'test_db'),
+            ('postprocess', 'test_db'),
+            ('ready', 'test_db'),
+        ])
+
+    def test_02_restore_async_not_ready(self):
+        runner = mock.Mock()
+        runner.enqueue.return_value = 'job-1'
+        with mock.patch.object(
+                db_management, 'get_job_runner', return_value=runner):
+            self.assertEqual(
+                db_management.restore_and_postprocess_db(
+                    None, 'test_db', self._restore, postprocess_async=True),
+                'job-1')
+        # Database is ready only when reconcile job succeeds
+        self.assertEqual(self._calls, [
+            ('not_ready', 'test_db', 'restore'),
+            ('restore', 'test_db'),
+        ])
+
+    def test_03_reconcile_failed(self):
+        self._dbs.add('test_db')
+        with mock.patch.object(
+                db_management, 'postprocess_restored_db',
+                side_effect=Exception("Cannot update addons")):
+            with self.assertRaisesRegex(Exception, "Cannot update addons"):
+                db_management.reconcile_db(None, 'test_db', 'test_db')
+        self.assertEqual(self._calls, [
+            ('not_ready', 'test_db', 'reconcile_failed'),
+        ])
+
+    def test_04_restore_failed(self):
+        def restore(db):
+            raise Exception("Bad backup")
+
+        with self.assertRaisesRegex(Exception, "Bad backup"):
+            db_management.restore_and_postprocess_db(
+                None, 'test_db', restore)
+        self.assertEqual(self._calls, [
+            ('not_ready', 'test_db', 'restore'),
+            ('ready', 'test_db'),
+        ])
+
+    def test_05_restore_existing_db(self):
+        # Existing database is not blocked by failed restore
+        self._dbs.add('test_db')
+
+        def restore(db):
+            raise Exception("Database already exists")
+
+        with self.assertRaisesRegex(Exception, "already exists"):
+            db_management.restore_and_postprocess_db(
+                None, 'test_db', restore)
+        self.assertEqual(self._calls, [])
+
+    def test_06_file_restore_failed(self):
+        # Restore from file (odoo's restore_db) leaves partially restored
+        # database, so it is dropped and not blocked forever
+        def restore(db):
+            self._dbs.add(db)
+            raise Exception("Cannot restore filestore")
+
+        with self.assertRaisesRegex(Exception, "Cannot restore filestore"):
+            db_management.restore_and_postprocess_db(
+                None, 'test_db', restore)
+        self.assertEqual(self._calls, [
+            ('not_ready', 'test_db', 'restore'),
+            ('drop', 'test_db'),
+            ('ready', 'test_db'),
+        ])
+        self.assertFalse(self._dbs)
+
+    def test_07_swap_restore_failed(self):
+        self._dbs.add('test_db')
+
+        def restore(db):
+            self._dbs.add(db)
+            raise Exception("Bad backup")
+
+        with mock.patch.object(
+                db_management, 'get_staging_db_name',
+                return_value='test_db_staging'):
+            with self.assertRaisesRegex(Exception, "Bad backup"):
+                db_management.restore_and_postprocess_db(
+                    None, 'test_db', restore, swap=True)
+        self.assertEqual(self._calls, [
+            ('not_ready', 'test_db_staging', 'restore'),
+            ('drop', 'test_db_staging'),
+            ('ready', 'test_db_staging'),
+        ])
+        self.assertEqual(self._dbs, {'test_db'})
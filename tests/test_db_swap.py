@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from yodoo_client import db_management
+
+OLD_DB = 'tmp-swapold-test-tmp'
+
+
+class FakeCursor(object):
+    def __init__(self, queries, on_execute):
+        self._queries = queries
+        self._on_execute = on_execute
+
+    def execute(self, query, params=None):
+        query = ' '.join(query.split())
+        self._on_execute(query)
+        self._queries.append(query)
+
+    def fetchone(self):
+        return (1, 1)
+
+    def autocommit(self, value):
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TestSwapDb(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tmp_dir, True)
+        for db in ('test_db', 'test_db_staging'):
+            os.makedirs(os.path.join(self._tmp_dir, db))
+            with open(os.path.join(self._tmp_dir, db, 'data'), 'wt') as f:
+                f.write(db)
+
+        self._queries = []
+        # Content of filestore of 'test_db', when connections allowed
+        self._allowed_with_filestore = []
+
+        def on_execute(query):
+            if query.endswith('ALLOW_CONNECTIONS true'):
+                self._allowed_with_filestore.append(
+                    self._read_filestore('test_db'))
+
+        db_connect = mock.MagicMock()
+        db_connect.return_value.cursor.side_effect = (
+            lambda: FakeCursor(self._queries, on_execute))
+        for obj, attr, kwargs in [
+                (db_management, 'db_connect', {'new': db_connect}),
+                (db_management, 'get_staging_db_name',
+                 {'return_value': OLD_DB}),
+                (db_management.odoo.tools.config, 'filestore',
+                 {'side_effect': lambda db: os.path.join(
+                     self._tmp_dir, db)}),
+                (db_management.odoo.modules.registry.Registry, 'delete', {}),
+                (db_management.odoo.sql_db, 'close_db', {}),
+                (db_management.service_db, '_drop_conn', {})]:
+            patcher = mock.patch.object(obj, attr, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(db_management, 'drop_db')
+        self._drop_db = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _read_filestore(self, db):
+        try:
+            with open(os.path.join(self._tmp_dir, db, 'data'), 'rt') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _get_ddl(self):
+        return [q for q in self._queries if q.startswith('ALTER DATABASE')]
+
+    def test_01_swap_db(self):
+        db_management.swap_db('test_db_staging', 'test_db')
+        self.assertEqual(self._get_ddl(), [
+            'ALTER DATABASE "test_db" ALLOW_CONNECTIONS false',
+            'ALTER DATABASE "test_db_staging" ALLOW_CONNECTIONS false',
+            'ALTER DATABASE "test_db" RENAME TO "%s"' % OLD_DB,
+            'ALTER DATABASE "test_db_staging" RENAME TO "test_db"',
+            'ALTER DATABASE "%s" ALLOW_CONNECTIONS true' % OLD_DB,
+            'ALTER DATABASE "test_db" ALLOW_CONNECTIONS true',
+        ])
+        # Filestores are swapped before connections are allowed
+        self.assertEqual(
+            self._allowed_with_filestore,
+            ['test_db_staging', 'test_db_staging'])
+        self.assertEqual(self._read_filestore('test_db'), 'test_db_staging')
+        self.assertEqual(self._read_filestore(OLD_DB), 'test_db')
+        self.assertIsNone(self._read_filestore('test_db_staging'))
+        self._drop_db.assert_called_once_with(OLD_DB)
+
+    def test_02_swap_db_filestore_failed(self):
+        rename = os.rename
+
+        def rename_fail(src, dst):
+            if src.endswith('test_db_staging'):
+                raise OSError("Cannot rename")
+            return rename(src, dst)
+
+        with mock.patch.object(
+                db_management.os, 'rename', side_effect=rename_fail):
+            with self.assertRaises(OSError):
+                db_management.swap_db('test_db_staging', 'test_db')
+
+        # All renames are reverted
+        self.assertEqual(self._get_ddl(), [
+            'ALTER DATABASE "test_db" ALLOW_CONNECTIONS false',
+            'ALTER DATABASE "test_db_staging" ALLOW_CONNECTIONS false',
+            'ALTER DATABASE "test_db" RENAME TO "%s"' % OLD_DB,
+            'ALTER DATABASE "test_db_staging" RENAME TO "test_db"',
+            'ALTER DATABASE "test_db" RENAME TO "test_db_staging"',
+            'ALTER DATABASE "%s" RENAME TO "test_db"' % OLD_DB,
+            'ALTER DATABASE "test_db" ALLOW_CONNECTIONS true',
+            'ALTER DATABASE "test_db_staging" ALLOW_CONNECTIONS true',
+        ])
+        self.assertEqual(self._read_filestore('test_db'), 'test_db')
+        self.assertEqual(
+            self._read_filestore('test_db_staging'), 'test_db_staging')
+        self.assertIsNone(self._read_filestore(OLD_DB))
+        self._drop_db.assert_not_called()
+
+    def test_03_swap_db_drop_old_failed(self):
+        # Databases are already swapped, so error is only logged
+        self._drop_db.side_effect = Exception("Cannot drop")
+        with self.assertLogs(db_management.__name__, 'ERROR'):
+            db_management.swap_db('test_db_staging', 'test_db')
+        self.assertEqual(self._read_filestore('test_db'), 'test_db_staging')
@@ -0,0 +1,169 @@
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from yodoo_client import filestore
+
+
+class TestCloneFilestore(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tmp_dir, True)
+        self._src = os.path.join(self._tmp_dir, 'src')
+        self._dst = os.path.join(self._tmp_dir, 'dst')
+        self._files = {
+            'ab/ab01': b'file-1',
+            'ab/ab02': b'file-2-data',
+            'cd/cd01': b'file-3',
+            'checklist/cd/cd02': b'',
+        }
+        for relpath, data in self._files.items():
+            path = os.path.join(self._src, relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        os.makedirs(os.path.join(self._src, 'empty'))
+
+    def _assert_cloned(self, res, mode):
+        self.assertEqual(res['mode'], mode)
+        self.assertEqual(res['files'], len(self._files))
+        self.assertEqual(
+            res['size'], sum(len(d) for d in self._files.values()))
+        self.assertTrue(os.path.isdir(os.path.join(self._dst, 'empty')))
+        for relpath, data in self._files.items():
+            path = os.path.join(self._dst, relpath)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            self.assertEqual(
+                os.path.samefile(path, os.path.join(self._src, relpath)),
+                mode == filestore.CLONE_MODE_HARDLINK)
+
+    def test_01_clone_filestore_copy(self):
+        res = filestore.clone_filestore(
+            self._src, self._dst, filestore.CLONE_MODE_COPY)
+        self._assert_cloned(res, filestore.CLONE_MODE_COPY)
+
+    def test_02_clone_filestore_hardlink(self):
+        res = filestore.clone_filestore(
+            self._src, self._dst, filestore.CLONE_MODE_HARDLINK)
+        self._assert_cloned(res, filestore.CLONE_MODE_HARDLINK)
+
+    def test_03_clone_filestore_auto_hardlink(self):
+        # Filesystem does not support reflinks
+        with mock.patch.object(
+                filestore, '_reflink_file',
+                side_effect=OSError(errno.EOPNOTSUPP, "Not supported")):
+            res = filestore.clone_filestore(
+                self._src, self._dst, filestore.CLONE_MODE_AUTO)
+        self._assert_cloned(res, filestore.CLONE_MODE_HARDLINK)
+
+    def test_04_clone_filestore_auto_copy(self):
+        # Neither reflinks, nor hardlinks are supported (for example,
+        # filestore is located on other filesystem), so files are copied
+        with mock.patch.object(
+                filestore, '_reflink_file',
+                side_effect=OSError(errno.EXDEV, "Cross-device link")), \
+                mock.patch.object(
+                    filestore.os, 'link',
+                    side_effect=OSError(errno.EXDEV, "Cross-device link")):
+            res = filestore.clone_filestore(
+                self._src, self._dst, filestore.CLONE_MODE_AUTO)
+        self._assert_cloned(res, filestore.CLONE_MODE_COPY)
+
+    def test_05_clone_filestore_auto_error(self):
+        # Errors, that do not mean that mode is not supported, are raised
+        with mock.patch.object(
+                filestore, '_reflink_file',
+                side_effect=OSError(errno.EIO, "I/O error")):
+            with self.assertRaises(OSError):
+                filestore.clone_filestore(
+                    self._src, self._dst, filestore.CLONE_MODE_AUTO)
+        self.assertFalse(os.path.exists(self._dst))
+
+    def test_06_clone_filestore_partial_cleanup(self):
+        clone_file = filestore._clone_file
+        calls = []
+
+        def clone_file_fail(src, dst, mode):
+            calls.append(src)
+            if len(calls) == 3:
+                raise OSError(errno.ENOSPC, "No space left on device")
+            return clone_file(src, dst, mode)
+
+        with mock.patch.object(
+                filestore, '_clone_file', side_effect=clone_file_fail), \
+                mock.patch.object(
+                    filestore, '_get_filestore_clone_jobs', return_value=1):
+            with self.assertRaises(OSError):
+                filestore.clone_filestore(
+                    self._src, self._dst, filestore.CLONE_MODE_COPY)
+
+        # Partially cloned filestore is removed, source is not changed
+        self.assertFalse(os.path.exists(self._dst))
+        for relpath in self._files:
+            self.assertTrue(
+                os.path.exists(os.path.join(self._src, relpath)))
+
+
+class TestFilestoreTrash(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tmp_dir, True)
+        self._files = ['ab/ab01', 'ab/ab02', 'cd/cd01']
+        for relpath in self._files:
+            path = os.path.join(
+                self._tmp_dir, 'filestore', 'test_db', relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'data')
+
+        self._reaper = filestore.FilestoreTrashReaper(
+            os.path.join(
+                self._tmp_dir, 'filestore', filestore.FILESTORE_TRASH_DIR),
+            rate=1000)
+        for obj, attr, kwargs in [
+                (filestore, 'config', {'new': {'data_dir': self._tmp_dir}}),
+                (filestore, 'get_filestore_trash_reaper',
+                 {'return_value': self._reaper}),
+                (self._reaper, 'ensure_running', {})]:
+            patcher = mock.patch.object(obj, attr, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_01_move_filestore_to_trash(self):
+        self.assertTrue(filestore.move_filestore_to_trash('test_db'))
+        self.assertFalse(os.path.exists(
+            os.path.join(self._tmp_dir, 'filestore', 'test_db')))
+
+        stat = self._reaper.get_statistic()
+        self.assertEqual(stat['count'], 1)
+        self.assertEqual(stat['filestores'][0]['db'], 'test_db')
+        self.assertTrue(stat['filestores'][0]['trashed_at'])
+
+        # Database without filestore
+        self.assertFalse(filestore.move_filestore_to_trash('test_db'))
+        self.assertEqual(self._reaper.get_statistic()['count'], 1)
+
+    def test_02_reap_trash(self):
+        filestore.move_filestore_to_trash('test_db')
+        self._reaper.reap()
+        stat = self._reaper.get_statistic()
+        self.assertEqual(stat['count'], 0)
+        self.assertEqual(stat['removed_files'], len(self._files))
+        self.assertEqual(
+            os.listdir(self._reaper.trash_path), ['.lock'])
+
+    def test_03_reap_trash_locked(self):
+        # Other process is cleaning trash, so trash is not touched
+        filestore.move_filestore_to_trash('test_db')
+        with open(os.path.join(self._reaper.trash_path, '.lock'), 'a') as f:
+            filestore.fcntl.flock(f, filestore.fcntl.LOCK_EX)
+            other = filestore.FilestoreTrashReaper(
+                self._reaper.trash_path, rate=1000)
+            other.reap()
+        self.assertEqual(self._reaper.get_statistic()['count'], 1)
@@ -0,0 +1,109 @@
+import os
+import threading
+import unittest
+from unittest import mock
+
+from yodoo_client import db_management  # noqa: registers job operations
+from yodoo_client import jobs
+
+
+class TestJobRetry(unittest.TestCase):
+
+    def test_01_job_retry_policy(self):
+        self.assertTrue(jobs.is_job_retryable('backup', {'db': 'test_db'}))
+        self.assertTrue(jobs.is_job_retryable(
+            'reconcile', {'db': 'test_db', 'target_db': 'test_db'}))
+        self.assertFalse(jobs.is_job_retryable('create', {'db': 'test_db'}))
+        self.assertFalse(jobs.is_job_retryable('unknown', {}))
+
+    def test_02_job_retry_policy_restore(self):
+        # Only restore to staging database could be run again
+        self.assertTrue(jobs.is_job_retryable(
+            'restore', {'db': 'test_db', 'swap': True}))
+        self.assertFalse(jobs.is_job_retryable(
+            'restore', {'db': 'test_db'}))
+        self.assertFalse(jobs.is_job_retryable(
+            'restore',
+            {'db': 'test_db', 'swap': True, 'postprocess_async': True}))
+
+    def test_03_staging_db_name_of_job(self):
+        job = jobs.Job('abc')
+        self.assertEqual(
+            db_management.get_staging_db_name('swap', job),
+            db_management.get_staging_db_name('swap', job))
+        self.assertNotEqual(
+            db_management.get_staging_db_name('swap'),
+            db_management.get_staging_db_name('swap'))
+
+
+class TestJobRunnerDrain(unittest.TestCase):
+
+    def _make_runner(self):
+        runner = jobs.JobRunner('test', 1)
+        runner._pid = os.getpid()
+        runner._thread = threading.current_thread()
+        return runner
+
+    def test_01_drain_waits_for_jobs(self):
+        runner = self._make_runner()
+        runner._running.add('job-1')
+        runner._secrets['job-2'] = {'password': 'secret'}
+        pings = []
+
+        def ping():
+            # Jobs are finished while worker is waiting
+            pings.append(1)
+            runner._running.discard('job-1')
+            runner._secrets.pop('job-2', None)
+
+        self.assertTrue(runner.drain(10, ping=ping))
+        self.assertTrue(runner._draining)
+        self.assertEqual(len(pings), 1)
+
+    def test_02_drain_timeout(self):
+        runner = self._make_runner()
+        runner._running.add('job-1')
+        self.assertFalse(runner.drain(0))
+
+    def test_03_drain_not_started(self):
+        runner = jobs.JobRunner('test', 1)
+        self.assertTrue(runner.drain(0))
+        self.assertFalse(runner._draining)
+
+
+class TestJobRunnerKeepalive(unittest.TestCase):
+
+    def _make_runner(self, jobs_to_claim):
+        runner = jobs.JobRunner('test', 2)
+        runner._pid = os.getpid()
+        runner._executor = mock.Mock()
+        runner.keepalive = mock.Mock()
+        claimed = list(jobs_to_claim)
+        runner._claim = lambda: claimed.pop(0) if claimed else None
+        return runner
+
+    def test_01_keepalive_before_jobs_started(self):
+        runner = self._make_runner([('job-1', 'backup', {})])
+        runner.keepalive.side_effect = lambda: self.assertEqual(
+            runner._executor.submit.call_count, 0)
+        runner._start_jobs()
+        self.assertEqual(runner.keepalive.call_count, 1)
+        self.assertEqual(runner._executor.submit.call_count, 1)
+        self.assertTrue(runner.has_running_jobs())
+
+        # Keepalive is called while jobs are running
+        runner._start_jobs()
+        self.assertEqual(runner.keepalive.call_count, 2)
+
+    def test_02_no_keepalive_without_jobs(self):
+        runner = self._make_runner([])
+        runner._start_jobs()
+        runner.keepalive.assert_not_called()
+        self.assertFalse(runner.has_running_jobs())
+
+    def test_03_keepalive_failed(self):
+        # Claimed jobs are started even if limits could not be lifted
+        runner = self._make_runner([('job-1', 'backup', {})])
+        runner.keepalive.side_effect = Exception("Cannot set limits")
+        runner._start_jobs()
+        self.assertEqual(runner._executor.submit.call_count, 1)
@@ -1,3 +1,4 @@
+import time
 import six
 import requests
 
@@ -80,6 +81,132 @@ class TestServerFastStatistic(TestOdooInfrastructureClient):
         self.assertEqual(response.status_code, 403)
 
 
+class TestServerStatisticHistory(TestOdooInfrastructureClient):
+
+    def setUp(self):
+        self._server_stat_history_url = self.create_url(
+            '/saas/client/server/stat/history')
+        self._server_stat_history_data = {
+            'token_hash': self._hash_token
+        }
+
+    def test_01_controller_server_statistic_history(self):
+        response = requests.post(
+            self._server_stat_history_url, self._server_stat_history_data)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertIsInstance(data['interval'], float)
+        self.assertIsInstance(data['capacity'], int)
+        self.assertEqual(data['fields'][0], 'timestamp')
+        self.assertIn('cpu_load_average_1', data['fields'])
+        self.assertIn('mem_available', data['fields'])
+        self.assertIsInstance(data['samples'], list)
+        for sample in data['samples']:
+            self.assertEqual(len(sample), len(data['fields']))
+
+    def test_02_controller_server_statistic_history_since(self):
+        # Samples collected before 'since' must not be returned
+        response = requests.post(
+            self._server_stat_history_url,
+            dict(self._server_stat_history_data, since=time.time() + 3600))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['samples'], [])
+
+        response = requests.post(
+            self._server_stat_history_url,
+            dict(self._server_stat_history_data, since='abracadabra'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_02_controller_server_statistic_history_shared(self):
+        # History is shared by all workers, so consecutive requests
+        # (possibly processed by different workers) return same samples
+        response = requests.post(
+            self._server_stat_history_url, self._server_stat_history_data)
+        self.assertEqual(response.status_code, 200)
+        timestamps_1 = [s[0] for s in response.json()['samples']]
+
+        response = requests.post(
+            self._server_stat_history_url, self._server_stat_history_data)
+        self.assertEqual(response.status_code, 200)
+        timestamps_2 = [s[0] for s in response.json()['samples']]
+
+        # Oldest samples could be rotated out of history between requests
+        expected = [
+            t for t in timestamps_1
+            if timestamps_2 and t >= timestamps_2[0]]
+        self.assertEqual(timestamps_2[:len(expected)], expected)
+
+    def test_03_controller_server_statistic_history(self):
+        # test incorrect request with bad token_hash
+        data = dict(self._server_stat_history_data, token_hash='abracadabra')
+
+        response = requests.post(self._server_stat_history_url, data)
+        self.assertEqual(response.status_code, 403)
+
+
+class TestServerFilestoreStatistic(TestOdooInfrastructureClient):
+
+    def setUp(self):
+        self._server_filestore_stat_url = self.create_url(
+            '/saas/client/server/stat/filestore')
+        self._server_filestore_stat_data = {
+            'token_hash': self._hash_token
+        }
+
+    def test_01_controller_server_filestore_statistic(self):
+        response = requests.post(
+            self._server_filestore_stat_url,
+            self._server_filestore_stat_data)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertIn(self._db_name, data)
+        self.assertIsInstance(data[self._db_name], int)
+
+    def test_02_controller_server_filestore_statistic_dbs(self):
+        response = requests.post(
+            self._server_filestore_stat_url,
+            dict(self._server_filestore_stat_data, dbs=self._db_name))
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(list(data), [self._db_name])
+        self.assertIsInstance(data[self._db_name], int)
+
+    def test_03_controller_server_filestore_statistic(self):
+        # test incorrect request with bad token_hash
+        data = dict(
+            self._server_filestore_stat_data, token_hash='abracadabra')
+
+        response = requests.post(self._server_filestore_stat_url, data)
+        self.assertEqual(response.status_code, 403)
+
+
+class TestServerCacheStatistic(TestOdooInfrastructureClient):
+
+    def setUp(self):
+        self._server_cache_stat_url = self.create_url(
+            '/saas/client/server/stat/cache')
+        self._server_cache_stat_data = {
+            'token_hash': self._hash_token
+        }
+
+    def test_01_controller_server_cache_statistic(self):
+        response = requests.post(
+            self._server_cache_stat_url, self._server_cache_stat_data)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertIn('db_filter', data)
+        for cache_stat in data.values():
+            self.assertIsInstance(cache_stat['hits'], int)
+            self.assertIsInstance(cache_stat['misses'], int)
+
+    def test_02_controller_server_cache_statistic(self):
+        # test incorrect request with bad token_hash
+        data = dict(self._server_cache_stat_data, token_hash='abracadabra')
+
+        response = requests.post(self._server_cache_stat_url, data)
+        self.assertEqual(response.status_code, 403)
+
+
 class TestServerModuleInfo(TestOdooInfrastructureClient):
     def setUp(self):
         self._module_info_url = self.create_url('/saas/client/module/info')
@@ -115,6 +242,29 @@ class TestServerModuleInfo(TestOdooInfrastructureClient):
         response = requests.post(self._module_info_url, data)
         self.assertEqual(response.status_code, 403)
 
+    def test_03_controller_instance_module_info_etag(self):
+        response = requests.post(
+            self._module_info_url, self._module_info_data)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertTrue(etag)
+
+        # Addons were not changed, so 304 expected
+        response = requests.post(
+            self._module_info_url, self._module_info_data,
+            headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertFalse(response.content)
+
+        # Unknown etag: full response expected
+        response = requests.post(
+            self._module_info_url, self._module_info_data,
+            headers={'If-None-Match': '"abracadabra"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertIn('base', response.json())
+
 
 class TestModuleInfoTokenInHeader(TestOdooInfrastructureClient):
     def setUp(self):
@@ -130,3 +280,58 @@ class TestModuleInfoTokenInHeader(TestOdooInfrastructureClient):
         self.assertTrue(len(data) != 0)
         base_info = data.get('base', None)
         self.assertIsNotNone(base_info)
+
+
+class TestServerTrashStatistic(TestOdooInfrastructureClient):
+
+    def setUp(self):
+        self._server_trash_stat_url = self.create_url(
+            '/saas/client/server/stat/trash')
+        self._server_trash_stat_data = {
+            'token_hash': self._hash_token
+        }
+
+    def test_01_controller_server_trash_statistic(self):
+        response = requests.post(
+            self._server_trash_stat_url, self._server_trash_stat_data)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['count'], len(data['filestores']))
+        self.assertIsInstance(data['rate'], (int, float))
+
+    def _get_trash_entries(self, db):
+        response = requests.post(
+            self._server_trash_stat_url, self._server_trash_stat_data)
+        self.assertEqual(response.status_code, 200)
+        return [
+            e for e in response.json()['filestores'] if e['db'] == db]
+
+    def test_01_controller_server_trash_drop_db(self):
+        # Filestore of dropped database is moved to trash, and removed
+        # from trash in background
+        db = 'test_db_trash'
+        response = requests.post(
+            self.create_url('/saas/client/db/duplicate'),
+            dict(self._server_trash_stat_data, db=self._db_name,
+                 new_dbname=db))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._get_trash_entries(db), [])
+
+        response = requests.post(
+            self.create_url('/saas/client/db/drop'),
+            dict(self._server_trash_stat_data, db=db))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(self._odoo_instance.services.db.db_exist(db))
+
+        for __ in range(60):
+            if not self._get_trash_entries(db):
+                break
+            time.sleep(1)
+        self.assertEqual(self._get_trash_entries(db), [])
+
+    def test_02_controller_server_trash_statistic(self):
+        # test incorrect request with bad token_hash
+        data = dict(self._server_trash_stat_data, token_hash='abracadabra')
+
+        response = requests.post(self._server_trash_stat_url, data)
+        self.assertEqual(response.status_code, 403)
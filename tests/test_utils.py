@@ -0,0 +1,168 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
+
+import werkzeug
+
+from yodoo_client import utils
+from yodoo_client.cache import invalidate_db_lifecycle_caches
+
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode('utf8')).hexdigest()
+
+
+class FakeConfig(dict):
+    """ Minimal replacement of odoo config, that reads options from
+        given config file
+    """
+    def __init__(self, rcfile, **options):
+        super(FakeConfig, self).__init__(**options)
+        self.rcfile = rcfile
+
+
+class TestSaaSTokenVerifier(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._rcfile = os.path.join(self._tmp_dir, 'odoo.conf')
+        self._mtime = 0
+        self._write_config('token-1')
+
+        self._config = FakeConfig(self._rcfile, yodoo_token='token-1')
+        patcher = mock.patch.object(utils, 'config', self._config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Check config file for changes on each request
+        patcher = mock.patch.object(
+            utils.SaaSTokenVerifier, 'RELOAD_CHECK_INTERVAL', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def _write_config(self, token, extra_tokens=None):
+        with open(self._rcfile, 'wt') as f:
+            f.write("[options]\n")
+            f.write("yodoo_token = %s\n" % token)
+            if extra_tokens:
+                f.write("yodoo_extra_tokens = %s\n" % extra_tokens)
+        # Make sure that change is detected, even if file was rewritten
+        # in same tick of filesystem clock
+        self._mtime += 1
+        os.utime(self._rcfile, ns=(self._mtime, self._mtime))
+
+    def test_01_token_check(self):
+        verifier = utils.SaaSTokenVerifier()
+        self.assertEqual(verifier.primary_digest, _token_hash('token-1'))
+        verifier.check(_token_hash('token-1'))
+        with self.assertRaises(werkzeug.exceptions.Forbidden):
+            verifier.check(_token_hash('token-2'))
+        with self.assertRaises(werkzeug.exceptions.Forbidden):
+            verifier.check('')
+
+    def test_02_token_rotation(self):
+        verifier = utils.SaaSTokenVerifier()
+
+        # New token is added, old one is still accepted
+        self._write_config('token-2', extra_tokens='token-1')
+        verifier.check(_token_hash('token-1'))
+        verifier.check(_token_hash('token-2'))
+        self.assertEqual(verifier.primary_digest, _token_hash('token-2'))
+
+        # Old token is removed
+        self._write_config('token-2')
+        verifier.check(_token_hash('token-2'))
+        with self.assertRaises(werkzeug.exceptions.Forbidden):
+            verifier.check(_token_hash('token-1'))
+
+    def test_03_token_config_file_missing(self):
+        verifier = utils.SaaSTokenVerifier()
+
+        # Config file removed (or being replaced): tokens are kept
+        os.unlink(self._rcfile)
+        verifier.check(_token_hash('token-1'))
+        self.assertEqual(verifier.primary_digest, _token_hash('token-1'))
+
+        # Config file restored with new token
+        self._write_config('token-2')
+        verifier.check(_token_hash('token-2'))
+        with self.assertRaises(werkzeug.exceptions.Forbidden):
+            verifier.check(_token_hash('token-1'))
+
+    def test_04_token_not_configured(self):
+        os.unlink(self._rcfile)
+        self._config.pop('yodoo_token')
+        verifier = utils.SaaSTokenVerifier()
+        self.assertFalse(verifier.primary_digest)
+        with self.assertLogs(utils.__name__, 'ERROR') as logs:
+            with self.assertRaises(werkzeug.exceptions.NotFound):
+                verifier.check(_token_hash('token-1'))
+        self.assertIn(self._rcfile, logs.output[0])
+
+
+class TestDbExists(unittest.TestCase):
+
+    def setUp(self):
+        utils._db_exist_cache.invalidate()
+        self.addCleanup(utils._db_exist_cache.invalidate)
+        utils._db_missing_cache.invalidate()
+        self.addCleanup(utils._db_missing_cache.invalidate)
+
+        # Direct check in pg_database: database does not exist
+        self._cursor = mock.MagicMock()
+        self._cursor.fetchone.return_value = (False,)
+        patcher = mock.patch.object(utils.sql_db, 'db_connect')
+        db_connect = patcher.start()
+        self.addCleanup(patcher.stop)
+        db_connect.return_value.cursor.return_value = self._cursor
+
+    def test_01_db_exists_cached(self):
+        with mock.patch.object(
+                utils._db_exist_cache, '_func',
+                side_effect=[frozenset(['db-1']), frozenset()]) as func:
+            self.assertTrue(utils.db_exists('db-1'))
+            self.assertTrue(utils.db_exists('db-1'))
+            self.assertEqual(func.call_count, 1)
+            self._cursor.execute.assert_not_called()
+
+            # Database dropped: cached list is invalidated, and database
+            # is not found anymore
+            invalidate_db_lifecycle_caches()
+            self.assertFalse(utils.db_exists('db-1'))
+            self.assertEqual(func.call_count, 2)
+            self._cursor.execute.assert_called_once()
+
+    def test_02_db_exists_not_cached(self):
+        # Database created by other worker is not in cached list yet,
+        # so it is checked directly
+        with mock.patch.object(
+                utils._db_exist_cache, '_func',
+                return_value=frozenset(['db-1'])) as func:
+            self.assertFalse(utils.db_exists('db-2'))
+            self._cursor.fetchone.return_value = (True,)
+            # Missing database is remembered only for short time
+            utils._db_missing_cache.invalidate()
+            self.assertTrue(utils.db_exists('db-2'))
+            self.assertEqual(func.call_count, 1)
+            self.assertEqual(self._cursor.execute.call_count, 2)
+
+    def test_03_db_exists_missing_cached(self):
+        with mock.patch.object(
+                utils._db_exist_cache, '_func',
+                return_value=frozenset(['db-1'])):
+            # Missing database is checked directly only once
+            self.assertFalse(utils.db_exists('db-2'))
+            self.assertFalse(utils.db_exists('db-2'))
+            self._cursor.execute.assert_called_once()
+
+            # Database created: missing databases are forgotten
+            invalidate_db_lifecycle_caches()
+            self._cursor.fetchone.return_value = (True,)
+            self.assertTrue(utils.db_exists('db-2'))
+            self.assertEqual(self._cursor.execute.call_count, 2)
@@ -0,0 +1,884 @@
+import os
+import re
+import time
+import json
+import zlib
+import shutil
+import struct
+import logging
+import zipfile
+import tempfile
+import contextlib
+import subprocess
+
+import odoo
+from odoo import SUPERUSER_ID
+from odoo.service import db as service_db
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .config import config_get_int
+
+BACKUP_CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+# Number of parallel jobs used by pg_dump / pg_restore for 'directory' format
+DEFAULT_BACKUP_JOBS = 4
+
+# Name of directory in zip archive, that contains pg_dump output
+# in directory format
+DIRECTORY_DUMP_NAME = 'dump'
+
+COMPRESSION_STORED = 'stored'
+COMPRESSION_DEFLATE = 'deflate'
+COMPRESSION_ZSTD = 'zstd'
+
+# Supported levels for compression codecs
+COMPRESSION_LEVELS = {
+    COMPRESSION_DEFLATE: range(0, 10),
+    COMPRESSION_ZSTD: range(1, 23),
+}
+DEFAULT_ZSTD_LEVEL = 3
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Name of entry in delta backups, that lists all files of filestore,
+# including ones not included in backup
+FILESTORE_INDEX_NAME = 'filestore.json'
+
+# Odoo stores attachments in filestore as '<sha1[:2]>/<sha1>'
+SHA1_RE = re.compile(r'^[0-9a-f]{40}$')
+FILESTORE_BLOB_RE = re.compile(r'^([0-9a-f]{2})/(\1[0-9a-f]{38})$')
+
+_logger = logging.getLogger(__name__)
+
+
+class _ZipStreamBuffer(object):
+    """ Write-only file-like object, that collects data written by zipfile.
+        Collected data have to be taken by 'take' method, so memory usage
+        is bounded by size of data written between calls of 'take'.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+@contextlib.contextmanager
+def _pg_command_pipe(name, *args):
+    """ Run postgresql command 'name' in background, and return its stdout.
+        On exit, wait for command to finish and raise error if it failed.
+        If block exits with error, then command is killed.
+    """
+    cmd = [odoo.tools.find_pg_tool(name)] + list(args)
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(
+            cmd,
+            env=odoo.tools.exec_pg_environ(),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=stderr)
+        try:
+            yield proc.stdout
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode:
+            stderr.seek(0)
+            raise Exception("%s failed (exit code %s): %s" % (
+                name, proc.returncode,
+                stderr.read().decode('utf-8', 'replace')))
+
+
+def _iter_filestore(filestore):
+    """ Yield tuples (path, relative_path) for all files in filestore
+    """
+    for root, dirs, files in os.walk(filestore):
+        dirs.sort()
+        for fname in sorted(files):
+            path = os.path.join(root, fname)
+            yield path, os.path.relpath(path, filestore)
+
+
+def _get_backup_jobs():
+    return max(min(
+        config_get_int('yodoo_backup_jobs', DEFAULT_BACKUP_JOBS),
+        os.cpu_count() or 1), 1)
+
+
+def parse_compression(compression):
+    """ Parse compression specification in form 'codec' or 'codec:level',
+        where codec is one of 'stored', 'deflate', 'zstd'.
+
+        :return: tuple(codec, level). Level is None if not specified.
+                 If compression is not specified, then (None, None)
+                 is returned, that means default compression.
+        :raises ValueError: if compression is not supported
+    """
+    if not compression:
+        return None, None
+    codec, __, level = compression.partition(':')
+    codec = codec.strip().lower()
+    if codec not in (
+            COMPRESSION_STORED, COMPRESSION_DEFLATE, COMPRESSION_ZSTD):
+        raise ValueError("Unsupported compression: %s" % compression)
+    if codec == COMPRESSION_ZSTD and zstandard is None:
+        raise ValueError(
+            "zstd compression is not available: "
+            "python package 'zstandard' is not installed")
+    if not level:
+        return codec, None
+    try:
+        level = int(level)
+    except ValueError:
+        raise ValueError("Wrong compression level: %s" % compression)
+    if level not in COMPRESSION_LEVELS.get(codec, ()):
+        raise ValueError("Wrong compression level: %s" % compression)
+    return codec, level
+
+
+def get_backup_filename(db_name, backup_format, compression=None):
+    codec, __ = parse_compression(compression)
+    if backup_format == 'directory':
+        filename = "%s.zip" % db_name
+    else:
+        filename = "%s.%s" % (db_name, backup_format)
+    if codec == COMPRESSION_ZSTD:
+        filename += '.zst'
+    return filename
+
+
+def _get_zip_options(codec, level):
+    """ Return kwargs for zipfile.ZipFile for compression codec.
+        With zstd, archive is compressed as whole, so entries are stored.
+    """
+    if codec in (COMPRESSION_STORED, COMPRESSION_ZSTD):
+        return {'compression': zipfile.ZIP_STORED}
+    if level is None:
+        return {'compression': zipfile.ZIP_DEFLATED}
+    return {'compression': zipfile.ZIP_DEFLATED, 'compresslevel': level}
+
+
+def _get_pg_dump_compress_args(codec, level):
+    """ Return pg_dump options to control compression of dumps in
+        custom and directory formats
+    """
+    if codec in (COMPRESSION_STORED, COMPRESSION_ZSTD):
+        return ['--compress=0']
+    if codec == COMPRESSION_DEFLATE and level is not None:
+        return ['--compress=%d' % level]
+    return []
+
+
+def _zip_stream_entry(zf, buf, arcname, src, compress_type=None):
+    """ Write content of file-like object 'src' to zip entry 'arcname',
+        yielding compressed data as soon as it is available.
+    """
+    if compress_type is None:
+        # Use compression and compression level of archive
+        zinfo = arcname
+    else:
+        zinfo = zipfile.ZipInfo(arcname, time.localtime()[:6])
+        zinfo.compress_type = compress_type
+    with zf.open(zinfo, 'w', force_zip64=True) as dest:
+        while True:
+            chunk = src.read(BACKUP_CHUNK_SIZE)
+            if not chunk:
+                break
+            dest.write(chunk)
+            data = buf.take()
+            if data:
+                yield data
+    data = buf.take()
+    if data:
+        yield data
+
+
+def parse_known_hashes(data):
+    """ Parse list of sha1 hashes separated by whitespace or commas.
+
+        :param data: str, bytes or file-like object
+        :return: frozenset of hashes
+        :raises ValueError: if data contains something except sha1 hashes
+    """
+    if hasattr(data, 'read'):
+        data = data.read()
+    if isinstance(data, bytes):
+        data = data.decode('ascii', 'replace')
+    hashes = set()
+    for token in re.split(r'[\s,]+', data.strip().lower()):
+        if not token:
+            continue
+        if not SHA1_RE.match(token):
+            raise ValueError("Wrong hash: %s" % token[:64])
+        hashes.add(token)
+    return frozenset(hashes)
+
+
+def _zip_stream_filestore(zf, buf, db_name, known_hashes=None):
+    """ Add files of filestore to archive.
+
+        If known_hashes is passed, then backup is delta backup: attachments
+        which hash is in known_hashes are not included in archive, and
+        list of all files of filestore is written to FILESTORE_INDEX_NAME
+        entry, so restore could take missing files from blob store.
+    """
+    filestore = odoo.tools.config.filestore(db_name)
+    filestore_index = []
+    for path, relpath in _iter_filestore(filestore):
+        if known_hashes is not None:
+            match = FILESTORE_BLOB_RE.match(relpath.replace(os.sep, '/'))
+            if match and match.group(2) in known_hashes:
+                if os.path.exists(path):
+                    filestore_index.append(relpath)
+                continue
+        try:
+            src = open(path, 'rb')
+        except FileNotFoundError:
+            # File was removed by garbage collector after dump started
+            continue
+        with src:
+            filestore_index.append(relpath)
+            yield from _zip_stream_entry(
+                zf, buf, os.path.join('filestore', relpath), src)
+    if known_hashes is not None:
+        zf.writestr(FILESTORE_INDEX_NAME, json.dumps({
+            'files': filestore_index,
+        }))
+
+
+def _zip_write_manifest(zf, db_name):
+    with odoo.sql_db.db_connect(db_name).cursor() as cr:
+        manifest = service_db.dump_db_manifest(cr)
+    zf.writestr('manifest.json', json.dumps(manifest, indent=4))
+
+
+def _stream_dump_db_zip(db_name, codec, level, known_hashes=None):
+    buf = _ZipStreamBuffer()
+    with zipfile.ZipFile(buf, 'w', allowZip64=True,
+                         **_get_zip_options(codec, level)) as zf:
+        _zip_write_manifest(zf, db_name)
+        with _pg_command_pipe('pg_dump', '--no-owner', db_name) as dump:
+            yield from _zip_stream_entry(zf, buf, 'dump.sql', dump)
+        yield from _zip_stream_filestore(zf, buf, db_name, known_hashes)
+    data = buf.take()
+    if data:
+        yield data
+
+
+def _stream_dump_db_directory(db_name, codec, level, known_hashes=None):
+    """ Dump database with pg_dump in directory format using parallel jobs,
+        and pack result in zip archive with filestore.
+
+        Files produced by pg_dump are already compressed by pg_dump
+        (according to requested compression), so they are stored
+        in archive without compression.
+    """
+    buf = _ZipStreamBuffer()
+    with odoo.tools.osutil.tempdir() as dump_dir:
+        dump_path = os.path.join(dump_dir, DIRECTORY_DUMP_NAME)
+        with zipfile.ZipFile(buf, 'w', allowZip64=True,
+                             **_get_zip_options(codec, level)) as zf:
+            _zip_write_manifest(zf, db_name)
+            odoo.tools.exec_pg_command(
+                'pg_dump', '--no-owner', '--format=directory',
+                '--jobs=%d' % _get_backup_jobs(),
+                *_get_pg_dump_compress_args(codec, level),
+                '--file=' + dump_path, db_name)
+            for fname in sorted(os.listdir(dump_path)):
+                with open(os.path.join(dump_path, fname), 'rb') as src:
+                    yield from _zip_stream_entry(
+                        zf, buf, '%s/%s' % (DIRECTORY_DUMP_NAME, fname), src,
+                        compress_type=zipfile.ZIP_STORED)
+            yield from _zip_stream_filestore(
+                zf, buf, db_name, known_hashes)
+    data = buf.take()
+    if data:
+        yield data
+
+
+def _stream_dump_db_custom(db_name, codec, level):
+    with _pg_command_pipe(
+            'pg_dump', '--no-owner', '--format=c',
+            *_get_pg_dump_compress_args(codec, level), db_name) as dump:
+        while True:
+            chunk = dump.read(BACKUP_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _zstd_compress_chunks(chunks, level):
+    """ Compress stream of chunks with zstd, using all available CPUs
+    """
+    compressor = zstandard.ZstdCompressor(
+        level=DEFAULT_ZSTD_LEVEL if level is None else level,
+        threads=-1,
+    ).compressobj()
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        chunks.close()
+
+
+@service_db.check_db_management_enabled
+def stream_dump_db(db_name, backup_format='zip', compression=None,
+                   known_hashes=None):
+    """ Dump database without staging dump on disk.
+
+        In 'zip' format, archive is generated on the fly: 'dump.sql' entry
+        is fed directly from pg_dump output, and filestore entries are read
+        directly from disk. Archive is compatible with odoo's restore.
+
+        In 'directory' format, pg_dump runs with parallel jobs, and its
+        output is packed to zip archive together with filestore.
+
+        With 'zstd' compression, backup is generated without compression
+        and then compressed as whole by multithreaded zstd.
+
+        :param str compression: compression in form 'codec[:level]',
+            see parse_compression.
+        :param known_hashes: set of sha1 hashes of attachments, that are
+            already available to receiver (for example in blob store).
+            If set, then these attachments are not included in archive.
+            Not used for custom format, that does not contain filestore.
+        :return: iterator over chunks of backup data
+        :raises AccessDenied: if database management is disabled
+        :raises ValueError: if compression is not supported
+    """
+    codec, level = parse_compression(compression)
+    _logger.info(
+        'DUMP DB (stream): %s format %s compression %s',
+        db_name, backup_format, compression)
+    if backup_format == 'zip':
+        chunks = _stream_dump_db_zip(db_name, codec, level, known_hashes)
+    elif backup_format == 'directory':
+        chunks = _stream_dump_db_directory(
+            db_name, codec, level, known_hashes)
+    else:
+        chunks = _stream_dump_db_custom(db_name, codec, level)
+
+    if codec == COMPRESSION_ZSTD:
+        return _zstd_compress_chunks(chunks, level)
+    return chunks
+
+
+def _get_blob_store_files(filestore_index, filestore_path, included=None):
+    """ Find files listed in filestore index of delta backup, but not
+        included in backup, in blob store configured by
+        'yodoo_blob_store' option.
+
+        :param dict filestore_index: content of FILESTORE_INDEX_NAME entry
+        :param str filestore_path: path to restored filestore
+        :param set included: paths of files (relative to filestore)
+            included in backup. If not set, then files that exist in
+            filestore_path are treated as included.
+        :return: list of tuples (blob_path, filestore_file_path)
+        :raises Exception: if some files are not available in blob store
+    """
+    blob_store = odoo.tools.config.get('yodoo_blob_store')
+
+    res = []
+    missing = []
+    for relpath in filestore_index['files']:
+        dest = os.path.join(filestore_path, relpath)
+        if included is None:
+            if os.path.exists(dest):
+                continue
+        elif relpath in included:
+            continue
+        match = FILESTORE_BLOB_RE.match(relpath)
+        src = match and blob_store and os.path.join(
+            blob_store, match.group(1), match.group(2))
+        if not src or not os.path.isfile(src):
+            missing.append(relpath)
+            continue
+        res.append((src, dest))
+    if missing:
+        raise Exception(
+            "Cannot restore delta backup: %d files are not available in "
+            "blob store (%s)" % (len(missing), ', '.join(missing[:10])))
+    return res
+
+
+def _fill_filestore_from_blob_store(filestore_index, filestore_path,
+                                    blob_files=None):
+    """ Add files listed in filestore index of delta backup, but not
+        included in backup, from blob store.
+
+        :param dict filestore_index: content of FILESTORE_INDEX_NAME entry
+        :param str filestore_path: path to restored filestore
+        :param list blob_files: result of _get_blob_store_files, if files
+            were already looked up
+        :raises Exception: if some files are not available in blob store
+    """
+    if blob_files is None:
+        blob_files = _get_blob_store_files(filestore_index, filestore_path)
+    for src, dest in blob_files:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            # Blob store is usually located on same filesystem as
+            # filestore, so try to avoid copying of data
+            os.link(src, dest)
+        except FileExistsError:
+            continue
+        except OSError:
+            shutil.copyfile(src, dest)
+
+
+@service_db.check_db_management_enabled
+def _restore_db_extracted(db, dump_dir, copy=False, restore_filestore=None):
+    """ Restore database from extracted backup.
+        Dump in directory format is restored by pg_restore with parallel
+        jobs. Other steps are same as in odoo's restore_db.
+
+        :param callable restore_filestore: function, that receives path
+            of filestore of restored database and fills it
+    """
+    if service_db.exp_db_exist(db):
+        _logger.info('RESTORE DB: %s already exists', db)
+        raise Exception("Database already exists")
+
+    service_db._create_empty_database(db)
+
+    directory_dump_path = os.path.join(dump_dir, DIRECTORY_DUMP_NAME)
+    if os.path.isdir(directory_dump_path):
+        odoo.tools.exec_pg_command(
+            'pg_restore', '--no-owner', '--dbname=' + db,
+            '--jobs=%d' % _get_backup_jobs(), directory_dump_path)
+    else:
+        odoo.tools.exec_pg_command(
+            'psql', '--dbname=' + db, '-q',
+            '-f', os.path.join(dump_dir, 'dump.sql'))
+
+    if restore_filestore is not None:
+        restore_filestore(odoo.tools.config.filestore(db))
+    _finalize_restored_db(db, copy)
+
+
+def _finalize_restored_db(db, copy=False):
+    """ Final steps of restore (same as in odoo's restore_db):
+        if database is a copy, regenerate its uuid and secret.
+    """
+    registry = odoo.modules.registry.Registry.new(db)
+    with registry.cursor() as cr:
+        env = odoo.api.Environment(cr, SUPERUSER_ID, {})
+        if copy:
+            env['ir.config_parameter'].init(force=True)
+
+    _logger.info('RESTORE DB: %s', db)
+
+
+def is_zstd_compressed(dump_file):
+    with open(dump_file, 'rb') as f:
+        return f.read(len(ZSTD_MAGIC)) == ZSTD_MAGIC
+
+
+def restore_db(db, dump_file, copy=False):
+    """ Restore database from file 'dump_file'.
+        Same as odoo's restore_db, but also supports zip archives
+        with dump in directory format (restored with parallel jobs),
+        delta backups (missing files are taken from blob store),
+        and backups compressed with zstd.
+        Format and compression of backup is detected automatically.
+    """
+    if is_zstd_compressed(dump_file):
+        if zstandard is None:
+            raise Exception(
+                "Cannot restore zstd compressed backup: "
+                "python package 'zstandard' is not installed")
+        with open(dump_file, 'rb') as src, \
+                tempfile.NamedTemporaryFile() as data_file:
+            zstandard.ZstdDecompressor().copy_stream(src, data_file)
+            data_file.flush()
+            return restore_db(db, data_file.name, copy)
+
+    if not zipfile.is_zipfile(dump_file):
+        return service_db.restore_db(db, dump_file, copy)
+
+    with zipfile.ZipFile(dump_file, 'r') as z:
+        names = z.namelist()
+        is_directory = '%s/toc.dat' % DIRECTORY_DUMP_NAME in names
+        is_delta = FILESTORE_INDEX_NAME in names
+        if not is_directory and not is_delta:
+            return service_db.restore_db(db, dump_file, copy)
+
+        filestore_names = [
+            m for m in names
+            if m.startswith('filestore/') and not m.endswith('/')]
+        blob_files = None
+        if is_delta:
+            # Check that blob store contains all files not included in
+            # backup before database is created
+            blob_files = _get_blob_store_files(
+                json.loads(z.read(FILESTORE_INDEX_NAME)),
+                odoo.tools.config.filestore(db),
+                included={m[len('filestore/'):] for m in filestore_names})
+
+        def restore_filestore(filestore_path):
+            # Extract filestore directly to its final location, thus
+            # files from blob store could be hardlinked there, and
+            # filestore have not to be moved across filesystems
+            for name in filestore_names:
+                dest = _get_restore_path(
+                    filestore_path, name[len('filestore/'):])
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                with z.open(name) as src, open(dest, 'wb') as f:
+                    shutil.copyfileobj(src, f, BACKUP_CHUNK_SIZE)
+            if blob_files:
+                _fill_filestore_from_blob_store(
+                    None, filestore_path, blob_files)
+
+        with odoo.tools.osutil.tempdir() as dump_dir:
+            # only extract known members!
+            z.extractall(dump_dir, [
+                m for m in names
+                if m == 'dump.sql' or
+                m.startswith(DIRECTORY_DUMP_NAME + '/')])
+            return _restore_db_extracted(
+                db, dump_dir, copy, restore_filestore)
+
+
+class _StreamReader(object):
+    """ Wrapper over readable file-like object, that allows to put back
+        data that was read, but not consumed.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._buf = b''
+
+    def read(self, size=-1):
+        if self._buf:
+            if size < 0 or size >= len(self._buf):
+                data, self._buf = self._buf, b''
+            else:
+                data, self._buf = self._buf[:size], self._buf[size:]
+            return data
+        return self._stream.read(size)
+
+    def read_exact(self, size):
+        chunks = []
+        while size > 0:
+            data = self.read(min(size, BACKUP_CHUNK_SIZE))
+            if not data:
+                raise EOFError("Unexpected end of backup stream")
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+    def unread(self, data):
+        if data:
+            self._buf = data + self._buf
+
+
+class _ZipStreamReader(object):
+    """ Sequential reader of zip archive from non-seekable stream.
+
+        Entries are read using local headers, so archive is processed
+        while it is being received. Stored and deflated entries are
+        supported, including entries with data descriptors (written when
+        archive is generated as stream, as done by stream_dump_db).
+    """
+    LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+    LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+    CENTRAL_DIR_SIGNATURES = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06')
+    DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+    FLAG_ENCRYPTED = 0x01
+    FLAG_DATA_DESCRIPTOR = 0x08
+
+    def __init__(self, reader):
+        self._reader = reader
+
+    def _parse_zip64_extra(self, extra, usize, csize):
+        while len(extra) >= 4:
+            tag, size = struct.unpack_from('<HH', extra)
+            if tag == 1:
+                values = list(struct.unpack_from(
+                    '<%dQ' % (size // 8), extra, 4))
+                if usize == 0xFFFFFFFF and values:
+                    usize = values.pop(0)
+                if csize == 0xFFFFFFFF and values:
+                    csize = values.pop(0)
+                return True, usize, csize
+            extra = extra[4 + size:]
+        return False, usize, csize
+
+    def _iter_sized(self, size):
+        while size > 0:
+            data = self._reader.read(min(size, BACKUP_CHUNK_SIZE))
+            if not data:
+                raise EOFError("Unexpected end of zip archive")
+            size -= len(data)
+            yield data
+
+    def _iter_deflated(self, csize):
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        while not decompressor.eof:
+            if csize is None:
+                data = self._reader.read(BACKUP_CHUNK_SIZE)
+            else:
+                data = self._reader.read(min(csize, BACKUP_CHUNK_SIZE))
+                csize -= len(data)
+            if not data:
+                raise EOFError("Unexpected end of zip archive")
+            data = decompressor.decompress(data)
+            if data:
+                yield data
+        self._reader.unread(decompressor.unused_data)
+
+    def _iter_stored_with_descriptor(self, zip64):
+        """ Read stored entry with unknown size. End of entry is found by
+            data descriptor, that contains crc and size of data read
+            before it, so false matches are practically impossible.
+        """
+        fmt = struct.Struct('<LQQ' if zip64 else '<LLL')
+        dd_size = len(self.DATA_DESCRIPTOR_SIGNATURE) + fmt.size
+        crc = size = 0
+        pending = b''
+        while True:
+            data = self._reader.read(BACKUP_CHUNK_SIZE)
+            if not data:
+                raise EOFError("Unexpected end of zip archive")
+            pending += data
+            start = 0
+            while True:
+                pos = pending.find(self.DATA_DESCRIPTOR_SIGNATURE, start)
+                if pos < 0 or pos + dd_size > len(pending):
+                    break
+                dd_crc, dd_csize, __ = fmt.unpack_from(pending, pos + 4)
+                if (dd_csize == size + pos and
+                        dd_crc == zlib.crc32(pending[:pos], crc)):
+                    if pos:
+                        yield pending[:pos]
+                    self._reader.unread(pending[pos + dd_size:])
+                    return
+                start = pos + 1
+
+            # Emit data, that could not contain start of data descriptor
+            if pos < 0:
+                pos = max(len(pending) - dd_size, 0)
+            data, pending = pending[:pos], pending[pos:]
+            if data:
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                yield data
+
+    def _skip_data_descriptor(self, zip64):
+        size = 20 if zip64 else 12
+        signature = self._reader.read_exact(4)
+        if signature != self.DATA_DESCRIPTOR_SIGNATURE:
+            # Signature of data descriptor is optional
+            size -= 4
+        self._reader.read_exact(size)
+
+    def iter_entries(self):
+        """ Yield tuples (name, chunks) for each entry of archive.
+            If chunks are not consumed by caller, they are skipped
+            automatically before next entry.
+        """
+        while True:
+            signature = self._reader.read_exact(4)
+            if signature in self.CENTRAL_DIR_SIGNATURES:
+                # All entries are read. Read rest of stream to finish
+                # request processing correctly
+                while self._reader.read(BACKUP_CHUNK_SIZE):
+                    pass
+                return
+            if signature != self.LOCAL_HEADER_SIGNATURE:
+                raise Exception("Bad zip archive: wrong local header")
+            header = self.LOCAL_HEADER.unpack(
+                signature + self._reader.read_exact(
+                    self.LOCAL_HEADER.size - 4))
+            __, __, flags, method, __, __, __, csize, usize, name_len, \
+                extra_len = header
+            name = self._reader.read_exact(name_len).decode(
+                'utf-8' if flags & 0x800 else 'cp437')
+            zip64, usize, csize = self._parse_zip64_extra(
+                self._reader.read_exact(extra_len), usize, csize)
+
+            if flags & self.FLAG_ENCRYPTED:
+                raise Exception("Encrypted zip archives are not supported")
+            has_descriptor = bool(flags & self.FLAG_DATA_DESCRIPTOR)
+            if method == zipfile.ZIP_DEFLATED:
+                chunks = self._iter_deflated(
+                    None if has_descriptor else csize)
+            elif method != zipfile.ZIP_STORED:
+                raise Exception(
+                    "Unsupported compression method %s in zip archive" % (
+                        method,))
+            elif has_descriptor:
+                chunks = self._iter_stored_with_descriptor(zip64)
+            else:
+                chunks = self._iter_sized(csize)
+
+            yield name, chunks
+            for __ in chunks:
+                pass
+            if has_descriptor and method == zipfile.ZIP_DEFLATED:
+                self._skip_data_descriptor(zip64)
+
+
+@contextlib.contextmanager
+def _pg_command_feed(name, *args):
+    """ Run postgresql command 'name' in background, and return its stdin.
+        On exit, wait for command to finish and raise error if it failed.
+        If block exits with error, then command is killed.
+    """
+    cmd = [odoo.tools.find_pg_tool(name)] + list(args)
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(
+            cmd,
+            env=odoo.tools.exec_pg_environ(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr)
+        try:
+            yield proc.stdin
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            proc.wait()
+        if proc.returncode:
+            stderr.seek(0)
+            raise Exception("%s failed (exit code %s): %s" % (
+                name, proc.returncode,
+                stderr.read().decode('utf-8', 'replace')))
+
+
+def _get_restore_path(root, relpath):
+    """ Return path of file 'relpath' inside directory 'root'.
+        Raise error if path points outside of root directory.
+    """
+    path = os.path.normpath(os.path.join(root, relpath))
+    if not path.startswith(root + os.sep):
+        raise Exception("Wrong path in backup: %s" % relpath)
+    return path
+
+
+def _write_chunks(path, chunks):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def _restore_zip_stream(db, reader):
+    """ Restore database from zip archive read from stream.
+
+        'dump.sql' is piped to psql while it is received, and filestore
+        entries are written directly to filestore of database. Dump in
+        directory format have to be received completely before
+        pg_restore started, so it is extracted to temporary directory.
+    """
+    filestore_path = odoo.tools.config.filestore(db)
+    filestore_index = None
+    with odoo.tools.osutil.tempdir() as dump_dir:
+        directory_dump_path = os.path.join(dump_dir, DIRECTORY_DUMP_NAME)
+        for name, chunks in _ZipStreamReader(reader).iter_entries():
+            if name.endswith('/'):
+                continue
+            if name == 'dump.sql':
+                with _pg_command_feed(
+                        'psql', '--dbname=' + db, '-q') as dump:
+                    for chunk in chunks:
+                        dump.write(chunk)
+            elif name == FILESTORE_INDEX_NAME:
+                filestore_index = json.loads(b''.join(chunks))
+            elif name.startswith('filestore/'):
+                _write_chunks(
+                    _get_restore_path(
+                        filestore_path, name[len('filestore/'):]),
+                    chunks)
+            elif name.startswith(DIRECTORY_DUMP_NAME + '/'):
+                _write_chunks(
+                    _get_restore_path(
+                        directory_dump_path,
+                        name[len(DIRECTORY_DUMP_NAME) + 1:]),
+                    chunks)
+
+        if os.path.isdir(directory_dump_path):
+            odoo.tools.exec_pg_command(
+                'pg_restore', '--no-owner', '--dbname=' + db,
+                '--jobs=%d' % _get_backup_jobs(), directory_dump_path)
+
+    if filestore_index is not None:
+        _fill_filestore_from_blob_store(filestore_index, filestore_path)
+
+
+@service_db.check_db_management_enabled
+def restore_db_stream(db, stream, copy=False):
+    """ Restore database from backup read from file-like object 'stream'
+        (for example body of HTTP request), without saving backup
+        to temporary file first.
+
+        Format and compression of backup is detected automatically:
+        zip archives (including directory format and delta backups),
+        pg_dump custom format, and zstd-compressed backups are supported.
+        If restore fails, then partially restored database is dropped.
+    """
+    if service_db.exp_db_exist(db):
+        _logger.info('RESTORE DB: %s already exists', db)
+        raise Exception("Database already exists")
+
+    reader = _StreamReader(stream)
+    magic = reader.read_exact(len(ZSTD_MAGIC))
+    reader.unread(magic)
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            raise Exception(
+                "Cannot restore zstd compressed backup: "
+                "python package 'zstandard' is not installed")
+        reader = _StreamReader(
+            zstandard.ZstdDecompressor().stream_reader(reader))
+        magic = reader.read_exact(len(ZSTD_MAGIC))
+        reader.unread(magic)
+
+    if magic == _ZipStreamReader.LOCAL_HEADER_SIGNATURE:
+        restore = _restore_zip_stream
+    elif magic == b'PGDM':
+        def restore(db, reader):
+            with _pg_command_feed(
+                    'pg_restore', '--no-owner', '--dbname=' + db) as dump:
+                shutil.copyfileobj(reader, dump, BACKUP_CHUNK_SIZE)
+    else:
+        raise Exception("Unsupported format of backup")
+
+    service_db._create_empty_database(db)
+    try:
+        restore(db, reader)
+        _finalize_restored_db(db, copy)
+    except Exception:
+        _logger.error(
+            "RESTORE DB: %s failed. Dropping partially restored database",
+            db)
+        try:
+            service_db.exp_drop(db)
+        except Exception:
+            _logger.error("Cannot drop database %s", db, exc_info=True)
+        raise
@@ -0,0 +1,349 @@
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from contextlib import closing
+
+from odoo import sql_db
+from odoo.tools import config
+
+from .config import config_get_int
+from .utils import get_yodoo_data_dir
+from .filestore import get_filestore_signature
+from .backup import stream_dump_db, get_backup_filename
+
+# Directory in yodoo data dir, where backup artifacts are stored
+BACKUP_ARTIFACTS_DIR = 'backups'
+
+# Time in seconds to keep backup artifacts
+DEFAULT_BACKUP_RETENTION = 24 * 3600
+
+ARTIFACT_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+# Modes to detect changes in database:
+# - 'db_stat' (default): use per-database counters of changed rows
+#   (pg_stat_database). Quiet databases keep same fingerprint even if
+#   other databases in cluster are changed. Counters of committed
+#   transaction are flushed by backend when it becomes idle (forced in
+#   PGSTAT_IDLE_INTERVAL, 10 seconds, on PostgreSQL 15+), so counters are
+#   trusted only if all sessions connected to database are idle for
+#   longer time. Otherwise fingerprint is unknown, and backup is not
+#   reused. On PostgreSQL before 15 idle sessions could keep counters
+#   unflushed forever, so 'wal' mode is used there.
+# - 'wal': use current WAL insert position. Each committed change is
+#   written to WAL before commit returns, so this position never lags
+#   behind commits. Any change in cluster changes fingerprint of all
+#   databases.
+FINGERPRINT_MODE_DB_STAT = 'db_stat'
+FINGERPRINT_MODE_WAL = 'wal'
+
+# Sessions, idle for this time (seconds), have flushed statistics of
+# their transactions (PGSTAT_IDLE_INTERVAL of PostgreSQL with margin)
+DB_STAT_FLUSH_WINDOW = 15
+
+# Max time (seconds) to wait until sessions of database become idle
+# for DB_STAT_FLUSH_WINDOW
+DB_STAT_FLUSH_WAIT = 30
+
+_logger = logging.getLogger(__name__)
+
+
+def _get_wal_signature(cr):
+    cr.execute("SELECT pg_current_wal_insert_lsn()::text")
+    return cr.fetchone()[0]
+
+
+def _is_db_stat_flushed(cr, db):
+    """ Check that statistics of all transactions committed in database
+        'db' are flushed to pg_stat_database: all other sessions
+        connected to database are idle for DB_STAT_FLUSH_WINDOW seconds.
+        State of sessions of other users is not visible (NULL), so such
+        sessions are treated as not idle.
+    """
+    # Statistics are cached till the end of transaction
+    cr.execute("SELECT pg_stat_clear_snapshot()")
+    cr.execute("""
+        SELECT NOT EXISTS (
+            SELECT 1
+            FROM pg_stat_activity
+            WHERE datname = %s
+              AND pid != pg_backend_pid()
+              AND (state IS DISTINCT FROM 'idle' OR
+                   state_change > clock_timestamp() -
+                                  make_interval(secs => %s))
+        )
+    """, (db, DB_STAT_FLUSH_WINDOW))
+    return cr.fetchone()[0]
+
+
+def _get_db_stat_signature(cr, db):
+    """ Return signature of database 'db' based on its statistic
+        counters, or None if counters could be not flushed yet
+    """
+    deadline = time.monotonic() + DB_STAT_FLUSH_WAIT
+    while not _is_db_stat_flushed(cr, db):
+        if time.monotonic() > deadline:
+            _logger.info(
+                "Database %s is in use, changes could be not counted in "
+                "its statistic yet, so its backups are not reused", db)
+            return None
+        time.sleep(1)
+
+    # Database size is included to detect changes that are not counted
+    # in statistics (for example TRUNCATE)
+    cr.execute("""
+        SELECT d.oid,
+               s.stats_reset,
+               s.tup_inserted,
+               s.tup_updated,
+               s.tup_deleted,
+               pg_database_size(d.oid)
+        FROM pg_database AS d
+        JOIN pg_stat_database AS s ON s.datid = d.oid
+        WHERE d.datname = %s
+    """, (db,))
+    row = cr.fetchone()
+    if not row:
+        return None
+    return ','.join(str(v) for v in row)
+
+
+def _get_db_state_signature(cr, db):
+    mode = config.get('yodoo_backup_fingerprint', FINGERPRINT_MODE_DB_STAT)
+    if mode == FINGERPRINT_MODE_DB_STAT:
+        cr.execute("SELECT current_setting('server_version_num')::int")
+        if cr.fetchone()[0] >= 150000:
+            signature = _get_db_stat_signature(cr, db)
+            return signature and 'db_stat:%s' % signature
+    return 'wal:%s' % _get_wal_signature(cr)
+
+
+def get_db_fingerprint(db):
+    """ Return fingerprint of state of database and its filestore.
+        If fingerprint is not changed, then backup of database made
+        before will be same as new one.
+
+        Changes in database are detected according to
+        'yodoo_backup_fingerprint' option (see FINGERPRINT_MODE_*),
+        and changes in filestore are detected via filestore size index.
+
+        :return: fingerprint or None if changes of database could be
+                 not detected yet (backup must not be reused)
+    """
+    with closing(sql_db.db_connect('postgres').cursor()) as cr:
+        db_signature = _get_db_state_signature(cr, db)
+    if db_signature is None:
+        return None
+    return "%s:%s" % (db_signature, get_filestore_signature(db))
+
+
+class BackupArtifactStore(object):
+    """ Storage of backups, saved on disk for some time (retention), to
+        be downloaded later (possibly in parts via HTTP Range requests).
+
+        Each artifact is stored as two files: '<id>.data' with backup
+        itself and '<id>.json' with metadata. Metadata file is written
+        only after backup completed, so artifacts without metadata
+        are incomplete.
+    """
+
+    def __init__(self, path, retention):
+        self.path = path
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _get_data_path(self, artifact_id):
+        return os.path.join(self.path, '%s.data' % artifact_id)
+
+    def _get_meta_path(self, artifact_id):
+        return os.path.join(self.path, '%s.json' % artifact_id)
+
+    def _save_meta(self, meta):
+        path = self._get_meta_path(meta['id'])
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wt') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+
+    def _load_meta(self, artifact_id):
+        try:
+            with open(self._get_meta_path(artifact_id), 'rt') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            _logger.warning(
+                "Cannot read metadata of backup artifact %s",
+                artifact_id, exc_info=True)
+            return None
+
+    def _remove(self, artifact_id):
+        for path in (self._get_meta_path(artifact_id),
+                     self._get_data_path(artifact_id)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _iter_artifacts(self):
+        """ Yield metadata of all complete artifacts
+        """
+        for fname in os.listdir(self.path):
+            artifact_id, ext = os.path.splitext(fname)
+            if ext == '.json' and ARTIFACT_ID_RE.match(artifact_id):
+                meta = self._load_meta(artifact_id)
+                if meta:
+                    yield meta
+
+    def cleanup(self):
+        """ Remove expired artifacts and leftovers of failed backups.
+            Files that are being downloaded stay available for
+            downloads in progress until they are closed.
+        """
+        now = time.time()
+        for meta in self._iter_artifacts():
+            if meta['expires'] < now:
+                _logger.info(
+                    "Removing expired backup artifact %s (db %s)",
+                    meta['id'], meta['db'])
+                self._remove(meta['id'])
+
+        for fname in os.listdir(self.path):
+            path = os.path.join(self.path, fname)
+            artifact_id, ext = os.path.splitext(fname)
+            if ext == '.json' or not ARTIFACT_ID_RE.match(
+                    artifact_id.split('.')[0]):
+                continue
+            if ext == '.data' and os.path.exists(
+                    self._get_meta_path(artifact_id)):
+                continue
+            try:
+                if os.stat(path).st_mtime + self.retention < now:
+                    os.unlink(path)
+            except FileNotFoundError:
+                continue
+
+    def get(self, artifact_id):
+        """ Return metadata of artifact or None if there is no such
+            artifact or it is expired
+        """
+        if not ARTIFACT_ID_RE.match(artifact_id or ''):
+            return None
+        meta = self._load_meta(artifact_id)
+        if not meta or meta['expires'] < time.time():
+            return None
+        if not os.path.exists(self._get_data_path(artifact_id)):
+            return None
+        return meta
+
+    def open(self, meta):
+        return open(self._get_data_path(meta['id']), 'rb')
+
+    def _find(self, key, fingerprint):
+        if fingerprint is None:
+            return None
+        now = time.time()
+        for meta in self._iter_artifacts():
+            if (meta['key'] == key and meta['fingerprint'] == fingerprint
+                    and meta['expires'] >= now and
+                    os.path.exists(self._get_data_path(meta['id']))):
+                return meta
+        return None
+
+    def _get_key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(
+                json.dumps(key, sort_keys=True), threading.Lock())
+
+    def get_or_create(self, db, backup_format='zip', compression=None,
+                      known_hashes=None, on_progress=None):
+        """ Return artifact with backup of database 'db'.
+            If there is artifact made with same parameters, and database
+            is not changed since that time, then it will be reused.
+
+            :param callable on_progress: function called with number of
+                                         bytes written while backup is
+                                         being made
+            :return: tuple(metadata, reused)
+        """
+        key = {
+            'db': db,
+            'backup_format': backup_format,
+            'compression': compression,
+            'known_hashes': (
+                None if known_hashes is None else
+                hashlib.sha256(
+                    ','.join(sorted(known_hashes)).encode('ascii')
+                ).hexdigest()),
+        }
+        with self._get_key_lock(key):
+            self.cleanup()
+
+            # Fingerprint have to be computed before backup started,
+            # thus changes made during backup will change fingerprint
+            fingerprint = get_db_fingerprint(db)
+            meta = self._find(key, fingerprint)
+            if meta:
+                meta['expires'] = time.time() + self.retention
+                self._save_meta(meta)
+                return meta, True
+
+            artifact_id = uuid.uuid4().hex
+            data_path = self._get_data_path(artifact_id)
+            tmp_path = '%s.%s.tmp' % (data_path, os.getpid())
+            checksum = hashlib.sha256()
+            size = 0
+            try:
+                with open(tmp_path, 'wb') as f:
+                    for chunk in stream_dump_db(
+                            db, backup_format, compression, known_hashes):
+                        f.write(chunk)
+                        checksum.update(chunk)
+                        size += len(chunk)
+                        if on_progress is not None:
+                            on_progress(size)
+                os.replace(tmp_path, data_path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+
+            now = time.time()
+            meta = {
+                'id': artifact_id,
+                'key': key,
+                'db': db,
+                'filename': get_backup_filename(
+                    db, backup_format, compression),
+                'size': size,
+                'sha256': checksum.hexdigest(),
+                'fingerprint': fingerprint,
+                'created': now,
+                'expires': now + self.retention,
+            }
+            self._save_meta(meta)
+            return meta, False
+
+
+_backup_artifact_store = None
+_backup_artifact_store_lock = threading.Lock()
+
+
+def get_backup_artifact_store():
+    global _backup_artifact_store
+    if _backup_artifact_store is None:
+        with _backup_artifact_store_lock:
+            if _backup_artifact_store is None:
+                path = os.path.join(
+                    get_yodoo_data_dir(), BACKUP_ARTIFACTS_DIR)
+                os.makedirs(path, exist_ok=True)
+                _backup_artifact_store = BackupArtifactStore(
+                    path,
+                    config_get_int(
+                        'yodoo_backup_retention', DEFAULT_BACKUP_RETENTION))
+    return _backup_artifact_store
@@ -0,0 +1,186 @@
+import os
+import time
+import uuid
+import logging
+import threading
+
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+# Name of file in yodoo_client data dir, that is replaced each time
+# databases are changed. It is used to notify other workers (processes),
+# that caches of list of databases have to be invalidated.
+DB_LIFECYCLE_STAMP_NAME = 'db_lifecycle.stamp'
+
+# All caches in process, used to collect statistics
+_caches = []
+
+# Caches, that depend on list of databases, and thus have to be invalidated
+# when databases are created, dropped, renamed, etc.
+_db_lifecycle_caches = []
+
+
+def _get_db_lifecycle_stamp_path():
+    return os.path.join(
+        config['data_dir'], 'yodoo_client', DB_LIFECYCLE_STAMP_NAME)
+
+
+def get_db_lifecycle_stamp():
+    """ Return stamp of last change of databases made by any worker
+        that uses same data dir, or None if databases were not changed
+        since stamp file was created.
+    """
+    try:
+        st = os.stat(_get_db_lifecycle_stamp_path())
+    except OSError:
+        return None
+    # File is replaced on each change, so inode changes even if
+    # filesystem has coarse timestamps
+    return (st.st_ino, st.st_mtime_ns)
+
+
+def _update_db_lifecycle_stamp():
+    path = _get_db_lifecycle_stamp_path()
+    tmp_path = '%s.%s' % (path, uuid.uuid4().hex)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            f.write(tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        _logger.warning(
+            "Cannot update stamp of databases change %s. Other workers "
+            "will see changes only after their caches expired",
+            path, exc_info=True)
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
+def register_cache(cache):
+    """ Register cache to be included in statistics.
+        Cache have to provide attributes 'name', 'hits' and 'misses'.
+    """
+    _caches.append(cache)
+    return cache
+
+
+def get_caches_statistic():
+    """ Return statistic of caches in current process
+
+        :return: dict {cache_name: {
+            'hits': number of hits,
+            'misses': number of misses,
+            'hit_rate': hits / (hits + misses) or None,
+        }}
+    """
+    res = {}
+    for cache in _caches:
+        hits, misses = cache.hits, cache.misses
+        total = hits + misses
+        res[cache.name] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else None,
+        }
+    return res
+
+
+class CachedValue(object):
+    """ Thread-safe value, that is computed by 'func' and cached
+        for 'ttl' seconds.
+
+        Only one thread computes new value at a time. When value expires,
+        other threads get previous value until new one is computed.
+        After explicit invalidation, stale value is never returned.
+
+        Cache is per process (worker), so other workers will see
+        changes only after their cached value expired. Caches, that depend
+        on list of databases (db_lifecycle), are also invalidated when
+        other worker changed databases (see invalidate_db_lifecycle_caches).
+    """
+
+    def __init__(self, name, func, ttl, db_lifecycle=False):
+        """
+            :param str name: name of cache (used for logging and stats)
+            :param callable func: function without args to compute value
+            :param float ttl: time in seconds to keep computed value
+            :param bool db_lifecycle: if set, then cache will be
+                invalidated by invalidate_db_lifecycle_caches
+        """
+        self.name = name
+        self.ttl = ttl
+        self._func = func
+        self._db_lifecycle = db_lifecycle
+        self._lock = threading.Lock()
+        # Tuple (value, expire, stamp) or None if value is not computed
+        # yet or was invalidated. Value and expiration time are always
+        # replaced together, so readers without lock get consistent
+        # snapshot. Stamp is stamp of databases change (see
+        # get_db_lifecycle_stamp) read before value was computed.
+        self._state = None
+        self.hits = 0
+        self.misses = 0
+        register_cache(self)
+        if db_lifecycle:
+            _db_lifecycle_caches.append(self)
+
+    def _get_stamp(self):
+        if not self._db_lifecycle:
+            return None
+        return get_db_lifecycle_stamp()
+
+    def get(self):
+        stamp = self._get_stamp()
+        state = self._state
+        if state is not None and state[2] != stamp:
+            # Databases were changed by other worker
+            state = None
+        if state is not None:
+            value, expire, __ = state
+            if expire > time.monotonic():
+                self.hits += 1
+                return value
+
+            # Value expired, but was not invalidated. If other thread is
+            # already computing new value, then return stale value instead
+            # of waiting, to avoid thundering herd on expiration.
+            if not self._lock.acquire(blocking=False):
+                self.hits += 1
+                return value
+        else:
+            self._lock.acquire()
+
+        try:
+            # Value could be computed by other thread while we waited for
+            # lock, so check it again
+            state = self._state
+            if (state is not None and state[1] > time.monotonic() and
+                    state[2] == stamp):
+                self.hits += 1
+                return state[0]
+            self.misses += 1
+            value = self._func()
+            self._state = (value, time.monotonic() + self.ttl, stamp)
+            return value
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        with self._lock:
+            self._state = None
+
+
+def invalidate_db_lifecycle_caches():
+    """ Invalidate all caches that depend on list of databases.
+        Have to be called after database created, dropped, renamed, etc.
+
+        Stamp file in data dir is replaced too, so other workers
+        invalidate their caches on next access.
+    """
+    for cache in _db_lifecycle_caches:
+        _logger.debug("Invalidating cache %s", cache.name)
+        cache.invalidate()
+    _update_db_lifecycle_stamp()
@@ -0,0 +1,31 @@
+import logging
+
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+
+def config_get_int(name, default):
+    """ Read integer option from odoo config file.
+        Return default if option is not set or is not valid integer
+    """
+    try:
+        return int(config.get(name, default))
+    except (TypeError, ValueError):
+        _logger.warning(
+            "Config option %s has wrong value, using default %r",
+            name, default)
+        return default
+
+
+def config_get_float(name, default):
+    """ Read float option from odoo config file.
+        Return default if option is not set or is not valid number
+    """
+    try:
+        return float(config.get(name, default))
+    except (TypeError, ValueError):
+        _logger.warning(
+            "Config option %s has wrong value, using default %r",
+            name, default)
+        return default
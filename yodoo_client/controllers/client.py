@@ -2,7 +2,6 @@ import json
 import uuid
 import base64
 import logging
-import hashlib
 from datetime import datetime, timedelta
 
 import werkzeug.exceptions
@@ -16,8 +15,8 @@ from ..utils import (
     DEFAULT_LEN_TOKEN,
     DEFAULT_ADMIN_SESSION_TTL,
     SAAS_CLIENT_API_VERSION,
-    SAAS_TOKEN_FIELD,
     check_saas_client_token,
+    get_saas_token_verifier,
     get_yodoo_client_version,
     generate_random_password,
 )
@@ -72,8 +71,7 @@ class SAASClient(http.Controller):
                 "but this operation is disabled in Odoo config")
             raise werkzeug.exceptions.Forbidden(description='Feature disabled')
 
-        token = config.get(SAAS_TOKEN_FIELD, False)
-        token_hash = hashlib.sha256(token.encode('utf8')).hexdigest()
+        token_hash = get_saas_token_verifier().primary_digest
 
         random_token = generate_random_password(DEFAULT_LEN_TOKEN)
         uri_token = '%s:%s:%s' % (db, random_token, token_hash)
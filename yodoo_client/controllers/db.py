@@ -1,32 +1,51 @@
 import datetime
 import os
+import base64
 import re
 import json
+import uuid
+import shutil
 import logging
 import tempfile
-from contextlib import closing
 
 import werkzeug
 
-import odoo
 from odoo import http, api, registry, exceptions, SUPERUSER_ID
-from odoo.sql_db import db_connect
 from odoo.http import Response
 from odoo.service import db as service_db
-from odoo.modules import db as modules_db
 from odoo.tools.misc import str2bool
 
 from ..utils import (
     prepare_db_statistic_data,
+    iter_db_statistic_data,
     str_filter_falsy,
-    get_yodoo_client_version,
     generate_random_password,
-    retry_iter,
 )
+from ..backup import (
+    BACKUP_CHUNK_SIZE,
+    stream_dump_db,
+    restore_db,
+    restore_db_stream,
+    get_backup_filename,
+    parse_known_hashes,
+)
+from ..backup_artifact import get_backup_artifact_store
+from ..jobs import get_job_runner, get_job_operation
+from ..db_management import (
+    restore_and_postprocess_db,
+    get_db_reconcile_info,
+    get_job_file_path,
+    is_template_demo,
+    get_db_pool,
+    drop_db,
+)
+from ..db_readiness import get_db_not_ready_reason
 from ..http_decorators import (
+    reject_token_in_query,
     require_saas_token,
     require_db_param,
     wrap_str_falsy_values,
+    invalidate_db_caches,
 )
 
 _logger = logging.getLogger(__name__)
@@ -61,6 +80,21 @@ class SAASClientDb(http.Controller):
         databases = service_db.list_dbs(force=True)
         return Response(json.dumps(databases), status=200)
 
+    def _run_operation(self, run_async, operation, params, secrets=None):
+        """ Run database management operation.
+
+            If run_async is set, then operation is queued as job, and
+            response with ID of job is returned at once. State of job
+            could be checked via /saas/client/job/<job_id>.
+            Otherwise operation is executed in this request.
+        """
+        if str2bool(run_async, False):
+            job_id = get_job_runner().enqueue(
+                operation, params, secrets=secrets)
+            return Response(json.dumps({'job_id': job_id}), status=202)
+        get_job_operation(operation)(None, **dict(params, **(secrets or {})))
+        return Response('OK', status=200)
+
     @http.route(
         '/saas/client/db/create',
         type='http',
@@ -69,33 +103,55 @@ class SAASClientDb(http.Controller):
         csrf=False
     )
     @require_saas_token
+    @invalidate_db_caches
     def client_db_create(self, dbname=None, demo=False, lang='en_US',
                          user_password='admin', user_login='admin',
                          country_code=None, phone=None,
-                         template_dbname=None, **params):
+                         template_dbname=None, pool_profile=None,
+                         run_async=False, **params):
         demo = str2bool(demo, False)
         if not dbname:
             raise werkzeug.exceptions.BadRequest(
                 description='Missing parameter: dbname')
-        _logger.info("Create database: %s (demo=%r)", dbname, demo)
-        try:
-            service_db._create_empty_database(dbname)
-        except service_db.DatabaseExists as bd_ex:
+        if service_db.exp_db_exist(dbname):
             raise werkzeug.exceptions.Conflict(
-                description=str(bd_ex))
-
-        service_db._initialize_db(
-            id, dbname, demo, lang, user_password, user_login,
-            country_code=str_filter_falsy(country_code),
-            phone=str_filter_falsy(phone),
-        )
-        db = db_connect(dbname)
-        with closing(db.cursor()) as cr:
-            db_init = modules_db.is_initialized(cr)
-        if not db_init:
-            raise werkzeug.exceptions.InternalServerError(
-                description='Database not initialized.')
-        return Response('OK', status=200)
+                description="Database %s already exists" % dbname)
+        template_dbname = str_filter_falsy(template_dbname)
+        if template_dbname:
+            if not service_db.exp_db_exist(template_dbname):
+                raise werkzeug.exceptions.BadRequest(
+                    description="Template database %s does not exist" % (
+                        template_dbname))
+            if is_template_demo(template_dbname) != demo:
+                raise werkzeug.exceptions.BadRequest(
+                    description="Template database %s %s demo data" % (
+                        template_dbname,
+                        'does not contain' if demo else 'contains'))
+        return self._run_operation(run_async, 'create', {
+            'dbname': dbname,
+            'demo': demo,
+            'lang': lang,
+            'user_login': user_login,
+            'country_code': str_filter_falsy(country_code),
+            'phone': str_filter_falsy(phone),
+            'template_dbname': template_dbname,
+            'pool_profile': str_filter_falsy(pool_profile),
+        }, secrets={'user_password': user_password})
+
+    @http.route(
+        '/saas/client/db/pool/stat',
+        type='http',
+        auth='none',
+        metods=['POST'],
+        csrf=False
+    )
+    @require_saas_token
+    def client_db_pool_statistic(self, **params):
+        """ Return depth and hit rate of pool of prepared databases
+            per profile (see 'yodoo_db_pool' option).
+        """
+        return Response(
+            json.dumps(get_db_pool().get_statistic()), status=200)
 
     @http.route(
         '/saas/client/db/duplicate',
@@ -106,17 +162,19 @@ class SAASClientDb(http.Controller):
     )
     @require_saas_token
     @require_db_param
-    def client_db_duplicate(self, db=None, new_dbname=None, **params):
+    @invalidate_db_caches
+    def client_db_duplicate(self, db=None, new_dbname=None, run_async=False,
+                            **params):
         if not new_dbname:
             raise werkzeug.exceptions.BadRequest(
                 "New database name not specified")
         if service_db.exp_db_exist(new_dbname):
             raise werkzeug.exceptions.Conflict(
                 description="Database %s already exists" % new_dbname)
-
-        _logger.info("Duplicate database: %s -> %s", db, new_dbname)
-        service_db.exp_duplicate_database(db, new_dbname)
-        return Response('OK', status=200)
+        return self._run_operation(run_async, 'duplicate', {
+            'db': db,
+            'new_dbname': new_dbname,
+        })
 
     @http.route(
         '/saas/client/db/rename',
@@ -127,37 +185,19 @@ class SAASClientDb(http.Controller):
     )
     @require_saas_token
     @require_db_param
-    def client_db_rename(self, db=None, new_dbname=None, **params):
+    @invalidate_db_caches
+    def client_db_rename(self, db=None, new_dbname=None, run_async=False,
+                         **params):
         if not new_dbname:
             raise werkzeug.exceptions.BadRequest(
                 "New database name not specified")
         if service_db.exp_db_exist(new_dbname):
             raise werkzeug.exceptions.Conflict(
                 description="Database %s already exists" % new_dbname)
-
-        _logger.info("Renaming database '%s' to '%s'...", db, new_dbname)
-        try:
-            service_db.exp_rename(db, new_dbname)
-        except Exception as e:
-            _logger.error("Rename database '%s' to '%s' failed:\n%s",
-                          db, new_dbname, e)
-            raise werkzeug.exceptions.InternalServerError(
-                description="Cannot rename database (%s -> %s):\n%s" % (
-                    db, new_dbname, e))
-
-        # Sometime, database is not available just after renaming,
-        # thus we have to wait while it will be available.
-        # Especially, this case sometimes happens with large databases (60+ GB)
-        for __ in retry_iter(interval_timeout=0.5,
-                             max_retries=10,
-                             first_timeout=False):
-            if service_db.exp_db_exist(new_dbname):
-                return Response('OK', status=200)
-
-        # If database still not available - raise error
-        raise werkzeug.exceptions.InternalServerError(
-            description="Cannot rename database (%s -> %s):\nTimed out" % (
-                db, new_dbname))
+        return self._run_operation(run_async, 'rename', {
+            'db': db,
+            'new_dbname': new_dbname,
+        })
 
     @http.route(
         '/saas/client/db/drop',
@@ -168,8 +208,10 @@ class SAASClientDb(http.Controller):
     )
     @require_saas_token
     @require_db_param
+    @invalidate_db_caches
     def client_db_drop(self, db=None, **params):
-        if not service_db.exp_drop(db):
+        # Filestore is removed in background (see move_filestore_to_trash)
+        if not drop_db(db):
             raise werkzeug.exceptions.Forbidden(
                 description="It is not allowed to drop database %s" % db)
         return Response('OK', status=200)
@@ -182,15 +224,78 @@ class SAASClientDb(http.Controller):
         csrf=False)
     @require_saas_token
     @require_db_param
-    def client_db_backup(self, db=None, backup_format='zip', **params):
-        filename = "%s.%s" % (db, backup_format)
+    def client_db_backup(self, db=None, backup_format='zip', stream=False,
+                         compression=None, known_hashes=None, artifact=False,
+                         run_async=False, **params):
+        # If known_hashes passed (as text or as uploaded file), then delta
+        # backup will be made: attachments with these hashes will not be
+        # included in backup.
+        try:
+            filename = get_backup_filename(db, backup_format, compression)
+            if known_hashes is not None:
+                known_hashes = parse_known_hashes(known_hashes)
+        except ValueError as e:
+            raise werkzeug.exceptions.BadRequest(description=str(e))
+        if str2bool(run_async, False):
+            # Backup is made as artifact by job, and result of job
+            # contains same info as response in 'artifact' mode
+            return self._run_operation(run_async, 'backup', {
+                'db': db,
+                'backup_format': backup_format,
+                'compression': compression,
+                'known_hashes': (
+                    None if known_hashes is None else sorted(known_hashes)),
+            })
         headers = [
             ('Content-Type', 'application/octet-stream; charset=binary'),
             ('Content-Disposition', http.content_disposition(filename)),
         ]
+        if str2bool(stream, False):
+            # Send backup while it is being generated, without staging it
+            # on disk. Errors after response started could not be reported
+            # via status code, so in this case client receives truncated
+            # (invalid) archive.
+            try:
+                chunks = stream_dump_db(
+                    db, backup_format, compression, known_hashes)
+            except exceptions.AccessDenied as e:
+                raise werkzeug.exceptions.Forbidden(
+                    description=str(e))
+            return werkzeug.wrappers.Response(
+                chunks,
+                headers=headers,
+                direct_passthrough=True)
+
+        if not str2bool(artifact, False):
+            # Backup is staged in temporary file, that is removed when
+            # response is sent, so backups do not occupy disk space
+            backup_data = tempfile.TemporaryFile()
+            try:
+                for chunk in stream_dump_db(
+                        db, backup_format, compression, known_hashes):
+                    backup_data.write(chunk)
+            except exceptions.AccessDenied as e:
+                backup_data.close()
+                raise werkzeug.exceptions.Forbidden(
+                    description=str(e))
+            except Exception as e:
+                backup_data.close()
+                _logger.error("Cannot backup db %s", db, exc_info=True)
+                raise werkzeug.exceptions.InternalServerError(
+                    description=str(e))
+            backup_data.seek(0)
+            return werkzeug.wrappers.Response(
+                backup_data,
+                headers=headers,
+                direct_passthrough=True)
+
+        # Backup is saved as artifact, that is reused for next requests
+        # if database is not changed. Only info about artifact returned,
+        # and it could be downloaded (and resumed) via
+        # /saas/client/db/backup/download during retention period
         try:
-            stream = tempfile.TemporaryFile()
-            service_db.dump_db(db, stream, backup_format)
+            meta, reused = get_backup_artifact_store().get_or_create(
+                db, backup_format, compression, known_hashes)
         except exceptions.AccessDenied as e:
             raise werkzeug.exceptions.Forbidden(
                 description=str(e))
@@ -198,91 +303,92 @@ class SAASClientDb(http.Controller):
             _logger.error("Cannot backup db %s", db, exc_info=True)
             raise werkzeug.exceptions.InternalServerError(
                 description=str(e))
-        else:
-            stream.seek(0)
-            response = werkzeug.wrappers.Response(
-                stream,
-                headers=headers,
-                direct_passthrough=True)
-            return response
+        return Response(json.dumps({
+            'artifact_id': meta['id'],
+            'filename': meta['filename'],
+            'size': meta['size'],
+            'sha256': meta['sha256'],
+            'created': meta['created'],
+            'expires': meta['expires'],
+            'reused': reused,
+        }), status=200)
+
+    def _backup_artifact_response(self, meta):
+        """ Prepare response with content of backup artifact.
+            Supports Range requests.
+        """
+        store = get_backup_artifact_store()
+        httprequest = http.request.httprequest
+        response = werkzeug.wrappers.Response(
+            werkzeug.wsgi.wrap_file(httprequest.environ, store.open(meta)),
+            headers=[
+                ('Content-Type', 'application/octet-stream; charset=binary'),
+                ('Content-Disposition',
+                 http.content_disposition(meta['filename'])),
+                ('Digest', 'SHA-256=%s' % base64.b64encode(
+                    bytes.fromhex(meta['sha256'])).decode('ascii')),
+            ],
+            direct_passthrough=True)
+        response.content_length = meta['size']
+        response.set_etag(meta['sha256'])
+        # Werkzeug handles Range and conditional headers only for GET and
+        # HEAD requests, but backup could be downloaded via POST too
+        environ = httprequest.environ
+        if environ['REQUEST_METHOD'] == 'POST':
+            environ = dict(environ, REQUEST_METHOD='GET')
+        return response.make_conditional(
+            environ, accept_ranges=True, complete_length=meta['size'])
 
-    def _postprocess_restored_db(self, dbname):
-        """ Do some postprocessing after DB restored from backup
+    @http.route(
+        '/saas/client/db/backup/download',
+        type='http',
+        auth="none",
+        methods=['GET', 'HEAD', 'POST'],
+        csrf=False)
+    @reject_token_in_query
+    @require_saas_token
+    def client_db_backup_download(self, artifact_id=None, **params):
+        """ Download backup artifact created by /saas/client/db/backup
+            with 'artifact' option. Supports Range requests, so download
+            could be resumed, or done in multiple parallel parts.
 
-            The reason for this method, is to ensure that yodoo_client
-            is installed on database and if needed updated.
-            Also, we check installed addons and compare them with
-            thats are available on disk, and if needed run update for them.
+            Token have to be passed in X-YODOO-TOKEN header (GET, HEAD)
+            or in body of POST request, but not in query string.
         """
-        to_update_modules = set()
-        to_install_modules = set()
-        modules_in_db = {}
-        modules_on_disk = {
-            mod: odoo.modules.module.load_information_from_description_file(
-                mod)
-            for mod in odoo.modules.module.get_modules()
-        }
-        auto_install_addons = odoo.tools.config.get(
-            'yodoo_auto_install_addons', '')
-        auto_install_addons = [
-            a.strip() for a in auto_install_addons.split(',') if a.strip()]
-
-        with closing(db_connect(dbname).cursor()) as cr:
-            cr.execute("""
-                SELECT name, latest_version
-                FROM ir_module_module
-                WHERE state = 'installed';
-            """)
-            modules_in_db = dict(cr.fetchall())
-
-        if 'yodoo_client' not in modules_in_db:
-            _logger.info(
-                "yodoo_client not installed, adding to install list")
-            to_install_modules.add('yodoo_client')
-        elif modules_in_db['yodoo_client'] != get_yodoo_client_version():
-            _logger.info(
-                "yodoo_client not up to date (%s != %s), "
-                "adding to update list",
-                modules_in_db['yodoo_client'], get_yodoo_client_version())
-            to_update_modules.add('yodoo_client')
-
-        for module_name in auto_install_addons:
-            if module_name not in modules_on_disk:
-                continue
-            if module_name not in modules_in_db:
-                _logger.info(
-                    "Module %s is mentioned in auto_install_addons list, "
-                    "but is not installed in database. Installing.",
-                    module_name
-                )
-                to_install_modules.add(module_name)
-
-        for module_name, db_version in modules_in_db.items():
-            if module_name not in modules_on_disk:
-                continue
-            if db_version != modules_on_disk[module_name]['version']:
-                _logger.info(
-                    "Module %s is not up to data, adding to update list.",
-                    module_name)
-                to_update_modules.add(module_name)
-
-        if to_install_modules or to_update_modules:
-            _logger.info(
-                "There are addons to install %s and to update %s found.",
-                tuple(to_install_modules), tuple(to_update_modules))
-            with registry(dbname).cursor() as cr:
-                env = api.Environment(cr, SUPERUSER_ID, context={})
-                env['ir.module.module'].update_list()
-                if to_install_modules:
-                    env['ir.module.module'].search(
-                        [('name', 'in', list(to_install_modules)),
-                         ('state', 'in', ('uninstalled', 'to_install'))]
-                    ).button_immediate_install()
-                if to_update_modules:
-                    env['ir.module.module'].search(
-                        [('name', 'in', list(to_update_modules)),
-                         ('state', 'in', ('uninstalled', 'to_install'))]
-                    ).button_immediate_upgrade()
+        meta = get_backup_artifact_store().get(artifact_id)
+        if not meta:
+            raise werkzeug.exceptions.NotFound(
+                description="Backup artifact %s not found" % artifact_id)
+        return self._backup_artifact_response(meta)
+
+    def _client_db_restore_async(self, db, backup_file, copy, swap,
+                                 postprocess_async):
+        """ Save uploaded backup (as file or raw request body) to job
+            files directory, and queue job to restore it
+        """
+        httprequest = http.request.httprequest
+        if (backup_file is None and
+                httprequest.mimetype != 'application/octet-stream'):
+            raise werkzeug.exceptions.BadRequest("Backup file not specified")
+        backup_path = get_job_file_path('%s.backup' % uuid.uuid4().hex)
+        try:
+            if backup_file is not None:
+                backup_file.save(backup_path)
+            else:
+                with open(backup_path, 'wb') as f:
+                    shutil.copyfileobj(
+                        httprequest.stream, f, BACKUP_CHUNK_SIZE)
+            return self._run_operation(True, 'restore', {
+                'db': db,
+                'backup_path': backup_path,
+                'copy': copy,
+                'swap': swap,
+                'postprocess_async': postprocess_async,
+            })
+        except Exception:
+            if os.path.exists(backup_path):
+                os.unlink(backup_path)
+            raise
 
     @http.route(
         '/saas/client/db/restore',
@@ -291,17 +397,67 @@ class SAASClientDb(http.Controller):
         methods=['POST'],
         csrf=False)
     @require_saas_token
+    @invalidate_db_caches
     def client_db_restore(self, db=None, backup_file=None,
-                          copy=False, **params):
+                          copy=False, run_async=False, swap=False,
+                          postprocess_async=False, **params):
+        """ Restore database from backup
+
+            If 'swap' is set and database already exists, then backup is
+            restored to hidden staging database, that replaces existing
+            database when restore completed. Existing database is
+            available while backup is being restored.
+
+            If 'postprocess_async' is set, then installation and update
+            of addons after restore is run in background, and response
+            is returned as soon as data is restored. Response contains
+            ID of reconciliation job. Logins to database are not allowed
+            until reconciliation completed.
+        """
+        swap = str2bool(swap, False)
+        copy = str2bool(copy, False)
+        postprocess_async = str2bool(postprocess_async, False)
         if not db:
             raise werkzeug.exceptions.BadRequest("Database not specified")
-        if service_db.exp_db_exist(db):
+        if not swap and service_db.exp_db_exist(db):
             raise werkzeug.exceptions.Conflict(
                 description="Database %s already exists" % db)
+
+        httprequest = http.request.httprequest
+        if str2bool(run_async, False):
+            return self._client_db_restore_async(
+                db, backup_file, copy, swap, postprocess_async)
+
+        # If backup is sent as body of request (with content type
+        # 'application/octet-stream' and other params in query string),
+        # then it is restored while it is being received, without
+        # saving it to temporary file.
+        if (backup_file is None and
+                httprequest.mimetype == 'application/octet-stream'):
+            try:
+                reconcile_job_id = restore_and_postprocess_db(
+                    None, db,
+                    lambda target_db: restore_db_stream(
+                        target_db, httprequest.stream, copy),
+                    swap=swap, postprocess_async=postprocess_async)
+            except exceptions.AccessDenied as e:
+                raise werkzeug.exceptions.Forbidden(
+                    description=str(e))
+            except Exception as e:
+                _logger.error("Cannot restore db %s", db, exc_info=True)
+                raise werkzeug.exceptions.InternalServerError(
+                    "Cannot restore db (%s): %s" % (db, str(e)))
+            return self._restore_response(reconcile_job_id)
+
+        if backup_file is None:
+            raise werkzeug.exceptions.BadRequest("Backup file not specified")
         try:
             with tempfile.NamedTemporaryFile(delete=False) as data_file:
                 backup_file.save(data_file)
-            service_db.restore_db(db, data_file.name, str2bool(copy))
+            reconcile_job_id = restore_and_postprocess_db(
+                None, db,
+                lambda target_db: restore_db(target_db, data_file.name, copy),
+                swap=swap, postprocess_async=postprocess_async)
         except exceptions.AccessDenied as e:
             raise werkzeug.exceptions.Forbidden(
                 description=str(e))
@@ -310,11 +466,78 @@ class SAASClientDb(http.Controller):
             raise werkzeug.exceptions.InternalServerError(
                 "Cannot restore db (%s): %s" % (db, str(e)))
         else:
-            self._postprocess_restored_db(db)
-            return http.Response('OK', status=200)
+            return self._restore_response(reconcile_job_id)
         finally:
             os.unlink(data_file.name)
 
+    def _restore_response(self, reconcile_job_id):
+        if reconcile_job_id:
+            return Response(
+                json.dumps({'reconcile_job_id': reconcile_job_id}),
+                status=200)
+        return http.Response('OK', status=200)
+
+    @http.route(
+        '/saas/client/db/reconcile/status',
+        type='http',
+        auth='none',
+        metods=['POST'],
+        csrf=False
+    )
+    @require_saas_token
+    @require_db_param
+    def client_db_reconcile_status(self, db=None, **params):
+        """ Return status of reconciliation of addons of database after
+            restore (see 'postprocess_async' option of restore)
+
+            :return: json object with keys:
+                - db: name of database
+                - ready: False if database is being restored, or its
+                  reconciliation is not completed yet or failed, and
+                  logins to database are not allowed
+                - reason: why database is not ready ('restore' or
+                  'reconcile_failed') or null
+                - job: info about last reconciliation job of database
+                  (see /saas/client/job/<job_id>) or null
+        """
+        reason = get_db_not_ready_reason(db)
+        return Response(json.dumps({
+            'db': db,
+            'ready': reason is None,
+            'reason': reason,
+            'job': get_db_reconcile_info(db),
+        }), status=200)
+
+    @http.route(
+        '/saas/client/job/<string:job_id>',
+        type='http',
+        auth='none',
+        metods=['POST'],
+        csrf=False
+    )
+    @require_saas_token
+    def client_job_info(self, job_id=None, **params):
+        """ Return info about job, started by database management API
+            with 'run_async' option.
+
+            :return: json object with keys:
+                - id
+                - operation
+                - state: one of 'queued', 'running', 'done', 'failed'
+                - node: name of node, that executes job
+                - progress: progress of job (from 0 to 1) or null
+                - message: description of current step of job
+                - result: result of job (when job is done)
+                - error: error message (when job is failed)
+                - created_at, started_at, finished_at: UTC time in
+                  ISO format
+        """
+        info = get_job_runner().get_job_info(job_id)
+        if not info:
+            raise werkzeug.exceptions.NotFound(
+                description="Job %s not found" % job_id)
+        return Response(json.dumps(info), status=200)
+
     @http.route(
         '/saas/client/db/configure/db',
         type='http',
@@ -581,6 +804,40 @@ class SAASClientDb(http.Controller):
         data = prepare_db_statistic_data(db)
         return Response(json.dumps(data), status=200)
 
+    @http.route(
+        '/saas/client/db/stat/bulk',
+        type='http',
+        auth='none',
+        metods=['POST'],
+        csrf=False
+    )
+    @require_saas_token
+    def client_db_statistic_bulk(self, dbs=None, **params):
+        """ Return statistic for multiple databases as NDJSON stream
+
+            :param str dbs: coma-separated list of database names.
+                            If not set, then statistic for all databases
+                            will be returned
+            :return: stream of json objects (one per line), each contains
+                     same data as /saas/client/db/stat with additional
+                     key 'db'. In case of error, object contains only
+                     keys 'db' and 'error'.
+        """
+        if dbs:
+            dbs = [d.strip() for d in dbs.split(',') if d.strip()]
+        else:
+            dbs = service_db.list_dbs(force=True)
+
+        def generate():
+            for data in iter_db_statistic_data(dbs):
+                yield json.dumps(data) + '\n'
+
+        return werkzeug.wrappers.Response(
+            generate(),
+            status=200,
+            mimetype='application/x-ndjson',
+            direct_passthrough=True)
+
     @http.route(
         '/saas/client/db/expiry',
         type='http',
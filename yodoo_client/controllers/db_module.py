@@ -5,11 +5,13 @@ from contextlib import closing
 from odoo import http, registry, SUPERUSER_ID, sql_db
 from odoo.http import Response
 from odoo.api import Environment
+from odoo.service import db as service_db
 
 from ..http_decorators import (
     require_saas_token,
     require_db_param,
 )
+from ..db_management import get_modules_diff_report
 
 
 _logger = logging.getLogger(__name__)
@@ -57,6 +59,38 @@ class SAASClientDbModule(http.Controller):
             data = cr.dictfetchall()
         return Response(json.dumps(data), status=200)
 
+    @http.route(
+        '/saas/client/db/module/diff',
+        type='http',
+        auth='none',
+        metods=['POST'],
+        csrf=False
+    )
+    @require_saas_token
+    def get_client_db_module_diff(self, dbs=None, **params):
+        """ Return addons to install, to update and missing on disk
+            for multiple databases
+
+            :param str dbs: coma-separated list of database names.
+                            If not set, then all databases are checked
+            :return: dict {
+                'dbs': [db_name, ...],
+                'modules': {module_name: {
+                    'version': version on disk,
+                    'to_install': [index of db in 'dbs', ...],
+                    'to_update': [index of db in 'dbs', ...],
+                    'missing': [index of db in 'dbs', ...],
+                }},
+                'errors': {db_name: error_message},
+            }
+        """
+        if dbs:
+            dbs = [d.strip() for d in dbs.split(',') if d.strip()]
+        else:
+            dbs = service_db.list_dbs(force=True)
+        data = get_modules_diff_report(dbs)
+        return Response(json.dumps(data), status=200)
+
     @http.route(
         '/saas/client/db/module/install',
         type='http',
@@ -1,13 +1,20 @@
 import json
 import logging
 
+import werkzeug.exceptions
+
 from odoo import http
 from odoo.http import Response
 from ..utils import (
-    prepare_saas_module_info_data,
     prepare_server_fast_statistic_data,
     prepare_server_slow_statistic_data,
-    ModuleManifestEncoder,
+)
+from ..module_index import get_addons_manifest_index
+from ..filestore import get_filestore_sizes, get_filestore_trash_reaper
+from ..cache import get_caches_statistic
+from ..stat_sampler import (
+    get_server_stat_sampler,
+    prepare_server_stat_history_data,
 )
 from ..http_decorators import (
     require_saas_token,
@@ -28,9 +35,17 @@ class SAASClientInstance(http.Controller):
     )
     @require_saas_token
     def get_client_module_info(self, **params):
-        data = prepare_saas_module_info_data()
-        return Response(
-            json.dumps(data, cls=ModuleManifestEncoder), status=200)
+        """ Return manifests of all addons available on server.
+
+            Response contains strong ETag, thus if client sends
+            If-None-Match header with same ETag, and addons on disk
+            were not changed, then 304 Not Modified will be returned.
+        """
+        index = get_addons_manifest_index()
+        headers = [('ETag', '"%s"' % index.etag)]
+        if http.request.httprequest.if_none_match.contains(index.etag):
+            return Response(status=304, headers=headers)
+        return Response(index.body, status=200, headers=headers)
 
     @http.route(
         ['/saas/client/server/fast/stat', '/saas/client/server/stat/fast'],
@@ -41,6 +56,9 @@ class SAASClientInstance(http.Controller):
     )
     @require_saas_token
     def get_server_fast_statistic(self, **params):
+        # Ensure background sampler is started, so next time history of
+        # samples will be available for this worker
+        get_server_stat_sampler()
         data = prepare_server_fast_statistic_data()
         return Response(json.dumps(data), status=200)
 
@@ -55,3 +73,86 @@ class SAASClientInstance(http.Controller):
     def get_server_slow_statistic(self, **params):
         data = prepare_server_slow_statistic_data()
         return Response(json.dumps(data), status=200)
+
+    @http.route(
+        '/saas/client/server/stat/history',
+        type='http',
+        auth='none',
+        metods=['POST'],
+        csrf=False
+    )
+    @require_saas_token
+    def get_server_statistic_history(self, since=None, **params):
+        """ Return fast statistic samples collected in background
+
+            :param since: unix timestamp. if set, then only samples
+                          collected after this time will be returned
+            :return: dict {
+                'interval': sample interval in seconds,
+                'capacity': max number of samples kept,
+                'fields': list of field names,
+                'samples': list of rows (values ordered as fields),
+            }
+        """
+        if since:
+            try:
+                since = float(since)
+            except ValueError:
+                raise werkzeug.exceptions.BadRequest(
+                    description='Wrong value for since: %s' % since)
+        else:
+            since = None
+        data = prepare_server_stat_history_data(since)
+        return Response(json.dumps(data), status=200)
+
+    @http.route(
+        '/saas/client/server/stat/filestore',
+        type='http',
+        auth='none',
+        metods=['POST'],
+        csrf=False
+    )
+    @require_saas_token
+    def get_server_filestore_statistic(self, dbs=None, **params):
+        """ Return sizes of filestores of databases on this server
+
+            :param str dbs: coma-separated list of database names.
+                            If not set, all filestores will be scanned.
+            :return: dict {db_name: filestore_size}
+        """
+        if dbs:
+            dbs = [d.strip() for d in dbs.split(',') if d.strip()]
+        else:
+            dbs = None
+        data = get_filestore_sizes(dbs)
+        return Response(json.dumps(data), status=200)
+
+    @http.route(
+        '/saas/client/server/stat/cache',
+        type='http',
+        auth='none',
+        metods=['POST'],
+        csrf=False
+    )
+    @require_saas_token
+    def get_server_cache_statistic(self, **params):
+        """ Return hits / misses statistic of caches of worker
+            that processed this request.
+        """
+        data = get_caches_statistic()
+        return Response(json.dumps(data), status=200)
+
+    @http.route(
+        '/saas/client/server/stat/trash',
+        type='http',
+        auth='none',
+        metods=['POST'],
+        csrf=False
+    )
+    @require_saas_token
+    def get_server_trash_statistic(self, **params):
+        """ Return backlog of filestores of dropped databases, that are
+            waiting for removal in background.
+        """
+        data = get_filestore_trash_reaper().get_statistic()
+        return Response(json.dumps(data), status=200)
@@ -0,0 +1,819 @@
+import os
+import uuid
+import logging
+import threading
+from contextlib import closing
+
+import werkzeug
+from pytz import country_timezones
+
+import odoo
+from odoo import api, registry, SUPERUSER_ID
+from odoo.sql_db import db_connect
+from odoo.service import db as service_db
+from odoo.modules import db as modules_db
+
+from .config import config_get_float, config_get_int
+from .utils import (
+    generate_random_password,
+    get_yodoo_data_dir,
+    iter_concurrent,
+    retry_iter,
+    DEFAULT_DB_STAT_BULK_CONNECTIONS,
+)
+from .backup import restore_db
+from .backup_artifact import get_backup_artifact_store
+from .cache import invalidate_db_lifecycle_caches
+from .filestore import clone_filestore, move_filestore_to_trash
+from .module_index import get_addons_manifest_index
+from .jobs import (
+    register_job_operation,
+    report_progress,
+    get_job_runner,
+)
+from .db_readiness import mark_db_not_ready, mark_db_ready
+from .db_pool import (
+    DatabasePool,
+    parse_db_pool_profiles,
+    DEFAULT_DB_POOL_INTERVAL,
+    DEFAULT_DB_POOL_MIN_FREE_SPACE,
+)
+
+# Directory in yodoo data dir, where uploaded backups are kept until
+# they are restored by job
+JOB_FILES_DIR = 'jobs'
+
+# Namespace for advisory locks used to serialize creation of databases
+# from same template (PostgreSQL does not allow to use database as
+# template while there are other connections to it)
+TEMPLATE_ADVISORY_LOCK_NAMESPACE = 0x59D1
+
+# Namespace for advisory locks used to serialize swaps of database
+SWAP_ADVISORY_LOCK_NAMESPACE = 0x59D3
+
+_logger = logging.getLogger(__name__)
+
+
+def get_job_file_path(name):
+    """ Return path for file, that have to be passed to job
+        (for example uploaded backup to restore)
+    """
+    path = os.path.join(get_yodoo_data_dir(), JOB_FILES_DIR)
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, name)
+
+
+def get_auto_install_addons():
+    """ Return list of addons from 'yodoo_auto_install_addons' option,
+        that have to be installed in all databases
+    """
+    auto_install_addons = odoo.tools.config.get(
+        'yodoo_auto_install_addons', '')
+    return [
+        a.strip() for a in auto_install_addons.split(',') if a.strip()]
+
+
+def get_installed_modules(dbname):
+    """ Return versions of modules installed in database
+
+        :return: dict {module_name: latest_version}
+    """
+    with closing(db_connect(dbname).cursor()) as cr:
+        cr.execute("""
+            SELECT name, latest_version
+            FROM ir_module_module
+            WHERE state = 'installed';
+        """)
+        return dict(cr.fetchall())
+
+
+def compute_modules_diff(modules_in_db, manifests, auto_install_addons):
+    """ Compare modules installed in database with addons on disk
+
+        :param dict modules_in_db: {module_name: latest_version}
+        :param dict manifests: {module_name: manifest} of addons on disk
+        :param list auto_install_addons: addons, that have to be installed
+        :return: tuple(to_install, to_update, missing) of sets of module
+                 names. 'missing' contains modules, that are installed in
+                 database, but not available on disk.
+    """
+    to_install = set()
+    to_update = set()
+    missing = set()
+
+    # yodoo_client have to be installed in all databases
+    for module_name in ['yodoo_client'] + list(auto_install_addons):
+        if module_name in manifests and module_name not in modules_in_db:
+            to_install.add(module_name)
+
+    for module_name, db_version in modules_in_db.items():
+        if module_name not in manifests:
+            missing.add(module_name)
+        elif db_version != manifests[module_name]['version']:
+            to_update.add(module_name)
+    return to_install, to_update, missing
+
+
+def postprocess_restored_db(dbname):
+    """ Do some postprocessing after DB restored from backup
+
+        The reason for this method, is to ensure that yodoo_client
+        is installed on database and if needed updated.
+        Also, we check installed addons and compare them with
+        thats are available on disk, and if needed run update for them.
+    """
+    to_install_modules, to_update_modules, __ = compute_modules_diff(
+        get_installed_modules(dbname),
+        get_addons_manifest_index().manifests,
+        get_auto_install_addons())
+
+    if to_install_modules or to_update_modules:
+        _logger.info(
+            "There are addons to install %s and to update %s found.",
+            tuple(to_install_modules), tuple(to_update_modules))
+        with registry(dbname).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, context={})
+            env['ir.module.module'].update_list()
+            if to_install_modules:
+                env['ir.module.module'].search(
+                    [('name', 'in', list(to_install_modules)),
+                     ('state', 'in', ('uninstalled', 'to_install'))]
+                ).button_immediate_install()
+            if to_update_modules:
+                env['ir.module.module'].search(
+                    [('name', 'in', list(to_update_modules)),
+                     ('state', 'in', ('uninstalled', 'to_install'))]
+                ).button_immediate_upgrade()
+
+
+def get_modules_diff_report(dbs):
+    """ Compare modules installed in multiple databases with addons
+        on disk. Manifests are loaded once, and databases are queried
+        concurrently, limited by 'yodoo_db_stat_bulk_connections'
+        config option.
+
+        :param list dbs: list of database names
+        :return: dict {
+            'dbs': [db_name, ...],
+            'modules': {module_name: {
+                'version': version on disk or None,
+                'to_install': [index of db in 'dbs', ...],
+                'to_update': [index of db in 'dbs', ...],
+                'missing': [index of db in 'dbs', ...],
+            }},
+            'errors': {db_name: error_message},
+        }
+        Only modules, that differ at least in one database, are included.
+    """
+    manifests = get_addons_manifest_index().manifests
+    auto_install_addons = get_auto_install_addons()
+    max_connections = config_get_int(
+        'yodoo_db_stat_bulk_connections',
+        DEFAULT_DB_STAT_BULK_CONNECTIONS)
+    db_index = {db: idx for idx, db in enumerate(dbs)}
+
+    modules = {}
+    errors = {}
+    for db, modules_in_db, error in iter_concurrent(
+            get_installed_modules, dbs, max_connections):
+        if error:
+            _logger.warning(
+                "Cannot compute modules diff for database %s: %s",
+                db, error)
+            errors[db] = str(error)
+            continue
+        diff = compute_modules_diff(
+            modules_in_db, manifests, auto_install_addons)
+        for key, module_names in zip(
+                ('to_install', 'to_update', 'missing'), diff):
+            for module_name in module_names:
+                if module_name not in modules:
+                    modules[module_name] = {
+                        'version': manifests.get(
+                            module_name, {}).get('version'),
+                        'to_install': [],
+                        'to_update': [],
+                        'missing': [],
+                    }
+                modules[module_name][key].append(db_index[db])
+
+    # Databases are processed in order of completion
+    for module_info in modules.values():
+        for key in ('to_install', 'to_update', 'missing'):
+            module_info[key].sort()
+    return {
+        'dbs': list(dbs),
+        'modules': modules,
+        'errors': errors,
+    }
+
+
+def is_template_demo(template_dbname):
+    """ Check if template database contains demo data
+    """
+    with closing(db_connect(template_dbname).cursor()) as cr:
+        cr.execute("""
+            SELECT demo
+            FROM ir_module_module
+            WHERE name = 'base';
+        """)
+        row = cr.fetchone()
+    return bool(row and row[0])
+
+
+@service_db.check_db_management_enabled
+def create_db_from_template(dbname, template_dbname):
+    """ Create database 'dbname' as copy of 'template_dbname' using
+        'CREATE DATABASE ... TEMPLATE', and clone filestore of template
+        (see clone_filestore)
+    """
+    odoo.sql_db.close_db(template_dbname)
+    db = db_connect('postgres')
+    with closing(db.cursor()) as cr:
+        # CREATE DATABASE could not be run inside transaction
+        cr.autocommit(True)
+        cr.execute(
+            "SELECT pg_advisory_lock(%s, hashtext(%s))",
+            (TEMPLATE_ADVISORY_LOCK_NAMESPACE, template_dbname))
+        try:
+            service_db._drop_conn(cr, template_dbname)
+            cr.execute(
+                """CREATE DATABASE "%s" ENCODING 'unicode' TEMPLATE "%s" """
+                % (dbname, template_dbname))
+        finally:
+            cr.execute(
+                "SELECT pg_advisory_unlock(%s, hashtext(%s))",
+                (TEMPLATE_ADVISORY_LOCK_NAMESPACE, template_dbname))
+
+    from_fs = odoo.tools.config.filestore(template_dbname)
+    to_fs = odoo.tools.config.filestore(dbname)
+    if os.path.exists(from_fs) and not os.path.exists(to_fs):
+        try:
+            clone_filestore(from_fs, to_fs)
+        except Exception:
+            _drop_failed_db(dbname)
+            raise
+
+
+def _drop_failed_db(dbname):
+    """ Drop database, that was created, but could not be prepared
+        for use. Errors are logged, to not hide original error.
+    """
+    _logger.error(
+        "Cannot prepare new database %s. Dropping it.", dbname)
+    try:
+        drop_db(dbname)
+    except Exception:
+        _logger.error(
+            "Cannot drop database %s", dbname, exc_info=True)
+
+
+def configure_new_db(dbname, lang, user_password, user_login,
+                     country_code=None, phone=None):
+    """ Configure database created from template (or taken from pool)
+        same way as database initialized by Odoo
+        (service_db._initialize_db)
+    """
+    with closing(registry(dbname).cursor()) as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+
+        # Generate new database UUID and secret, to make database
+        # different from template
+        env['ir.config_parameter'].init(force=True)
+
+        # Load translations only if language is not loaded in template
+        if lang and not env['res.lang'].search_count(
+                [('code', '=', lang), ('active', '=', True)]):
+            env['res.lang']._activate_lang(lang)
+            if lang != 'en_US':
+                env['ir.module.module'].search(
+                    [('state', '=', 'installed')]
+                )._update_translations(lang)
+
+        if country_code:
+            country = env['res.country'].search(
+                [('code', 'ilike', country_code)], limit=1)
+            if country:
+                env['res.company'].browse(1).write({
+                    'country_id': country.id,
+                    'currency_id': country.currency_id.id,
+                })
+            if len(country_timezones.get(country_code, [])) == 1:
+                users = env['res.users'].search([])
+                users.write({'tz': country_timezones[country_code][0]})
+        if phone:
+            env['res.company'].browse(1).write({'phone': phone})
+        if '@' in user_login:
+            env['res.company'].browse(1).write({'email': user_login})
+
+        # update admin's password and lang and login
+        values = {'password': user_password, 'lang': lang}
+        if user_login:
+            values['login'] = user_login
+            emails = odoo.tools.email_split(user_login)
+            if emails:
+                values['email'] = emails[0]
+        env.ref('base.user_admin').write(values)
+
+        # Cleanup login history, inherited from template
+        env['res.users.log'].sudo().search([]).unlink()
+        cr.commit()
+
+
+@service_db.check_db_management_enabled
+def drop_db(db_name):
+    """ Drop database. Same as service_db.exp_drop, but filestore is
+        moved to trash and removed in background, instead of removing
+        it before return.
+
+        :return: False if there is no such database, that could be dropped
+    """
+    odoo.modules.registry.Registry.delete(db_name)
+    odoo.sql_db.close_db(db_name)
+
+    db = db_connect('postgres')
+    with closing(db.cursor()) as cr:
+        cr.autocommit(True)  # avoid transaction block
+        # Same conditions as in service_db.list_dbs, but temporary
+        # databases (hidden by yodoo_client) could be dropped too
+        cr.execute("""
+            SELECT 1
+            FROM pg_database
+            WHERE datname = %s
+              AND datdba = (SELECT usesysid FROM pg_user
+                            WHERE usename = current_user)
+              AND NOT datistemplate
+              AND datallowconn
+              AND datname NOT IN ('postgres', %s)
+        """, (db_name, odoo.tools.config['db_template']))
+        if not cr.fetchone():
+            return False
+        service_db._drop_conn(cr, db_name)
+        try:
+            cr.execute('DROP DATABASE "%s"' % db_name)
+        except Exception as e:
+            _logger.info('DROP DB: %s failed:\n%s', db_name, e)
+            raise Exception(
+                "Couldn't drop database %s: %s" % (db_name, e))
+        else:
+            _logger.info('DROP DB: %s', db_name)
+        finally:
+            invalidate_db_lifecycle_caches()
+
+    try:
+        mark_db_ready(db_name)
+    except Exception:
+        _logger.error(
+            "Cannot clear readiness marker of dropped database %s",
+            db_name, exc_info=True)
+    move_filestore_to_trash(db_name)
+    return True
+
+
+def _fill_pool_db(dbname, profile):
+    """ Create database for pool profile
+    """
+    create_db(
+        None, dbname, demo=profile.demo, lang=profile.lang,
+        user_password=generate_random_password(),
+        template_dbname=profile.template_dbname, use_pool=False)
+    if profile.addons:
+        with registry(dbname).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, context={})
+            env['ir.module.module'].search(
+                [('name', 'in', profile.addons),
+                 ('state', 'in', ('uninstalled', 'to_install'))]
+            ).button_immediate_install()
+    odoo.modules.registry.Registry.delete(dbname)
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    """ Return pool of prepared databases, configured by
+        'yodoo_db_pool' option
+    """
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = DatabasePool(
+                    parse_db_pool_profiles(
+                        odoo.tools.config.get('yodoo_db_pool')),
+                    _fill_pool_db,
+                    drop_db,
+                    interval=config_get_float(
+                        'yodoo_db_pool_interval', DEFAULT_DB_POOL_INTERVAL),
+                    min_free_space=config_get_int(
+                        'yodoo_db_pool_min_free_space',
+                        DEFAULT_DB_POOL_MIN_FREE_SPACE) * 1024 * 1024,
+                    pg_data_dir=odoo.tools.config.get(
+                        'yodoo_db_pool_pg_data_dir'))
+    return _db_pool
+
+
+# Operations below are used by database management API. They could be
+# called directly (with job=None) or run in background as jobs.
+# Params of operations are validated by controllers before call.
+
+@register_job_operation('create')
+def create_db(job, dbname, demo=False, lang='en_US', user_password='admin',
+              user_login='admin', country_code=None, phone=None,
+              template_dbname=None, pool_profile=None, use_pool=True):
+    """ Create new database.
+
+        If there is matching prepared database in pool (see
+        'yodoo_db_pool' option), then it is renamed to 'dbname' and
+        configured. 'pool_profile' could be used to select profile of
+        pool explicitly.
+
+        If template_dbname is set, then database is created as copy of
+        template database, that have to contain same addons, that have
+        to be installed in new database. This is much faster, than
+        initialization of new database, that installs all addons.
+    """
+    if use_pool:
+        profile_name = get_db_pool().claim(
+            dbname, lang=lang, demo=demo, template_dbname=template_dbname,
+            profile_name=pool_profile)
+        if profile_name:
+            report_progress(job, 0.5, "Configuring database")
+            try:
+                configure_new_db(
+                    dbname, lang, user_password, user_login,
+                    country_code=country_code, phone=phone)
+            except Exception:
+                _drop_failed_db(dbname)
+                raise
+            return {'db': dbname, 'pool_profile': profile_name}
+
+    if template_dbname:
+        _logger.info(
+            "Create database: %s from template %s",
+            dbname, template_dbname)
+        report_progress(job, 0.0, "Creating database from template")
+        try:
+            create_db_from_template(dbname, template_dbname)
+        finally:
+            invalidate_db_lifecycle_caches()
+        report_progress(job, 0.5, "Configuring database")
+        try:
+            configure_new_db(
+                dbname, lang, user_password, user_login,
+                country_code=country_code, phone=phone)
+        except Exception:
+            _drop_failed_db(dbname)
+            raise
+        return {'db': dbname}
+
+    _logger.info("Create database: %s (demo=%r)", dbname, demo)
+    report_progress(job, 0.0, "Creating database")
+    try:
+        service_db._create_empty_database(dbname)
+    except service_db.DatabaseExists as bd_ex:
+        raise werkzeug.exceptions.Conflict(
+            description=str(bd_ex))
+
+    report_progress(job, 0.1, "Initializing database")
+    service_db._initialize_db(
+        id, dbname, demo, lang, user_password, user_login,
+        country_code=country_code, phone=phone,
+    )
+    db = db_connect(dbname)
+    with closing(db.cursor()) as cr:
+        db_init = modules_db.is_initialized(cr)
+    if not db_init:
+        raise werkzeug.exceptions.InternalServerError(
+            description='Database not initialized.')
+    invalidate_db_lifecycle_caches()
+    return {'db': dbname}
+
+
+@register_job_operation('duplicate')
+def duplicate_db(job, db, new_dbname):
+    """ Duplicate database. Same as service_db.exp_duplicate_database,
+        but filestore is cloned (using reflinks or hardlinks if
+        supported by filesystem) instead of full copy.
+    """
+    _logger.info("Duplicate database: %s -> %s", db, new_dbname)
+    report_progress(job, 0.0, "Duplicating database")
+    try:
+        create_db_from_template(new_dbname, db)
+    finally:
+        invalidate_db_lifecycle_caches()
+
+    # Force generation of new dbuuid for copy of database
+    with registry(new_dbname).cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        env['ir.config_parameter'].init(force=True)
+    return {'db': new_dbname}
+
+
+@register_job_operation('rename')
+def rename_db(job, db, new_dbname):
+    _logger.info("Renaming database '%s' to '%s'...", db, new_dbname)
+    report_progress(job, 0.0, "Renaming database")
+    try:
+        service_db.exp_rename(db, new_dbname)
+    except Exception as e:
+        _logger.error("Rename database '%s' to '%s' failed:\n%s",
+                      db, new_dbname, e)
+        raise werkzeug.exceptions.InternalServerError(
+            description="Cannot rename database (%s -> %s):\n%s" % (
+                db, new_dbname, e))
+    finally:
+        invalidate_db_lifecycle_caches()
+
+    # Sometime, database is not available just after renaming,
+    # thus we have to wait while it will be available.
+    # Especially, this case sometimes happens with large databases (60+ GB)
+    report_progress(job, 0.5, "Waiting for renamed database")
+    for __ in retry_iter(interval_timeout=0.5,
+                         max_retries=10,
+                         first_timeout=False):
+        if service_db.exp_db_exist(new_dbname):
+            return {'db': new_dbname}
+
+    # If database still not available - raise error
+    raise werkzeug.exceptions.InternalServerError(
+        description="Cannot rename database (%s -> %s):\nTimed out" % (
+            db, new_dbname))
+
+
+@register_job_operation('backup', retry=True)
+def backup_db(job, db, backup_format='zip', compression=None,
+              known_hashes=None):
+    """ Make backup of database as artifact
+
+        :return: dict with info about artifact
+    """
+    report_progress(job, None, "Making backup")
+
+    def on_progress(size):
+        if job is not None:
+            job.set_progress(None, "Making backup: %s bytes written" % size)
+
+    meta, reused = get_backup_artifact_store().get_or_create(
+        db, backup_format, compression, known_hashes,
+        on_progress=on_progress)
+    return {
+        'artifact_id': meta['id'],
+        'filename': meta['filename'],
+        'size': meta['size'],
+        'sha256': meta['sha256'],
+        'created': meta['created'],
+        'expires': meta['expires'],
+        'reused': reused,
+    }
+
+
+def get_staging_db_name(kind, job=None):
+    """ Return unique name for temporary database, hidden from list of
+        databases (see hooks.TMP_DB_NAME_PATTERN). If job is passed, then
+        name is same for each attempt of this job, so database left by
+        interrupted attempt could be found and dropped.
+    """
+    return 'tmp-%s-%s-tmp' % (kind, job.id if job else uuid.uuid4().hex)
+
+
+def _get_signaling_values(dbname):
+    with closing(db_connect(dbname).cursor()) as cr:
+        cr.execute("""
+            SELECT (SELECT last_value FROM base_registry_signaling),
+                   (SELECT last_value FROM base_cache_signaling)
+        """)
+        return cr.fetchone()
+
+
+def _swap_filestores(staging_db, db, old_db):
+    """ Move filestore of 'db' to 'old_db', and filestore of 'staging_db'
+        to 'db'. If second rename fails, first one is reverted.
+    """
+    db_fs = odoo.tools.config.filestore(db)
+    staging_fs = odoo.tools.config.filestore(staging_db)
+    renamed = []
+    try:
+        if os.path.exists(db_fs):
+            os.rename(db_fs, odoo.tools.config.filestore(old_db))
+            renamed.append((db_fs, odoo.tools.config.filestore(old_db)))
+        if os.path.exists(staging_fs):
+            os.rename(staging_fs, db_fs)
+            renamed.append((staging_fs, db_fs))
+    except OSError:
+        for src, dst in reversed(renamed):
+            os.rename(dst, src)
+        raise
+
+
+@service_db.check_db_management_enabled
+def swap_db(staging_db, db):
+    """ Replace database 'db' with database 'staging_db'.
+
+        Connections to both databases are not allowed, while databases
+        and their filestores are renamed, so database is unavailable
+        only for time of renaming, and nobody could write attachments
+        to filestore that is being moved. If some rename fails, then
+        all renames done before are reverted. Then old database is
+        dropped (its filestore is removed in background).
+    """
+    old_db = get_staging_db_name('swapold')
+
+    # Workers, that have registry or caches of old database loaded,
+    # have to reload them after swap, so ensure that signaling
+    # sequences of new database are greater than in old one
+    registry_seq, cache_seq = _get_signaling_values(db)
+    with closing(db_connect(staging_db).cursor()) as cr:
+        cr.execute("""
+            SELECT setval('base_registry_signaling',
+                          GREATEST(last_value, %s) + 1)
+            FROM base_registry_signaling
+        """, (registry_seq,))
+        cr.execute("""
+            SELECT setval('base_cache_signaling',
+                          GREATEST(last_value, %s) + 1)
+            FROM base_cache_signaling
+        """, (cache_seq,))
+        cr.commit()
+
+    for dbname in (db, staging_db):
+        odoo.modules.registry.Registry.delete(dbname)
+        odoo.sql_db.close_db(dbname)
+
+    _logger.info("Swapping database %s with %s", db, staging_db)
+    with closing(db_connect('postgres').cursor()) as cr:
+        cr.autocommit(True)  # avoid transaction block
+        cr.execute(
+            "SELECT pg_advisory_lock(%s, hashtext(%s))",
+            (SWAP_ADVISORY_LOCK_NAMESPACE, db))
+        disallowed = []  # databases, that do not allow connections
+        renamed = []  # tuples (old_name, new_name) of renamed databases
+        try:
+            for dbname in (db, staging_db):
+                cr.execute(
+                    'ALTER DATABASE "%s" ALLOW_CONNECTIONS false' % dbname)
+                disallowed.append(dbname)
+                service_db._drop_conn(cr, dbname)
+            for old_name, new_name in ((db, old_db), (staging_db, db)):
+                cr.execute(
+                    'ALTER DATABASE "%s" RENAME TO "%s"' % (
+                        old_name, new_name))
+                renamed.append((old_name, new_name))
+            _swap_filestores(staging_db, db, old_db)
+        except Exception:
+            _logger.error(
+                "Cannot swap database %s with %s. Reverting.",
+                db, staging_db)
+            while renamed:
+                old_name, new_name = renamed[-1]
+                cr.execute(
+                    'ALTER DATABASE "%s" RENAME TO "%s"' % (
+                        new_name, old_name))
+                renamed.pop()
+            raise
+        finally:
+            current_names = dict(renamed)
+            for dbname in disallowed:
+                cr.execute(
+                    'ALTER DATABASE "%s" ALLOW_CONNECTIONS true' % (
+                        current_names.get(dbname, dbname)))
+            cr.execute(
+                "SELECT pg_advisory_unlock(%s, hashtext(%s))",
+                (SWAP_ADVISORY_LOCK_NAMESPACE, db))
+            invalidate_db_lifecycle_caches()
+    _logger.info("Database %s swapped with %s", db, staging_db)
+
+    # Database is already swapped, so failure to drop old database
+    # does not fail the operation
+    try:
+        drop_db(old_db)
+    except Exception:
+        _logger.error(
+            "Cannot drop database %s, that was replaced by %s",
+            old_db, staging_db, exc_info=True)
+
+
+@register_job_operation('reconcile', retry=True)
+def reconcile_db(job, db, target_db):
+    """ Postprocess restored database 'target_db' (install and update
+        addons, see postprocess_restored_db). If 'target_db' is staging
+        database, then it replaces database 'db' after postprocessing.
+
+        Logins to 'target_db' are not allowed since restore started
+        until this operation succeeds (see db_readiness.is_db_ready).
+        If it fails, then 'target_db' stays not ready.
+    """
+    try:
+        report_progress(job, 0.0, "Updating addons")
+        postprocess_restored_db(target_db)
+        if target_db != db:
+            report_progress(job, 0.9, "Swapping databases")
+            swap_db(target_db, db)
+    except Exception:
+        if target_db != db and service_db.exp_db_exist(target_db):
+            drop_db(target_db)
+        elif target_db == db:
+            mark_db_not_ready(db, 'reconcile_failed')
+        raise
+    # If databases were swapped, then marker of staging database is
+    # cleared, and 'db' was not marked, because it was available while
+    # staging database was restored
+    mark_db_ready(target_db)
+    return {'db': db}
+
+
+def get_db_reconcile_info(db):
+    """ Return info about last reconciliation job of database 'db'
+        (see JobRunner.get_job_info) or None
+    """
+    return get_job_runner().find_last_job_info('reconcile', db=db)
+
+
+def restore_and_postprocess_db(job, db, restore_func, swap=False,
+                               postprocess_async=False):
+    """ Restore database 'db' by calling restore_func(target_db), and
+        postprocess it (see reconcile_db).
+
+        If swap is set and database 'db' exists, then backup is restored
+        to hidden staging database, that replaces 'db' after restore
+        and postprocessing (see swap_db). Thus existing database is
+        available while backup is being restored.
+
+        If postprocess_async is set, then postprocessing is run as
+        background job, and ID of this job is returned.
+    """
+    target_db = db
+    if swap and service_db.exp_db_exist(db):
+        target_db = get_staging_db_name('swap', job)
+        if service_db.exp_db_exist(target_db):
+            _logger.info(
+                "Dropping staging database %s left by interrupted "
+                "attempt to restore database %s", target_db, db)
+            drop_db(target_db)
+        _logger.info(
+            "Restoring database %s to staging database %s", db, target_db)
+
+    # Logins are not allowed before any data lands to restored database,
+    # until it is postprocessed (see reconcile_db). Existing database is
+    # not marked, because restore fails for it.
+    marked = not service_db.exp_db_exist(target_db)
+    if marked:
+        mark_db_not_ready(target_db, 'restore')
+    try:
+        report_progress(job, 0.0, "Restoring database")
+        try:
+            restore_func(target_db)
+        finally:
+            invalidate_db_lifecycle_caches()
+    except Exception:
+        # Not all restore functions drop partially restored database
+        # (for example, odoo's restore_db does not), so it is dropped
+        # here. Existing database 'db' (not marked) is never dropped.
+        if ((marked or target_db != db) and
+                service_db.exp_db_exist(target_db)):
+            _logger.info(
+                "Restore of database %s failed. Dropping partially "
+                "restored database %s", db, target_db)
+            try:
+                drop_db(target_db)
+            except Exception:
+                _logger.error(
+                    "Cannot drop database %s", target_db, exc_info=True)
+        if marked and not service_db.exp_db_exist(target_db):
+            mark_db_ready(target_db)
+        raise
+
+    if postprocess_async:
+        return get_job_runner().enqueue('reconcile', {
+            'db': db,
+            'target_db': target_db,
+        })
+    report_progress(job, 0.8, "Updating addons")
+    reconcile_db(None, db, target_db)
+    return None
+
+
+def _is_restore_retryable(params):
+    # Only restore to staging database could be safely run again: staging
+    # database left by interrupted attempt is dropped before restore.
+    # Restore with async postprocessing is not retried, because reconcile
+    # job of interrupted attempt could be already working on staging db.
+    return params.get('swap') and not params.get('postprocess_async')
+
+
+@register_job_operation('restore', retry=_is_restore_retryable)
+def restore_db_from_file(job, db, backup_path, copy=False, swap=False,
+                         postprocess_async=False):
+    """ Restore database from backup file, and remove this file after
+        restore (even if it failed)
+    """
+    try:
+        reconcile_job_id = restore_and_postprocess_db(
+            job, db,
+            lambda target_db: restore_db(target_db, backup_path, copy),
+            swap=swap, postprocess_async=postprocess_async)
+    finally:
+        if os.path.exists(backup_path):
+            os.unlink(backup_path)
+    return {'db': db, 'reconcile_job_id': reconcile_job_id}
@@ -0,0 +1,407 @@
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import logging
+import threading
+import contextlib
+from contextlib import closing
+
+from odoo import sql_db
+from odoo.tools import config
+from odoo.service import db as service_db
+
+from .cache import invalidate_db_lifecycle_caches
+
+# Default interval (seconds) between checks of pool depth
+DEFAULT_DB_POOL_INTERVAL = 60
+
+# Default min free disk space (in MB) in Odoo data dir and in PostgreSQL
+# data directory, required to add new database to pool
+DEFAULT_DB_POOL_MIN_FREE_SPACE = 1024
+
+# Namespace for advisory locks used by pool
+DB_POOL_ADVISORY_LOCK_NAMESPACE = 0x59D2
+
+# Names of pool databases. Both match 'tmp-*-tmp' pattern, so they are
+# hidden from list of databases. Databases that are being prepared have
+# separate prefix, and are renamed to 'ready' name when prepared.
+DB_POOL_READY_PREFIX = 'tmp-pool-'
+DB_POOL_FILL_PREFIX = 'tmp-poolfill-'
+
+DB_POOL_PROFILE_NAME_RE = re.compile(r'^[a-z0-9_]+$')
+
+_logger = logging.getLogger(__name__)
+
+
+class DatabasePoolProfile(object):
+    """ Kind of databases kept ready in pool
+    """
+
+    def __init__(self, name, size=1, lang='en_US', demo=False,
+                 template_dbname=None, addons=None):
+        if not DB_POOL_PROFILE_NAME_RE.match(name):
+            raise ValueError(
+                "Wrong name of database pool profile: %r" % name)
+        self.name = name
+        self.size = int(size)
+        self.lang = lang
+        self.demo = bool(demo)
+        self.template_dbname = template_dbname or None
+        self.addons = list(addons or [])
+
+    def match(self, lang, demo, template_dbname, explicit=False):
+        """ Check if database requested with these params could be
+            taken from this profile. Profiles with extra addons are used
+            only if selected explicitly.
+        """
+        return (
+            (explicit or not self.addons) and
+            self.lang == lang and
+            self.demo == bool(demo) and
+            self.template_dbname == (template_dbname or None))
+
+    def get_ready_db_re(self):
+        return r'^%s%s-[0-9a-f]+-[0-9a-f]+-tmp$' % (
+            DB_POOL_READY_PREFIX, self.name)
+
+    def generate_db_names(self):
+        """ Return tuple(fill_name, ready_name) for new pool database.
+            Timestamp in name is used to claim oldest databases first.
+        """
+        suffix = '%s-%010x-%s-tmp' % (
+            self.name, int(time.time()), uuid.uuid4().hex[:8])
+        return DB_POOL_FILL_PREFIX + suffix, DB_POOL_READY_PREFIX + suffix
+
+
+def parse_db_pool_profiles(value):
+    """ Parse 'yodoo_db_pool' option: json object
+        {profile_name: {size, lang, demo, template_dbname, addons}}
+    """
+    if not value:
+        return {}
+    try:
+        data = json.loads(value)
+        return {
+            name: DatabasePoolProfile(name, **params)
+            for name, params in data.items()
+        }
+    except (ValueError, TypeError, AttributeError):
+        _logger.error(
+            "Config option yodoo_db_pool has wrong value, "
+            "database pool disabled", exc_info=True)
+        return {}
+
+
+@contextlib.contextmanager
+def _postgres_cursor():
+    with closing(sql_db.db_connect('postgres').cursor()) as cr:
+        cr.autocommit(True)
+        yield cr
+
+
+class DatabasePool(object):
+    """ Pool of databases, prepared in advance, to create databases
+        instantly: database requested by client is just renamed from
+        pool database.
+
+        Pool is filled by background thread. Only one thread in cluster
+        fills pool at a time (guarded by advisory lock). Statistic of
+        claims (hits and misses) is stored in 'postgres' database, thus
+        it is shared by all workers.
+    """
+
+    def __init__(self, profiles, fill_func, drop_func, interval,
+                 min_free_space, pg_data_dir=None):
+        """
+            :param dict profiles: {name: DatabasePoolProfile}
+            :param callable fill_func: function(dbname, profile), that
+                creates new database for profile
+            :param callable drop_func: function(dbname), that drops
+                database (including hidden temporary databases)
+            :param float interval: interval between checks of pool depth
+            :param int min_free_space: min free space (in bytes) in
+                data dir and in PostgreSQL data directory, required to
+                add new database to pool
+            :param str pg_data_dir: path to PostgreSQL data directory (or
+                to mount point of its volume). If not set, it is read from
+                PostgreSQL settings.
+        """
+        self.profiles = profiles
+        self.interval = interval
+        self.min_free_space = min_free_space
+        self.pg_data_dir = pg_data_dir
+        self._pg_data_dir_checked = False
+        self._fill_func = fill_func
+        self._drop_func = drop_func
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._thread = None
+        self._table_ready = False
+
+    def _ensure_table(self, cr):
+        if self._table_ready:
+            return
+        cr.execute("""
+            SELECT pg_advisory_lock(%(ns)s, 1);
+            CREATE TABLE IF NOT EXISTS yodoo_client_db_pool_stat (
+                profile VARCHAR PRIMARY KEY,
+                hits BIGINT NOT NULL DEFAULT 0,
+                misses BIGINT NOT NULL DEFAULT 0
+            );
+            SELECT pg_advisory_unlock(%(ns)s, 1);
+        """, {'ns': DB_POOL_ADVISORY_LOCK_NAMESPACE})
+        self._table_ready = True
+
+    def ensure_running(self):
+        """ Start filler thread in current process if it is not started.
+            Filler runs in each worker, but only one of them fills
+            pool at a time.
+        """
+        if not self.profiles:
+            return
+        if (self._pid == os.getpid() and self._thread and
+                self._thread.is_alive()):
+            return
+        with self._lock:
+            if (self._pid == os.getpid() and self._thread and
+                    self._thread.is_alive()):
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name='yodoo-db-pool', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.fill()
+            except Exception:
+                _logger.error("Cannot fill database pool", exc_info=True)
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def _list_pool_dbs(self, cr, pattern):
+        cr.execute("""
+            SELECT datname
+            FROM pg_database
+            WHERE datname ~ %s
+            ORDER BY datname
+        """, (pattern,))
+        return [r[0] for r in cr.fetchall()]
+
+    def _get_pg_data_dir(self, cr):
+        """ Return path to PostgreSQL data directory, where pool
+            databases are stored, or None if it is not available on
+            this host (for example, PostgreSQL runs on other server)
+        """
+        if self._pg_data_dir_checked:
+            return self.pg_data_dir
+        path = self.pg_data_dir
+        if not path:
+            # Setting is readable only by superusers and members of
+            # pg_read_all_settings role
+            cr.execute("""
+                SELECT current_setting('data_directory')
+                WHERE pg_has_role('pg_read_all_settings', 'MEMBER')
+            """)
+            row = cr.fetchone()
+            path = row[0] if row else None
+        if not path or not os.path.isdir(path):
+            _logger.warning(
+                "PostgreSQL data directory %s is not available, free "
+                "space on it is not checked when database pool is filled. "
+                "Set option yodoo_db_pool_pg_data_dir to path of mounted "
+                "PostgreSQL volume to check it.", path or '')
+            path = None
+        self.pg_data_dir = path
+        self._pg_data_dir_checked = True
+        return path
+
+    def _check_free_space(self, cr):
+        # Filestore of new database is stored in data dir, and database
+        # itself in PostgreSQL data directory
+        paths = [config['data_dir']]
+        pg_data_dir = self._get_pg_data_dir(cr)
+        if pg_data_dir:
+            paths.append(pg_data_dir)
+        for path in paths:
+            free = shutil.disk_usage(path).free
+            if free < self.min_free_space:
+                _logger.warning(
+                    "Not enough free disk space in %s to fill database "
+                    "pool (%s bytes free, %s bytes required)",
+                    path, free, self.min_free_space)
+                return False
+        return True
+
+    def _drop(self, dbname):
+        _logger.info("Dropping pool database %s", dbname)
+        try:
+            self._drop_func(dbname)
+        except Exception:
+            _logger.error(
+                "Cannot drop pool database %s", dbname, exc_info=True)
+
+    def fill(self):
+        """ Add databases to pool up to size of profiles, and remove
+            excess databases and leftovers of failed fills
+        """
+        with _postgres_cursor() as cr:
+            cr.execute(
+                "SELECT pg_try_advisory_lock(%s, 0)",
+                (DB_POOL_ADVISORY_LOCK_NAMESPACE,))
+            if not cr.fetchone()[0]:
+                return
+            try:
+                self._fill(cr)
+            finally:
+                cr.execute(
+                    "SELECT pg_advisory_unlock(%s, 0)",
+                    (DB_POOL_ADVISORY_LOCK_NAMESPACE,))
+
+    def _fill(self, cr):
+        # Databases, that were being prepared when previous filler
+        # stopped, are incomplete
+        for dbname in self._list_pool_dbs(
+                cr, '^%s.*-tmp$' % DB_POOL_FILL_PREFIX):
+            self._drop(dbname)
+
+        known = set()
+        for profile in self.profiles.values():
+            ready = self._list_pool_dbs(cr, profile.get_ready_db_re())
+            known.update(ready)
+            for dbname in ready[profile.size:]:
+                self._drop(dbname)
+            for __ in range(profile.size - len(ready)):
+                if not self._check_free_space(cr):
+                    return
+                fill_name, ready_name = profile.generate_db_names()
+                _logger.info(
+                    "Adding database %s to pool (profile %s)",
+                    ready_name, profile.name)
+                try:
+                    self._fill_func(fill_name, profile)
+                    service_db.exp_rename(fill_name, ready_name)
+                except Exception:
+                    _logger.error(
+                        "Cannot add database to pool (profile %s)",
+                        profile.name, exc_info=True)
+                    if service_db.exp_db_exist(fill_name):
+                        self._drop(fill_name)
+                    break
+                finally:
+                    invalidate_db_lifecycle_caches()
+                known.add(ready_name)
+
+        # Databases of profiles removed from config
+        for dbname in self._list_pool_dbs(
+                cr, '^%s.*-tmp$' % DB_POOL_READY_PREFIX):
+            if dbname not in known:
+                self._drop(dbname)
+
+    def _find_profile(self, lang, demo, template_dbname, profile_name):
+        if profile_name:
+            profile = self.profiles.get(profile_name)
+            if profile and profile.match(
+                    lang, demo, template_dbname, explicit=True):
+                return profile
+            return None
+        for profile in self.profiles.values():
+            if profile.match(lang, demo, template_dbname):
+                return profile
+        return None
+
+    def _record_claim(self, cr, profile, hit):
+        self._ensure_table(cr)
+        cr.execute("""
+            INSERT INTO yodoo_client_db_pool_stat (profile, hits, misses)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (profile) DO UPDATE
+            SET hits = yodoo_client_db_pool_stat.hits + EXCLUDED.hits,
+                misses = yodoo_client_db_pool_stat.misses + EXCLUDED.misses
+        """, (profile.name, int(hit), int(not hit)))
+
+    def claim(self, dbname, lang='en_US', demo=False, template_dbname=None,
+              profile_name=None):
+        """ Try to take database from pool, and rename it to 'dbname'
+
+            :return: name of profile if database was taken from pool,
+                     otherwise None
+        """
+        profile = self._find_profile(
+            lang, demo, template_dbname, profile_name)
+        if profile is None:
+            return None
+        self.ensure_running()
+
+        claimed = None
+        with _postgres_cursor() as cr:
+            cr.execute(
+                "SELECT pg_advisory_lock(%s, hashtext(%s))",
+                (DB_POOL_ADVISORY_LOCK_NAMESPACE, profile.name))
+            try:
+                for pool_dbname in self._list_pool_dbs(
+                        cr, profile.get_ready_db_re()):
+                    try:
+                        service_db.exp_rename(pool_dbname, dbname)
+                    except Exception:
+                        _logger.warning(
+                            "Cannot claim pool database %s",
+                            pool_dbname, exc_info=True)
+                        continue
+                    finally:
+                        invalidate_db_lifecycle_caches()
+                    claimed = pool_dbname
+                    break
+            finally:
+                cr.execute(
+                    "SELECT pg_advisory_unlock(%s, hashtext(%s))",
+                    (DB_POOL_ADVISORY_LOCK_NAMESPACE, profile.name))
+            self._record_claim(cr, profile, bool(claimed))
+
+        # Refill pool
+        self._wakeup.set()
+        if not claimed:
+            _logger.info(
+                "Database pool of profile %s is empty", profile.name)
+            return None
+        _logger.info(
+            "Database %s taken from pool as %s", claimed, dbname)
+        return profile.name
+
+    def get_statistic(self):
+        """ Return depth and hit rate of pool profiles
+
+            :return: dict {profile_name: {
+                'size': configured size of pool,
+                'ready': number of ready databases,
+                'hits': number of databases taken from pool,
+                'misses': number of requests, when pool was empty,
+                'hit_rate': hits / (hits + misses) or None,
+            }}
+        """
+        self.ensure_running()
+        res = {}
+        with _postgres_cursor() as cr:
+            self._ensure_table(cr)
+            cr.execute("""
+                SELECT profile, hits, misses
+                FROM yodoo_client_db_pool_stat
+            """)
+            stat = {r[0]: r[1:] for r in cr.fetchall()}
+            for profile in self.profiles.values():
+                hits, misses = stat.get(profile.name, (0, 0))
+                total = hits + misses
+                res[profile.name] = {
+                    'size': profile.size,
+                    'ready': len(self._list_pool_dbs(
+                        cr, profile.get_ready_db_re())),
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_rate': hits / total if total else None,
+                }
+        return res
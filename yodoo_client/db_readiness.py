@@ -0,0 +1,145 @@
+import logging
+import contextlib
+from contextlib import closing
+
+from odoo import sql_db
+
+from .cache import CachedValue
+from .config import config_get_float
+
+# Time (seconds) to cache list of databases, that are not ready, in
+# each worker
+DEFAULT_DB_READY_CACHE_TTL = 2
+
+# Namespace for advisory locks used to create table of markers
+DB_READY_ADVISORY_LOCK_NAMESPACE = 0x59D4
+
+_logger = logging.getLogger(__name__)
+
+_table_ready = False
+
+
+@contextlib.contextmanager
+def _postgres_cursor():
+    with closing(sql_db.db_connect('postgres').cursor()) as cr:
+        yield cr
+        cr.commit()
+
+
+def _ensure_table(cr):
+    global _table_ready
+    if _table_ready:
+        return
+    cr.execute("""
+        SELECT pg_advisory_xact_lock(%(ns)s, 0);
+        CREATE TABLE IF NOT EXISTS yodoo_client_db_not_ready (
+            db VARCHAR PRIMARY KEY,
+            reason VARCHAR,
+            created_at TIMESTAMP NOT NULL
+        );
+    """, {'ns': DB_READY_ADVISORY_LOCK_NAMESPACE})
+    _table_ready = True
+
+
+def _table_exists(cr):
+    cr.execute(
+        "SELECT to_regclass('yodoo_client_db_not_ready') IS NOT NULL")
+    return cr.fetchone()[0]
+
+
+def _fetch_not_ready_dbs():
+    with _postgres_cursor() as cr:
+        if not _table_exists(cr):
+            return frozenset()
+        cr.execute("SELECT db FROM yodoo_client_db_not_ready")
+        return frozenset(r[0] for r in cr.fetchall())
+
+
+_not_ready_dbs_cache = CachedValue(
+    'db_not_ready',
+    _fetch_not_ready_dbs,
+    ttl=config_get_float(
+        'yodoo_db_ready_cache_ttl', DEFAULT_DB_READY_CACHE_TTL))
+
+
+def mark_db_not_ready(db, reason):
+    """ Do not allow logins to database 'db' (see is_db_ready) until
+        mark_db_ready is called. Marker is stored in 'postgres' database,
+        so it is shared by all workers, and kept after restart of server.
+
+        :param str reason: why database is not ready (for example,
+                           'restore' or 'reconcile_failed')
+    """
+    with _postgres_cursor() as cr:
+        _ensure_table(cr)
+        cr.execute("""
+            INSERT INTO yodoo_client_db_not_ready (db, reason, created_at)
+            VALUES (%s, %s, now() at time zone 'UTC')
+            ON CONFLICT (db) DO UPDATE
+            SET reason = EXCLUDED.reason
+        """, (db, reason))
+    _not_ready_dbs_cache.invalidate()
+
+
+def mark_db_ready(db):
+    """ Allow logins to database 'db'
+    """
+    with _postgres_cursor() as cr:
+        if not _table_exists(cr):
+            return
+        cr.execute("""
+            DELETE FROM yodoo_client_db_not_ready
+            WHERE db = %s
+        """, (db,))
+    _not_ready_dbs_cache.invalidate()
+
+
+def rename_db_readiness(db, new_db):
+    """ Move marker of not ready database 'db' to 'new_db'
+        after rename of database
+    """
+    with _postgres_cursor() as cr:
+        if not _table_exists(cr):
+            return
+        cr.execute("""
+            UPDATE yodoo_client_db_not_ready
+            SET db = %s
+            WHERE db = %s
+        """, (new_db, db))
+    _not_ready_dbs_cache.invalidate()
+
+
+def get_db_not_ready_reason(db):
+    """ Return reason why database 'db' is not ready, or None if it is
+        ready. Always reads state from database (not cached).
+    """
+    with _postgres_cursor() as cr:
+        if not _table_exists(cr):
+            return None
+        cr.execute("""
+            SELECT reason
+            FROM yodoo_client_db_not_ready
+            WHERE db = %s
+        """, (db,))
+        row = cr.fetchone()
+        return row[0] if row else None
+
+
+def is_db_ready(db):
+    """ Check that logins to database 'db' are allowed (database is not
+        being restored or reconciled, and its reconciliation did not fail)
+
+        Cached list of not ready databases is checked first, so most of
+        logins do not query 'postgres' database. If database is in this
+        list, then its state is read from database, because it could be
+        changed by other worker after list was cached.
+    """
+    try:
+        if db not in _not_ready_dbs_cache.get():
+            return True
+        return get_db_not_ready_reason(db) is None
+    except Exception:
+        # Do not block logins if state of database could not be checked
+        _logger.warning(
+            "Cannot check if database %s is ready", db, exc_info=True)
+        return True
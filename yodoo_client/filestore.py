@@ -0,0 +1,618 @@
+import os
+import json
+import time
+import uuid
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo.tools import config
+
+from .config import config_get_int, config_get_float
+
+# Directory in filestore root, where indexes of filestore sizes are stored.
+# Name starts with dot to never clash with database names.
+FILESTORE_SIZE_INDEX_DIR = '.yodoo_size_index'
+
+# Directory in filestore root, where filestores of dropped databases are
+# moved to be removed in background. It is located on same filesystem,
+# thus filestore is moved there by atomic rename.
+FILESTORE_TRASH_DIR = '.yodoo_trash'
+
+# Default max number of files removed from trash per second
+DEFAULT_TRASH_REAPER_RATE = 1000
+
+# Interval (seconds) between checks for new filestores in trash
+TRASH_REAPER_INTERVAL = 30
+
+# Directories modified less than this number of nanoseconds before scan
+# are scanned again on next refresh: on filesystems with coarse mtime
+# resolution directory could be changed after scan without change of its
+# mtime (same approach as git uses for racily clean index entries).
+FILESTORE_RACY_MTIME_WINDOW = 2 * 10 ** 9
+
+# Max number of filestores scanned in parallel in this process
+DEFAULT_FILESTORE_SCAN_CONCURRENCY = 4
+
+# Modes of cloning filestore:
+# - 'auto': use best mode supported by filesystem (reflink, hardlink, copy)
+# - 'reflink': copy-on-write clone of files (btrfs, xfs, ...)
+# - 'hardlink': hardlinks to same files. Safe, because files in filestore
+#   are never changed in place: Odoo writes new file and removes old one.
+# - 'copy': full copy of files
+CLONE_MODE_AUTO = 'auto'
+CLONE_MODE_REFLINK = 'reflink'
+CLONE_MODE_HARDLINK = 'hardlink'
+CLONE_MODE_COPY = 'copy'
+CLONE_MODES = (
+    CLONE_MODE_AUTO, CLONE_MODE_REFLINK, CLONE_MODE_HARDLINK, CLONE_MODE_COPY)
+
+# Max number of files cloned in parallel
+DEFAULT_FILESTORE_CLONE_JOBS = 8
+
+# ioctl request to clone file (linux/fs.h)
+FICLONE = 0x40049409
+
+# Errors, that mean that filesystem does not support mode of cloning
+_CLONE_UNSUPPORTED_ERRORS = (
+    errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY,
+    errno.EPERM, errno.EMLINK, errno.ENOSYS)
+
+_logger = logging.getLogger(__name__)
+
+
+def get_filestore_root():
+    return os.path.join(config['data_dir'], 'filestore')
+
+
+class FilestoreSizeIndex(object):
+    """ Persistent index of size of database filestore.
+
+        For each directory of filestore index keeps its modification time,
+        total size of files located directly in this directory, and list of
+        subdirectories. Directory mtime changes when entries are added,
+        removed or renamed in it, and files in filestore are never
+        changed in place, so on refresh only directories with changed mtime
+        have to be scanned again. For unchanged filestore refresh costs
+        one stat call per directory.
+
+        Index does not depend on notifications from Odoo workers, thus it
+        sees changes made by any process on this server.
+    """
+
+    def __init__(self, filestore_path, index_path):
+        self.filestore_path = filestore_path
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._records = None
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'rt') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            _logger.warning(
+                "Cannot read filestore size index %s. It will be rebuilt.",
+                self.index_path, exc_info=True)
+            return {}
+
+    def _save(self, records):
+        tmp_path = '%s.%s.tmp' % (self.index_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(tmp_path, 'wt') as f:
+                json.dump(records, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            _logger.warning(
+                "Cannot save filestore size index %s",
+                self.index_path, exc_info=True)
+
+    def _scan_dir(self, relpath):
+        """ Compute size of files located directly in directory and
+            find its subdirectories.
+
+            :return: tuple(size, subdirs)
+        """
+        size = 0
+        subdirs = []
+        with os.scandir(os.path.join(self.filestore_path, relpath)) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    else:
+                        size += entry.stat().st_size
+                except FileNotFoundError:
+                    # File was removed while we scan directory
+                    continue
+        return size, sorted(subdirs)
+
+    def refresh(self):
+        """ Update index and return total size of filestore in bytes
+        """
+        with self._lock:
+            if self._records is None:
+                self._records = self._load()
+            old_records = self._records
+            racy_mtime = time.time_ns() - FILESTORE_RACY_MTIME_WINDOW
+
+            records = {}
+            total_size = 0
+            changed = False
+            to_visit = ['']
+            while to_visit:
+                relpath = to_visit.pop()
+                try:
+                    # Stat directory before reading its content, so if it
+                    # will be changed while we are scanning it, mtime will
+                    # differ on next refresh.
+                    mtime = os.stat(
+                        os.path.join(self.filestore_path, relpath)
+                    ).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                record = old_records.get(relpath)
+                if not record or record[0] != mtime:
+                    try:
+                        size, subdirs = self._scan_dir(relpath)
+                    except FileNotFoundError:
+                        continue
+                    # Directory could be changed after scan in same tick
+                    # of filesystem clock. Do not save its mtime, so it
+                    # will be scanned again on next refresh.
+                    record = [
+                        mtime if mtime < racy_mtime else None,
+                        size, subdirs]
+                    changed = True
+                records[relpath] = record
+                total_size += record[1]
+                to_visit.extend(
+                    os.path.join(relpath, d) for d in record[2])
+
+            if changed or len(records) != len(old_records):
+                self._save(records)
+            self._records = records
+        return total_size
+
+    def get_signature(self):
+        """ Refresh index and return signature of filestore state.
+            Signature changes when files are added to or removed from
+            filestore.
+        """
+        self.refresh()
+        with self._lock:
+            data = json.dumps(self._records, sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+_size_indexes = {}
+_size_indexes_lock = threading.Lock()
+
+
+def _check_filestore_name(db):
+    if not db or db.startswith('.') or os.path.basename(db) != db:
+        raise ValueError("Wrong database name: %r" % db)
+
+
+def get_filestore_size_index(db):
+    """ Return filestore size index for database 'db'
+    """
+    _check_filestore_name(db)
+    index = _size_indexes.get(db)
+    if index is None:
+        with _size_indexes_lock:
+            index = _size_indexes.get(db)
+            if index is None:
+                root = get_filestore_root()
+                index = _size_indexes[db] = FilestoreSizeIndex(
+                    os.path.join(root, db),
+                    os.path.join(
+                        root, FILESTORE_SIZE_INDEX_DIR, '%s.json' % db))
+    return index
+
+
+def get_filestore_size(db):
+    """ Return size of filestore of database 'db' in bytes
+    """
+    return get_filestore_size_index(db).refresh()
+
+
+def get_filestore_signature(db):
+    """ Return signature of state of filestore of database 'db'
+    """
+    return get_filestore_size_index(db).get_signature()
+
+
+def _get_filestore_scan_concurrency():
+    return max(config_get_int(
+        'yodoo_filestore_scan_concurrency',
+        DEFAULT_FILESTORE_SCAN_CONCURRENCY), 1)
+
+
+_scan_semaphore = None
+_scan_semaphore_lock = threading.Lock()
+
+
+def _get_scan_semaphore():
+    """ Return semaphore, that limits number of concurrent filestore
+        scans in this process, even if multiple server-wide scans
+        are requested at same time.
+    """
+    global _scan_semaphore
+    if _scan_semaphore is None:
+        with _scan_semaphore_lock:
+            if _scan_semaphore is None:
+                _scan_semaphore = threading.BoundedSemaphore(
+                    _get_filestore_scan_concurrency())
+    return _scan_semaphore
+
+
+def scan_filestore_size(db):
+    """ Return size of filestore of database 'db' in bytes,
+        or None if it cannot be computed.
+        Number of concurrent scans in process is limited.
+    """
+    with _get_scan_semaphore():
+        try:
+            return get_filestore_size(db)
+        except (OSError, ValueError):
+            _logger.error(
+                "Cannot compute size of filestore for database %s",
+                db, exc_info=True)
+            return None
+
+
+def list_filestores():
+    """ Return names of databases that have filestore on this server
+    """
+    try:
+        entries = list(os.scandir(get_filestore_root()))
+    except FileNotFoundError:
+        return []
+    return sorted(
+        e.name for e in entries
+        if e.is_dir(follow_symlinks=False) and not e.name.startswith('.'))
+
+
+def get_filestore_sizes(dbs=None):
+    """ Compute sizes of filestores of multiple databases in parallel.
+
+        Filestores are scanned by bounded thread pool, and total number
+        of concurrent scans in process is limited by
+        'yodoo_filestore_scan_concurrency' config option.
+
+        :param list dbs: names of databases to compute filestore size for.
+                         If not set, then all filestores will be scanned
+        :return: dict {db_name: size_in_bytes}. Size is None if filestore
+                 cannot be scanned.
+    """
+    if dbs is None:
+        dbs = list_filestores()
+    if not dbs:
+        return {}
+    max_workers = min(_get_filestore_scan_concurrency(), len(dbs))
+    with ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='yodoo-filestore-scan') as executor:
+        sizes = executor.map(scan_filestore_size, dbs)
+        return dict(zip(dbs, sizes))
+
+
+def _reflink_file(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _clone_file(src, dst, mode):
+    if mode == CLONE_MODE_REFLINK:
+        try:
+            _reflink_file(src, dst)
+        except OSError:
+            # Remove empty file created before clone failed
+            if os.path.exists(dst):
+                os.unlink(dst)
+            raise
+    elif mode == CLONE_MODE_HARDLINK:
+        os.link(src, dst)
+    else:
+        shutil.copy2(src, dst)
+
+
+def _detect_clone_mode(src, dst):
+    """ Clone file 'src' to 'dst' using best supported mode
+
+        :return: mode used to clone file
+    """
+    for mode in (CLONE_MODE_REFLINK, CLONE_MODE_HARDLINK):
+        try:
+            _clone_file(src, dst, mode)
+        except OSError as e:
+            if e.errno not in _CLONE_UNSUPPORTED_ERRORS:
+                raise
+            _logger.debug(
+                "Cloning files in %s mode is not supported: %s", mode, e)
+        else:
+            return mode
+    _clone_file(src, dst, CLONE_MODE_COPY)
+    return CLONE_MODE_COPY
+
+
+def get_filestore_clone_mode():
+    mode = config.get('yodoo_filestore_clone_mode') or CLONE_MODE_AUTO
+    if mode not in CLONE_MODES:
+        _logger.warning(
+            "Config option yodoo_filestore_clone_mode has wrong value, "
+            "using default %r", CLONE_MODE_AUTO)
+        return CLONE_MODE_AUTO
+    return mode
+
+
+def _get_filestore_clone_jobs():
+    return max(config_get_int(
+        'yodoo_filestore_clone_jobs', DEFAULT_FILESTORE_CLONE_JOBS), 1)
+
+
+def clone_filestore(src_path, dst_path, mode=None):
+    """ Clone filestore directory 'src_path' to 'dst_path' (that must not
+        exist). Directories are created, and files are cloned in
+        parallel using reflinks, hardlinks or copying, according to
+        'mode' (by default 'yodoo_filestore_clone_mode' option).
+        In 'auto' mode, cloning mode is detected on first file.
+
+        If cloning fails, then partially cloned directory is removed.
+
+        :return: dict with keys 'mode', 'files' and 'size'
+    """
+    mode = mode or get_filestore_clone_mode()
+    files = []
+    os.makedirs(dst_path)
+    try:
+        for root, dirs, fnames in os.walk(src_path):
+            rel_root = os.path.relpath(root, src_path)
+            for dname in dirs:
+                os.mkdir(os.path.join(dst_path, rel_root, dname))
+            for fname in fnames:
+                files.append(os.path.normpath(os.path.join(rel_root, fname)))
+
+        size = 0
+        to_clone = files
+        if files and mode == CLONE_MODE_AUTO:
+            mode = _detect_clone_mode(
+                os.path.join(src_path, files[0]),
+                os.path.join(dst_path, files[0]))
+            size += os.path.getsize(os.path.join(src_path, files[0]))
+            to_clone = files[1:]
+
+        def clone(rel_path):
+            src = os.path.join(src_path, rel_path)
+            _clone_file(src, os.path.join(dst_path, rel_path), mode)
+            return os.path.getsize(src)
+
+        if to_clone:
+            max_workers = min(_get_filestore_clone_jobs(), len(to_clone))
+            with ThreadPoolExecutor(
+                    max_workers=max_workers,
+                    thread_name_prefix='yodoo-filestore-clone') as executor:
+                size += sum(executor.map(clone, to_clone))
+    except Exception:
+        shutil.rmtree(dst_path, ignore_errors=True)
+        raise
+
+    _logger.info(
+        "Filestore %s cloned to %s (mode %s, %s files, %s bytes)",
+        src_path, dst_path, mode, len(files), size)
+    return {
+        'mode': mode,
+        'files': len(files),
+        'size': size,
+    }
+
+
+def get_filestore_trash_path():
+    return os.path.join(get_filestore_root(), FILESTORE_TRASH_DIR)
+
+
+def move_filestore_to_trash(db):
+    """ Move filestore of database 'db' to trash, from where it will be
+        removed in background by trash reaper. If filestore cannot be
+        moved to trash, then it is removed at once.
+
+        :return: True if filestore was moved to trash
+    """
+    _check_filestore_name(db)
+    path = os.path.join(get_filestore_root(), db)
+    index = get_filestore_size_index(db)
+    with _size_indexes_lock:
+        _size_indexes.pop(db, None)
+    if not os.path.exists(path):
+        return False
+
+    # Size of filestore is taken from size index (without refresh),
+    # only to report backlog of trash
+    size = None
+    records = index._load()
+    if records:
+        size = sum(r[1] for r in records.values())
+    if os.path.exists(index.index_path):
+        os.unlink(index.index_path)
+
+    trash_path = get_filestore_trash_path()
+    name = '%s-%010x-%s' % (db, int(time.time()), uuid.uuid4().hex[:8])
+    try:
+        os.makedirs(trash_path, exist_ok=True)
+        with open(os.path.join(trash_path, '%s.json' % name), 'wt') as f:
+            json.dump({'db': db, 'trashed_at': time.time(), 'size': size}, f)
+        os.rename(path, os.path.join(trash_path, name))
+    except OSError:
+        _logger.warning(
+            "Cannot move filestore of database %s to trash, removing it",
+            db, exc_info=True)
+        if os.path.exists(os.path.join(trash_path, '%s.json' % name)):
+            os.unlink(os.path.join(trash_path, '%s.json' % name))
+        shutil.rmtree(path)
+        return False
+    _logger.info("Filestore of database %s moved to trash as %s", db, name)
+    get_filestore_trash_reaper().wakeup()
+    return True
+
+
+class FilestoreTrashReaper(object):
+    """ Background remover of filestores moved to trash.
+
+        Files are removed with limited rate, to not saturate disk I/O.
+        Reaper thread runs in each worker process, but only one of them
+        removes files at a time (guarded by lock on file in trash
+        directory).
+    """
+
+    def __init__(self, trash_path, rate):
+        self.trash_path = trash_path
+        self.rate = rate
+        self.removed_files = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._thread = None
+
+    def ensure_running(self):
+        """ Start reaper thread in current process if it is not started
+        """
+        if (self._pid == os.getpid() and self._thread and
+                self._thread.is_alive()):
+            return
+        with self._lock:
+            if (self._pid == os.getpid() and self._thread and
+                    self._thread.is_alive()):
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name='yodoo-trash-reaper', daemon=True)
+            self._thread.start()
+
+    def wakeup(self):
+        self.ensure_running()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.reap()
+            except Exception:
+                _logger.error("Cannot clean filestore trash", exc_info=True)
+            self._wakeup.wait(TRASH_REAPER_INTERVAL)
+            self._wakeup.clear()
+
+    def list_entries(self):
+        """ Return list of filestores in trash (oldest first)
+
+            :return: list of dicts with keys 'name', 'db', 'trashed_at'
+                     and 'size' (size is None if unknown)
+        """
+        try:
+            names = os.listdir(self.trash_path)
+        except FileNotFoundError:
+            return []
+        entries = []
+        for name in sorted(names):
+            path = os.path.join(self.trash_path, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                with open('%s.json' % path, 'rt') as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                info = {}
+            entries.append({
+                'name': name,
+                'db': info.get('db'),
+                'trashed_at': info.get('trashed_at'),
+                'size': info.get('size'),
+            })
+        return sorted(entries, key=lambda e: e['trashed_at'] or 0)
+
+    def _remove_tree(self, path):
+        """ Remove directory tree with rate limit
+        """
+        started = time.monotonic()
+        removed = 0
+        for root, dirs, files in os.walk(path, topdown=False):
+            for fname in files:
+                try:
+                    os.unlink(os.path.join(root, fname))
+                except FileNotFoundError:
+                    continue
+                removed += 1
+                self.removed_files += 1
+                delay = removed / self.rate - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            for dname in dirs:
+                try:
+                    os.rmdir(os.path.join(root, dname))
+                except FileNotFoundError:
+                    continue
+        os.rmdir(path)
+
+    def reap(self):
+        """ Remove all filestores in trash
+        """
+        if not os.path.isdir(self.trash_path):
+            return
+        with open(os.path.join(self.trash_path, '.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Other process is cleaning trash
+                return
+            for entry in self.list_entries():
+                path = os.path.join(self.trash_path, entry['name'])
+                _logger.info(
+                    "Removing filestore %s from trash", entry['name'])
+                self._remove_tree(path)
+                if os.path.exists('%s.json' % path):
+                    os.unlink('%s.json' % path)
+
+    def get_statistic(self):
+        """ Return backlog of trash
+
+            :return: dict with keys:
+                - filestores: list of filestores in trash
+                  (see list_entries)
+                - count: number of filestores in trash
+                - size: known total size of filestores in trash
+                - rate: max number of files removed per second
+                - removed_files: number of files removed by this process
+        """
+        self.ensure_running()
+        entries = self.list_entries()
+        return {
+            'filestores': entries,
+            'count': len(entries),
+            'size': sum(e['size'] or 0 for e in entries),
+            'rate': self.rate,
+            'removed_files': self.removed_files,
+        }
+
+
+_trash_reaper = None
+_trash_reaper_lock = threading.Lock()
+
+
+def get_filestore_trash_reaper():
+    global _trash_reaper
+    if _trash_reaper is None:
+        with _trash_reaper_lock:
+            if _trash_reaper is None:
+                _trash_reaper = FilestoreTrashReaper(
+                    get_filestore_trash_path(),
+                    max(config_get_float(
+                        'yodoo_trash_reaper_rate',
+                        DEFAULT_TRASH_REAPER_RATE), 1))
+    return _trash_reaper
@@ -1,34 +1,134 @@
 import re
+import logging
+import functools
+import threading
+import collections
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
 import odoo
-from odoo.service import db
+from odoo.service import db, server
 from odoo import http
 from odoo.tools import config
+from odoo.addons.base.models import res_users
 
+from .config import config_get_int, config_get_float
 from .utils import (
     make_addons_to_be_installed,
     ensure_installing_addons_dependencies,
 )
+from .cache import CachedValue, register_cache
+from .http_decorators import invalidate_db_caches
+from .db_management import get_db_pool
+from .db_readiness import is_db_ready, mark_db_ready, rename_db_readiness
+from .jobs import get_job_runner, DEFAULT_JOB_DRAIN_TIMEOUT
+from .filestore import get_filestore_trash_reaper
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_DB_FILTER_CACHE_SIZE = 1024
+DEFAULT_LIST_DBS_CACHE_TTL = 30  # seconds
+
+# Temporary databases, that could be used by backup system
+TMP_DB_NAME_PATTERN = re.compile(r"^tmp-.*-tmp$")
 
 original_list_dbs = db.list_dbs
 original_db_filter = http.db_filter
 original_module_db_initialize = odoo.modules.db.initialize
+original_users_authenticate = res_users.Users.authenticate.__func__
+original_exp_drop = db.exp_drop
+original_exp_rename = db.exp_rename
+original_worker_http_start = server.WorkerHTTP.start
+original_worker_http_stop = server.WorkerHTTP.stop
+original_worker_http_check_limits = server.WorkerHTTP.check_limits
+original_threaded_http_spawn = server.ThreadedServer.http_spawn
+
+
+def _list_dbs_filtered():
+    return tuple(
+        d for d in original_list_dbs(True)
+        if not TMP_DB_NAME_PATTERN.match(d))
+
+
+_list_dbs_cache = CachedValue(
+    'list_dbs',
+    _list_dbs_filtered,
+    ttl=config_get_float(
+        'yodoo_list_dbs_cache_ttl', DEFAULT_LIST_DBS_CACHE_TTL),
+    db_lifecycle=True)
 
 
 def list_dbs(force=False):
     # Modify list_db method to ignore temporary databases, that could be used
-    # by backup system.
-    res = original_list_dbs(force)
-    db_name_pattern = r"^tmp-.*-tmp$"
-    return list(filter(lambda i: not (re.match(db_name_pattern, i)), res))
+    # by backup system. Result is cached, and cache is invalidated when
+    # databases are created, dropped, renamed, etc.
+    if not config['list_db'] and not force:
+        raise odoo.exceptions.AccessDenied()
+    return list(_list_dbs_cache.get())
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_db_header(db_header):
+    return re.compile(db_header)
+
+
+class DbFilterIndex(object):
+    """ Index of databases available for (host, X-Odoo-Dbfilter header).
+
+        Result of filtering is cached in LRU cache, and whole cache is
+        dropped when list of databases changes.
+    """
+
+    def __init__(self, max_size):
+        self.name = 'db_filter'
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._dbs = None
+        self._results = collections.OrderedDict()
+
+    def filter(self, dbs, httprequest):
+        key = (
+            httprequest.environ.get('HTTP_HOST', ''),
+            httprequest.environ.get('HTTP_X_ODOO_DBFILTER'),
+        )
+        dbs = tuple(dbs)
+        with self._lock:
+            if dbs != self._dbs:
+                self._dbs = dbs
+                self._results.clear()
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return list(result)
+            self.misses += 1
+
+        result = original_db_filter(list(dbs), httprequest=httprequest)
+        if key[1]:
+            pattern = _compile_db_header(key[1])
+            result = [db for db in result if pattern.match(db)]
+
+        with self._lock:
+            if dbs == self._dbs:
+                self._results[key] = tuple(result)
+                while len(self._results) > self.max_size:
+                    self._results.popitem(last=False)
+        return result
+
+
+db_filter_index = register_cache(DbFilterIndex(
+    config_get_int(
+        'yodoo_db_filter_cache_size', DEFAULT_DB_FILTER_CACHE_SIZE)))
 
 
 def db_filter(dbs, httprequest=None):
     httprequest = httprequest or http.request.httprequest
-    dbs = original_db_filter(dbs, httprequest=httprequest)
-    db_header = httprequest.environ.get('HTTP_X_ODOO_DBFILTER')
-    if not db_header:
-        return dbs
-    return [db for db in dbs if re.match(db_header, db)]
+    return db_filter_index.filter(dbs, httprequest)
 
 
 def module_db_initialize(cr):
@@ -44,6 +144,103 @@ def module_db_initialize(cr):
     ensure_installing_addons_dependencies(cr)
 
 
+def users_authenticate(cls, db, login, password, user_agent_env):
+    # Do not allow logins to database, while it is being restored, or
+    # addons are being installed or updated in background after restore
+    if not is_db_ready(db):
+        _logger.info(
+            "Login to database %s denied: database is being restored "
+            "or reconciled after restore", db)
+        raise odoo.exceptions.AccessDenied()
+    return original_users_authenticate(
+        cls, db, login, password, user_agent_env)
+
+
+def exp_drop(db_name):
+    # Forget readiness state of database dropped via standard database
+    # manager, so new database with same name is not blocked
+    res = original_exp_drop(db_name)
+    if res:
+        try:
+            mark_db_ready(db_name)
+        except Exception:
+            _logger.error(
+                "Cannot clear readiness marker of dropped database %s",
+                db_name, exc_info=True)
+    return res
+
+
+def exp_rename(old_name, new_name):
+    res = original_exp_rename(old_name, new_name)
+    rename_db_readiness(old_name, new_name)
+    return res
+
+
+def _start_background_services():
+    # Threads are not inherited by child processes, thus background
+    # services have to be started in each process, that serves requests
+    for name, get_service in [('job runner', get_job_runner),
+                              ('database pool filler', get_db_pool),
+                              ('filestore trash reaper',
+                               get_filestore_trash_reaper)]:
+        try:
+            get_service().ensure_running()
+        except Exception:
+            _logger.error("Cannot start %s", name, exc_info=True)
+
+
+def _relax_worker_limits(worker):
+    # Jobs are executed in threads of worker, so CPU time and memory used
+    # by them are counted in limits of worker (limit_time_cpu,
+    # limit_memory_hard), and master kills worker, that does not ping
+    # watchdog for limit_time_real (for example, while it processes long
+    # request). Thus, while jobs are running, these limits are lifted, and
+    # watchdog is notified from runner thread.
+    if resource is not None:
+        for limit in (resource.RLIMIT_CPU, resource.RLIMIT_AS):
+            soft, hard = resource.getrlimit(limit)
+            if soft != hard:
+                resource.setrlimit(limit, (hard, hard))
+    worker.multi.pipe_ping(worker.watchdog_pipe)
+
+
+def worker_http_start(self):
+    original_worker_http_start(self)
+    get_job_runner().keepalive = functools.partial(
+        _relax_worker_limits, self)
+    _start_background_services()
+
+
+def worker_http_check_limits(self):
+    # Limits are set again before each request, so they have to be lifted
+    # again if jobs are still running. Worker, that exceeded
+    # limit_memory_soft or limit_request, is stopped as usual, but waits
+    # for its jobs before exit (see worker_http_stop).
+    original_worker_http_check_limits(self)
+    if get_job_runner().has_running_jobs():
+        _relax_worker_limits(self)
+
+
+def worker_http_stop(self):
+    # Worker is stopped (for example, it is recycled after limit_request),
+    # so wait for jobs, that are executed by it, to finish. Watchdog of
+    # master process is notified, that worker is alive while waiting.
+    def ping():
+        self.check_limits()
+        self.multi.pipe_ping(self.watchdog_pipe)
+
+    get_job_runner().drain(
+        config_get_float(
+            'yodoo_job_drain_timeout', DEFAULT_JOB_DRAIN_TIMEOUT),
+        ping=ping)
+    original_worker_http_stop(self)
+
+
+def threaded_http_spawn(self):
+    original_threaded_http_spawn(self)
+    _start_background_services()
+
+
 def _post_load_hook():
     if config.get('yodoo_db_filter', False):
         http.db_filter = db_filter
@@ -51,3 +248,27 @@ def _post_load_hook():
     # Make autoinstall of yodoo_client
     odoo.modules.db.initialize = module_db_initialize
     odoo.service.db.list_dbs = list_dbs
+
+    # Block logins to databases, that are not ready yet. This is done on
+    # server level, because yodoo_client could be not installed in
+    # restored database yet.
+    res_users.Users.authenticate = classmethod(users_authenticate)
+
+    # Start background services (job runner, database pool filler,
+    # filestore trash reaper) when server starts serving requests,
+    # instead of waiting for first request, that uses them. Limits of
+    # worker are lifted while jobs are running in it.
+    server.WorkerHTTP.start = worker_http_start
+    server.WorkerHTTP.stop = worker_http_stop
+    server.WorkerHTTP.check_limits = worker_http_check_limits
+    server.ThreadedServer.http_spawn = threaded_http_spawn
+
+    db.exp_drop = exp_drop
+    db.exp_rename = exp_rename
+
+    # Ensure caches that depend on list of databases are invalidated
+    # when databases are managed not via yodoo API (for example via
+    # standard odoo database manager)
+    for fname in ('_create_empty_database', 'exp_duplicate_database',
+                  'exp_drop', 'exp_rename', 'restore_db'):
+        setattr(db, fname, invalidate_db_caches(getattr(db, fname)))
@@ -4,13 +4,14 @@ from functools import wraps
 import werkzeug
 
 from odoo import http
-from odoo.service.db import exp_db_exist
 
 from .utils import (
-    check_saas_client_token,
+    db_exists,
+    get_saas_token_verifier,
     str_filter_falsy,
 )
 from .exceptions import DatabaseNotExists
+from .cache import invalidate_db_lifecycle_caches
 
 _logger = logging.getLogger(__name__)
 
@@ -25,7 +26,26 @@ def require_saas_token(func):
         token_hash = http.request.httprequest.environ.get(
             'HTTP_X_YODOO_TOKEN',
             kwargs.get('token_hash', None))
-        check_saas_client_token(token_hash)
+        get_saas_token_verifier().check(token_hash)
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def reject_token_in_query(func):
+    """
+    Decorate the controller method, that does not accept SaaS token
+    in query string, because URLs are written to logs of web servers
+    and proxies. Token have to be passed in X-YODOO-TOKEN header or
+    in body of POST request.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if 'token_hash' in http.request.httprequest.args:
+            raise werkzeug.exceptions.BadRequest(
+                "Token must not be passed in query string. "
+                "Use X-YODOO-TOKEN header or body of POST request.")
         return func(*args, **kwargs)
 
     return wrapper
@@ -33,7 +53,8 @@ def require_saas_token(func):
 
 def require_db_param(func):
     """
-    Decorate the controller method that requires exp_db_exist.
+    Decorate the controller method that requires existing database
+    passed as 'db' param.
     """
 
     @wraps(func)
@@ -41,7 +62,7 @@ def require_db_param(func):
         db = kwargs.get('db', None)
         if not db:
             raise werkzeug.exceptions.BadRequest("Database not specified")
-        if not exp_db_exist(db):
+        if not db_exists(db):
             _logger.info(
                 'Database %s is not found.', db)
             raise DatabaseNotExists()
@@ -50,6 +71,23 @@ def require_db_param(func):
     return wrapper
 
 
+def invalidate_db_caches(func):
+    """
+    Decorate the controller method (or function) that changes list of
+    databases (create, drop, rename, etc). Caches that depend on list of
+    databases will be invalidated after call, even if it failed.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            invalidate_db_lifecycle_caches()
+
+    return wrapper
+
+
 def wrap_str_falsy_values(*field_names):
     """ check the data passed to method and converf string falsy values
         to correct python valus:
@@ -0,0 +1,531 @@
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+import contextlib
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo import sql_db
+from odoo.tools import config
+
+from .config import config_get_int
+
+JOB_STATE_QUEUED = 'queued'
+JOB_STATE_RUNNING = 'running'
+JOB_STATE_DONE = 'done'
+JOB_STATE_FAILED = 'failed'
+
+# Max number of jobs running at same time on this node
+DEFAULT_JOB_WORKERS = 2
+
+# How often job runner checks for new jobs and updates heartbeat of
+# jobs owned by this process (seconds)
+JOB_POLL_INTERVAL = 5
+
+# Jobs, which owner process did not update heartbeat for this time
+# (seconds), are considered as interrupted (for example, worker was
+# killed). Interrupted jobs of operations, that are safe to retry, are
+# queued again, other ones are marked as failed
+JOB_HEARTBEAT_TIMEOUT = 60
+
+# Max number of attempts to run job, that is safe to retry
+JOB_MAX_ATTEMPTS = 3
+
+# Max time (seconds) worker waits for its jobs to finish, when it stops
+DEFAULT_JOB_DRAIN_TIMEOUT = 600
+
+# Finished jobs are removed after this number of days
+JOB_HISTORY_DAYS = 30
+
+# Min interval between progress updates of job in database (seconds)
+JOB_PROGRESS_INTERVAL = 2
+
+# Namespace for advisory locks used to serialize claiming of jobs
+JOB_ADVISORY_LOCK_NAMESPACE = 0x59D0
+
+_logger = logging.getLogger(__name__)
+
+_job_operations = {}
+_job_retry_policies = {}
+
+
+def register_job_operation(name, retry=False):
+    """ Decorator to register function as operation, that could be
+        run as job. Function receives Job instance as first argument,
+        and job params as keyword arguments. Returned value (have to be
+        json-serializable) is saved as job result.
+
+        :param retry: True if job of this operation could be run again,
+            when process executing it was interrupted, or callable, that
+            receives params of job and decides if it could be run again
+    """
+    def decorator(func):
+        _job_operations[name] = func
+        _job_retry_policies[name] = retry
+        return func
+    return decorator
+
+
+def get_job_operation(name):
+    return _job_operations[name]
+
+
+def is_job_retryable(operation, params):
+    """ Check if interrupted job of operation could be run again
+    """
+    retry = _job_retry_policies.get(operation, False)
+    if callable(retry):
+        return bool(retry(params))
+    return bool(retry)
+
+
+def get_node_name():
+    """ Return name of this node. Jobs are executed on node where
+        they were created, because they use local filestore and files.
+    """
+    return config.get('yodoo_node_name') or socket.gethostname()
+
+
+@contextlib.contextmanager
+def _postgres_cursor():
+    with closing(sql_db.db_connect('postgres').cursor()) as cr:
+        yield cr
+        cr.commit()
+
+
+class Job(object):
+    """ Handle of running job, used by operation to report progress
+    """
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self._last_update = 0
+
+    def set_progress(self, progress=None, message=None, force=False):
+        """ Update progress of job
+
+            :param float progress: progress from 0 to 1, or None if unknown
+            :param str message: description of current step of operation
+            :param bool force: update progress even if previous update
+                               was made less than JOB_PROGRESS_INTERVAL ago
+        """
+        now = time.monotonic()
+        if not force and now - self._last_update < JOB_PROGRESS_INTERVAL:
+            return
+        self._last_update = now
+        with _postgres_cursor() as cr:
+            cr.execute("""
+                UPDATE yodoo_client_job
+                SET progress = %s,
+                    message = COALESCE(%s, message)
+                WHERE id = %s
+            """, (progress, message, self.id))
+
+
+def report_progress(job, progress=None, message=None, force=True):
+    """ Report progress of operation if it is running as job.
+        Operations could be run synchronously with job=None.
+    """
+    if job is not None:
+        job.set_progress(progress, message, force=force)
+
+
+class JobRunner(object):
+    """ Executes jobs of this node, stored in table 'yodoo_client_job'
+        of 'postgres' database.
+
+        Each process (worker) has its own runner with thread pool, and
+        total number of jobs running on node is limited by
+        'yodoo_job_workers' option: jobs are claimed under advisory lock
+        after checking number of running jobs on node.
+
+        Running jobs are bound to process, that executes them. This
+        process regularly updates heartbeat of its jobs, so if process
+        dies, its jobs are detected by other processes: jobs of
+        operations, that are safe to retry, are queued again (at most
+        JOB_MAX_ATTEMPTS times), other ones are marked as failed.
+        Queued jobs are executed by any process of node, except jobs with
+        secret params (kept only in memory of process, that created job),
+        which are pinned to that process.
+
+        When worker stops (for example, it is recycled after
+        limit_request), it stops claiming new jobs, and waits until its
+        running and pinned jobs are finished (see drain).
+
+        While jobs are running in process, runner thread calls 'keepalive'
+        function (if set) when jobs are claimed and every
+        JOB_POLL_INTERVAL seconds. It is used by prefork workers to
+        exempt jobs from limits of worker (see hooks).
+    """
+
+    def __init__(self, node, max_workers):
+        self.node = node
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._thread = None
+        self._executor = None
+        self._running = set()
+        self._secrets = {}
+        self._draining = False
+        self._table_ready = False
+        self.keepalive = None
+
+    @property
+    def owner(self):
+        return '%s:%s' % (self.node, os.getpid())
+
+    def _ensure_table(self):
+        if self._table_ready:
+            return
+        with _postgres_cursor() as cr:
+            # Serialize creation of table between processes
+            cr.execute(
+                "SELECT pg_advisory_xact_lock(%s, 0)",
+                (JOB_ADVISORY_LOCK_NAMESPACE,))
+            cr.execute("""
+                CREATE TABLE IF NOT EXISTS yodoo_client_job (
+                    id VARCHAR(32) PRIMARY KEY,
+                    operation VARCHAR NOT NULL,
+                    params JSONB NOT NULL,
+                    state VARCHAR NOT NULL,
+                    node VARCHAR NOT NULL,
+                    owner VARCHAR,
+                    progress DOUBLE PRECISION,
+                    message TEXT,
+                    result JSONB,
+                    error TEXT,
+                    created_at TIMESTAMP NOT NULL,
+                    started_at TIMESTAMP,
+                    finished_at TIMESTAMP,
+                    heartbeat_at TIMESTAMP,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    pinned BOOLEAN NOT NULL DEFAULT false
+                );
+                ALTER TABLE yodoo_client_job
+                    ADD COLUMN IF NOT EXISTS
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS
+                        pinned BOOLEAN NOT NULL DEFAULT false;
+                CREATE INDEX IF NOT EXISTS yodoo_client_job_node_state_idx
+                    ON yodoo_client_job (node, state, created_at);
+            """)
+        self._table_ready = True
+
+    def ensure_running(self):
+        """ Start runner thread in current process if it is not started.
+            Have to be called after fork, because threads are not
+            inherited by child processes.
+        """
+        if (self._pid == os.getpid() and self._thread and
+                self._thread.is_alive()):
+            return
+        with self._lock:
+            if (self._pid == os.getpid() and self._thread and
+                    self._thread.is_alive()):
+                return
+            self._ensure_table()
+            if self._pid != os.getpid():
+                self._running = set()
+                self._secrets = {}
+                self._draining = False
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='yodoo-job')
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name='yodoo-job-runner', daemon=True)
+            self._thread.start()
+
+    def enqueue(self, operation, params, secrets=None):
+        """ Create new job
+
+            :param str operation: name of registered operation
+            :param dict params: json-serializable params of operation,
+                                stored in database
+            :param dict secrets: params, that must not be stored in
+                                 database. If set, job is pinned to this
+                                 process: it could be executed only by
+                                 this process, and is not retried if
+                                 process is interrupted.
+            :return: ID of created job
+        """
+        if operation not in _job_operations:
+            raise ValueError("Unknown job operation: %s" % operation)
+        self.ensure_running()
+        job_id = uuid.uuid4().hex
+        pinned = bool(secrets)
+        if pinned:
+            self._secrets[job_id] = secrets
+        with _postgres_cursor() as cr:
+            cr.execute("""
+                INSERT INTO yodoo_client_job (
+                    id, operation, params, state, node, owner, pinned,
+                    created_at, heartbeat_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s,
+                        now() at time zone 'UTC',
+                        now() at time zone 'UTC')
+            """, (job_id, operation, json.dumps(params), JOB_STATE_QUEUED,
+                  self.node, self.owner if pinned else None, pinned))
+        _logger.info("Job %s (%s) queued", job_id, operation)
+        self._wakeup.set()
+        return job_id
+
+    def has_running_jobs(self):
+        """ Check if jobs are running in current process
+        """
+        return self._pid == os.getpid() and bool(self._running)
+
+    def _run(self):
+        last_cleanup = 0
+        while True:
+            try:
+                self._update_heartbeat()
+                if time.monotonic() - last_cleanup > 3600:
+                    self._cleanup()
+                    last_cleanup = time.monotonic()
+                self._start_jobs()
+            except Exception:
+                _logger.error("Job runner failed", exc_info=True)
+            self._wakeup.wait(JOB_POLL_INTERVAL)
+            self._wakeup.clear()
+
+    def _start_jobs(self):
+        jobs = []
+        while len(self._running) + len(jobs) < self.max_workers:
+            job = self._claim()
+            if not job:
+                break
+            jobs.append(job)
+        if (jobs or self._running) and self.keepalive is not None:
+            try:
+                self.keepalive()
+            except Exception:
+                _logger.error("Job runner keepalive failed", exc_info=True)
+        for job in jobs:
+            self._running.add(job[0])
+            self._executor.submit(self._execute, *job)
+
+    def _update_heartbeat(self):
+        with _postgres_cursor() as cr:
+            cr.execute("""
+                UPDATE yodoo_client_job
+                SET heartbeat_at = now() at time zone 'UTC'
+                WHERE owner = %s
+                  AND state IN %s
+            """, (self.owner, (JOB_STATE_QUEUED, JOB_STATE_RUNNING)))
+            cr.execute("""
+                SELECT id, operation, params, owner, pinned, attempts
+                FROM yodoo_client_job
+                WHERE node = %s
+                  AND owner IS NOT NULL
+                  AND state IN %s
+                  AND heartbeat_at < (now() at time zone 'UTC') -
+                      make_interval(secs => %s)
+                FOR UPDATE SKIP LOCKED
+            """, (self.node, (JOB_STATE_QUEUED, JOB_STATE_RUNNING),
+                  JOB_HEARTBEAT_TIMEOUT))
+            for (job_id, operation, params, owner,
+                    pinned, attempts) in cr.fetchall():
+                if (not pinned and attempts < JOB_MAX_ATTEMPTS and
+                        is_job_retryable(operation, params)):
+                    _logger.warning(
+                        "Job %s (%s) interrupted: process %s stopped. "
+                        "Job is queued again.", job_id, operation, owner)
+                    cr.execute("""
+                        UPDATE yodoo_client_job
+                        SET state = %s,
+                            owner = NULL,
+                            progress = NULL,
+                            message = 'Job interrupted: process executing '
+                                      || 'job ' || owner || ' stopped. '
+                                      || 'Queued again.'
+                        WHERE id = %s
+                    """, (JOB_STATE_QUEUED, job_id))
+                    continue
+                _logger.warning(
+                    "Job %s (%s) interrupted: process %s stopped. "
+                    "Job is marked as failed.", job_id, operation, owner)
+                cr.execute("""
+                    UPDATE yodoo_client_job
+                    SET state = %s,
+                        error = 'Job interrupted: process executing job '
+                                || owner || ' stopped',
+                        finished_at = now() at time zone 'UTC'
+                    WHERE id = %s
+                """, (JOB_STATE_FAILED, job_id))
+
+    def _cleanup(self):
+        with _postgres_cursor() as cr:
+            cr.execute("""
+                DELETE FROM yodoo_client_job
+                WHERE state IN %s
+                  AND finished_at < (now() at time zone 'UTC') -
+                      make_interval(days => %s)
+            """, ((JOB_STATE_DONE, JOB_STATE_FAILED), JOB_HISTORY_DAYS))
+
+    def _claim(self):
+        """ Take next queued job of this node, if number of jobs
+            running on node is below limit.
+
+            :return: tuple(job_id, operation, params) or None
+        """
+        with _postgres_cursor() as cr:
+            cr.execute(
+                "SELECT pg_advisory_xact_lock(%s, hashtext(%s))",
+                (JOB_ADVISORY_LOCK_NAMESPACE, self.node))
+            cr.execute("""
+                SELECT count(*)
+                FROM yodoo_client_job
+                WHERE node = %s AND state = %s
+            """, (self.node, JOB_STATE_RUNNING))
+            if cr.fetchone()[0] >= self.max_workers:
+                return None
+            # While process is stopping, only jobs pinned to it are
+            # claimed, other jobs are left for other processes
+            cr.execute("""
+                SELECT id, operation, params
+                FROM yodoo_client_job
+                WHERE node = %s
+                  AND state = %s
+                  AND (owner IS NULL OR owner = %s)
+                  AND (pinned OR NOT %s)
+                ORDER BY created_at
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            """, (self.node, JOB_STATE_QUEUED, self.owner, self._draining))
+            row = cr.fetchone()
+            if not row:
+                return None
+            cr.execute("""
+                UPDATE yodoo_client_job
+                SET state = %s,
+                    owner = %s,
+                    attempts = attempts + 1,
+                    started_at = now() at time zone 'UTC',
+                    heartbeat_at = now() at time zone 'UTC'
+                WHERE id = %s
+            """, (JOB_STATE_RUNNING, self.owner, row[0]))
+        return row
+
+    def _finish(self, job_id, state, result=None, error=None):
+        with _postgres_cursor() as cr:
+            cr.execute("""
+                UPDATE yodoo_client_job
+                SET state = %s,
+                    result = %s,
+                    error = %s,
+                    progress = CASE WHEN %s THEN 1.0 ELSE progress END,
+                    finished_at = now() at time zone 'UTC'
+                WHERE id = %s
+            """, (state, json.dumps(result), error,
+                  state == JOB_STATE_DONE, job_id))
+
+    def _execute(self, job_id, operation, params):
+        secrets = self._secrets.pop(job_id, {})
+        _logger.info("Job %s (%s) started", job_id, operation)
+        try:
+            result = _job_operations[operation](
+                Job(job_id), **dict(params, **secrets))
+        except Exception as e:
+            _logger.error(
+                "Job %s (%s) failed", job_id, operation, exc_info=True)
+            self._finish(
+                job_id, JOB_STATE_FAILED,
+                error=getattr(e, 'description', None) or str(e))
+        else:
+            _logger.info("Job %s (%s) done", job_id, operation)
+            self._finish(job_id, JOB_STATE_DONE, result=result)
+        finally:
+            self._running.discard(job_id)
+            self._wakeup.set()
+
+    def drain(self, timeout, ping=None):
+        """ Stop claiming new jobs in this process, and wait until jobs
+            running in it, and queued jobs pinned to it, are finished.
+            Called when worker process stops.
+
+            :param float timeout: max time to wait (seconds)
+            :param callable ping: function called every second while
+                                  waiting (for example, to notify
+                                  watchdog, that process is alive)
+            :return: True if all jobs of this process are finished
+        """
+        if self._pid != os.getpid() or self._thread is None:
+            return True
+        self._draining = True
+        self._wakeup.set()
+        deadline = time.monotonic() + timeout
+        if self._running or self._secrets:
+            _logger.info(
+                "Waiting for jobs of process %s to finish", self.owner)
+        while self._running or self._secrets:
+            if time.monotonic() > deadline:
+                _logger.warning(
+                    "Process %s stopped while its jobs are not finished",
+                    self.owner)
+                return False
+            if ping is not None:
+                ping()
+            time.sleep(1)
+        return True
+
+    def _fetch_job_info(self, cr):
+        row = cr.dictfetchone()
+        if not row:
+            return None
+        for field in ('created_at', 'started_at', 'finished_at'):
+            if row[field]:
+                row[field] = row[field].isoformat()
+        return row
+
+    def get_job_info(self, job_id):
+        """ Return info about job, or None if there is no such job
+        """
+        self.ensure_running()
+        with _postgres_cursor() as cr:
+            cr.execute("""
+                SELECT id, operation, state, node, progress, message,
+                       result, error, created_at, started_at, finished_at
+                FROM yodoo_client_job
+                WHERE id = %s
+            """, (job_id,))
+            return self._fetch_job_info(cr)
+
+    def find_last_job_info(self, operation, **params):
+        """ Return info about last job of operation, created with
+            given params, or None if there is no such job
+        """
+        self.ensure_running()
+        with _postgres_cursor() as cr:
+            cr.execute("""
+                SELECT id, operation, state, node, progress, message,
+                       result, error, created_at, started_at, finished_at
+                FROM yodoo_client_job
+                WHERE operation = %s
+                  AND params @> %s::jsonb
+                ORDER BY created_at DESC
+                LIMIT 1
+            """, (operation, json.dumps(params)))
+            return self._fetch_job_info(cr)
+
+
+_job_runner = None
+_job_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    global _job_runner
+    if _job_runner is None:
+        with _job_runner_lock:
+            if _job_runner is None:
+                _job_runner = JobRunner(
+                    get_node_name(),
+                    max(config_get_int(
+                        'yodoo_job_workers', DEFAULT_JOB_WORKERS), 1))
+    return _job_runner
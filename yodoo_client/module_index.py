@@ -0,0 +1,171 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import collections
+
+import odoo
+from odoo.modules import module
+
+from .utils import (
+    get_yodoo_data_dir,
+    ModuleManifestEncoder,
+)
+
+MODULE_INDEX_FILE_NAME = 'module_index.json'
+
+_logger = logging.getLogger(__name__)
+
+AddonsManifestIndexState = collections.namedtuple(
+    'AddonsManifestIndexState', ['manifests', 'body', 'etag'])
+
+
+class AddonsManifestIndex(object):
+    """ Index of manifests of all addons available on disk.
+
+        Index is stored in data_dir, and on refresh only manifests
+        of addons which manifest or README files modification time changed
+        are parsed again (odoo uses README as description of addon, if
+        description is not set in manifest). So, refresh of index requires
+        only listing of addons paths and few stat calls per addon.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = None
+        self._signature = None
+        self._state = None
+
+    @staticmethod
+    def _get_mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _iter_addons(self):
+        """ Yield tuples (module_name, module_path, mtimes)
+            for addons available in addons paths, where mtimes is list
+            of modification times of manifest and README files (None for
+            README files that do not exist).
+            If same addon present in multiple addons paths, then only
+            first one is used (same way as odoo does).
+        """
+        seen = set()
+        for addons_path in odoo.addons.__path__:
+            try:
+                entries = list(os.scandir(addons_path))
+            except OSError:
+                _logger.warning(
+                    "addons path does not exist: %s", addons_path)
+                continue
+            for entry in entries:
+                if entry.name in seen or not entry.is_dir():
+                    continue
+                for manifest_name in module.MANIFEST_NAMES:
+                    try:
+                        stat = os.stat(
+                            os.path.join(entry.path, manifest_name))
+                    except OSError:
+                        continue
+                    seen.add(entry.name)
+                    yield entry.name, entry.path, (
+                        [stat.st_mtime_ns] +
+                        [self._get_mtime(os.path.join(entry.path, name))
+                         for name in module.README])
+                    break
+
+    def _load(self):
+        try:
+            with open(self.path, 'rt') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            _logger.warning(
+                "Cannot read addons manifest index %s. It will be rebuilt.",
+                self.path, exc_info=True)
+            return {}
+
+    def _save(self, entries):
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp_path, 'wt') as f:
+                json.dump(entries, f, cls=ModuleManifestEncoder)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            _logger.warning(
+                "Cannot save addons manifest index %s",
+                self.path, exc_info=True)
+
+    def refresh(self):
+        """ Ensure index is up to date with addons on disk
+
+            :return: AddonsManifestIndexState
+        """
+        addons = sorted(self._iter_addons())
+        signature = tuple(addons)
+        if signature == self._signature:
+            return self._state
+
+        with self._lock:
+            if signature == self._signature:
+                return self._state
+
+            if self._entries is None:
+                self._entries = self._load()
+
+            entries = {}
+            changed = set(self._entries) != {a[0] for a in addons}
+            for name, path, mtimes in addons:
+                entry = self._entries.get(name)
+                if (entry and entry['path'] == path and
+                        entry.get('mtimes') == mtimes):
+                    entries[name] = entry
+                    continue
+                manifest = module.load_information_from_description_file(
+                    name, path)
+                manifest['auto_install'] = bool(manifest['auto_install'])
+                # Normalize manifest to json-compatible representation
+                manifest = json.loads(
+                    json.dumps(manifest, cls=ModuleManifestEncoder))
+                entries[name] = {
+                    'path': path,
+                    'mtimes': mtimes,
+                    'manifest': manifest,
+                }
+                changed = True
+
+            if changed:
+                self._save(entries)
+
+            manifests = {
+                name: entry['manifest'] for name, entry in entries.items()}
+            body = json.dumps(manifests, sort_keys=True).encode('utf-8')
+            self._entries = entries
+            self._state = AddonsManifestIndexState(
+                manifests=manifests,
+                body=body,
+                etag=hashlib.sha256(body).hexdigest())
+            self._signature = signature
+        return self._state
+
+
+_addons_manifest_index = None
+_addons_manifest_index_lock = threading.Lock()
+
+
+def get_addons_manifest_index():
+    """ Return up to date state of addons manifest index
+
+        :return: AddonsManifestIndexState
+    """
+    global _addons_manifest_index
+    if _addons_manifest_index is None:
+        with _addons_manifest_index_lock:
+            if _addons_manifest_index is None:
+                _addons_manifest_index = AddonsManifestIndex(
+                    os.path.join(get_yodoo_data_dir(), MODULE_INDEX_FILE_NAME))
+    return _addons_manifest_index.refresh()
@@ -0,0 +1,245 @@
+import os
+import math
+import time
+import zlib
+import array
+import fcntl
+import struct
+import logging
+import threading
+
+from .config import config_get_float, config_get_int
+from .utils import (
+    get_yodoo_data_dir,
+    prepare_server_fast_statistic_data,
+)
+
+DEFAULT_SAMPLE_INTERVAL = 5  # seconds
+DEFAULT_SAMPLE_HISTORY = 720  # samples (1 hour with default interval)
+
+# File in yodoo data dir, where history of samples is stored
+SAMPLE_HISTORY_FILE_NAME = 'stat_history.bin'
+
+# Header of history file: magic, capacity, number of fields, checksum of
+# names of fields, position of next sample, number of samples
+_HEADER = struct.Struct('<8sIIIQQ')
+_HEADER_MAGIC = b'YDSTAT01'
+
+_logger = logging.getLogger(__name__)
+
+
+class ServerStatSampler(object):
+    """ Background sampler of fast server statistics.
+
+        Samples are stored in fixed-size ring buffer in file in yodoo data
+        dir, thus memory and disk usage does not depend on uptime, and
+        history is shared by all workers of server: each request gets same
+        history, regardless of worker, that processed it. Missing values
+        (None) are stored as NaN.
+
+        Sampler thread runs in each worker, but only one of them (that holds
+        lock on '<history file>.lock') collects samples at a time. When this
+        worker exits, other one takes over.
+    """
+
+    def __init__(self, path, interval, capacity):
+        if interval <= 0:
+            raise ValueError(
+                "Sample interval have to be positive: %r" % interval)
+        if capacity < 1:
+            raise ValueError(
+                "Sample history have to be positive: %r" % capacity)
+        self.path = path
+        self.interval = interval
+        self.capacity = capacity
+        self.fields = ['timestamp'] + list(
+            prepare_server_fast_statistic_data())
+        self._fields_crc = zlib.crc32(','.join(self.fields).encode('utf-8'))
+        self._row_size = len(self.fields) * 8
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _pack_header(self, pos, count):
+        return _HEADER.pack(
+            _HEADER_MAGIC, self.capacity, len(self.fields), self._fields_crc,
+            pos, count)
+
+    def _read_header(self, fd):
+        """ Return tuple(pos, count) or None if file is not a history
+            with same capacity and fields
+        """
+        data = os.pread(fd, _HEADER.size, 0)
+        if len(data) != _HEADER.size:
+            return None
+        magic, capacity, nfields, fields_crc, pos, count = _HEADER.unpack(
+            data)
+        if (magic != _HEADER_MAGIC or capacity != self.capacity or
+                nfields != len(self.fields) or
+                fields_crc != self._fields_crc or
+                pos >= capacity or count > capacity):
+            return None
+        return pos, count
+
+    def _init_file(self, fd):
+        """ Prepare empty history in file, if it contains history with
+            other capacity or fields. Called with exclusive lock held.
+        """
+        if self._read_header(fd) is not None:
+            return
+        _logger.info("Initializing server statistic history %s", self.path)
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, self._pack_header(0, 0), 0)
+        os.ftruncate(fd, _HEADER.size + self._row_size * self.capacity)
+
+    def record(self, fd, timestamp, data):
+        """ Write single sample to ring buffer in file 'fd'
+        """
+        row = array.array('d', [timestamp])
+        for field in self.fields[1:]:
+            value = data[field]
+            row.append(math.nan if value is None else value)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            self._init_file(fd)
+            pos, count = self._read_header(fd)
+            os.pwrite(fd, row.tobytes(), _HEADER.size + pos * self._row_size)
+            os.pwrite(fd, self._pack_header(
+                (pos + 1) % self.capacity,
+                min(count + 1, self.capacity)), 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def get_samples(self, since=None):
+        """ Return list of samples (oldest first) recorded after 'since'
+
+            :param float since: unix timestamp
+            :return: list of rows, values ordered same as self.fields
+        """
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return []
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            header = self._read_header(fd)
+            if header is None:
+                return []
+            pos, count = header
+            data = os.pread(
+                fd, self._row_size * self.capacity, _HEADER.size)
+        finally:
+            os.close(fd)
+
+        values = array.array('d')
+        values.frombytes(data[:len(data) - len(data) % 8])
+        nfields = len(self.fields)
+        start = (pos - count) % self.capacity
+        rows = []
+        for i in range(count):
+            offset = ((start + i) % self.capacity) * nfields
+            row = values[offset:offset + nfields]
+            if len(row) != nfields:
+                break
+            if since is not None and row[0] <= since:
+                continue
+            rows.append([None if math.isnan(v) else v for v in row])
+        return rows
+
+    def is_running(self):
+        return bool(
+            self._pid == os.getpid() and
+            self._thread is not None and
+            self._thread.is_alive())
+
+    def ensure_running(self):
+        """ Start sampler thread if it is not running in current process.
+            Threads do not survive fork, so this have to be checked
+            in each worker process.
+        """
+        if self.is_running():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name='yodoo-stat-sampler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        # Lock file is kept open while process is alive, thus lock is
+        # released only when process exits
+        lock_fd = os.open(
+            self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        while True:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Other worker collects samples
+                time.sleep(self.interval)
+                continue
+            break
+
+        _logger.info(
+            "Server statistic sampler started (interval=%ss, history=%s)",
+            self.interval, self.capacity)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        while True:
+            started = time.time()
+            try:
+                self.record(
+                    fd, started, prepare_server_fast_statistic_data())
+            except Exception:
+                _logger.error(
+                    "Cannot collect server statistic sample", exc_info=True)
+            time.sleep(max(self.interval - (time.time() - started), 0))
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def _get_sampler_config():
+    interval = config_get_float(
+        'yodoo_stat_sample_interval', DEFAULT_SAMPLE_INTERVAL)
+    if interval <= 0:
+        _logger.warning(
+            "Config option yodoo_stat_sample_interval have to be positive, "
+            "using default %r", DEFAULT_SAMPLE_INTERVAL)
+        interval = DEFAULT_SAMPLE_INTERVAL
+    capacity = config_get_int(
+        'yodoo_stat_sample_history', DEFAULT_SAMPLE_HISTORY)
+    if capacity < 1:
+        _logger.warning(
+            "Config option yodoo_stat_sample_history have to be positive, "
+            "using default %r", DEFAULT_SAMPLE_HISTORY)
+        capacity = DEFAULT_SAMPLE_HISTORY
+    return interval, capacity
+
+
+def get_server_stat_sampler():
+    """ Return running sampler for current process
+    """
+    global _sampler
+    if _sampler is None:
+        with _sampler_lock:
+            if _sampler is None:
+                interval, capacity = _get_sampler_config()
+                _sampler = ServerStatSampler(
+                    os.path.join(
+                        get_yodoo_data_dir(), SAMPLE_HISTORY_FILE_NAME),
+                    interval=interval,
+                    capacity=capacity)
+    _sampler.ensure_running()
+    return _sampler
+
+
+def prepare_server_stat_history_data(since=None):
+    sampler = get_server_stat_sampler()
+    return {
+        'interval': sampler.interval,
+        'capacity': sampler.capacity,
+        'fields': sampler.fields,
+        'samples': sampler.get_samples(since),
+    }
@@ -1,13 +1,17 @@
 import os
 import time
 import string
+import hmac
 import hashlib
 import logging
+import threading
+import configparser
 import random
 import platform
 import datetime
 import json
 from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import dateutil
 import psutil
@@ -16,7 +20,10 @@ import werkzeug
 import odoo
 from odoo import sql_db
 from odoo.tools import config
-from odoo.modules import module
+
+from .cache import CachedValue
+from .config import config_get_int, config_get_float
+from .filestore import get_filestore_size, scan_filestore_size
 
 SAAS_CLIENT_API_VERSION = 1
 DEFAULT_TIME_TO_LOGIN = 3600
@@ -24,6 +31,12 @@ DEFAULT_ADMIN_SESSION_TTL = 2 * 60 * 60  # seconds
 DEFAULT_LEN_TOKEN = 128
 DEFAULT_RANDOM_PASSWORD_LEN = 32
 SAAS_TOKEN_FIELD = 'yodoo_token'
+SAAS_EXTRA_TOKENS_FIELD = 'yodoo_extra_tokens'
+DEFAULT_SERVER_STAT_CACHE_TTL = 60  # seconds
+DEFAULT_DB_STAT_BULK_CONNECTIONS = 4
+DEFAULT_DB_EXIST_CACHE_TTL = 10  # seconds
+DEFAULT_DB_MISSING_CACHE_TTL = 2  # seconds
+DB_MISSING_CACHE_SIZE = 1024
 
 _logger = logging.getLogger(__name__)
 
@@ -88,6 +101,15 @@ def generate_random_password(length=DEFAULT_RANDOM_PASSWORD_LEN):
     return ''.join(random.choice(letters) for _ in range(length))
 
 
+def get_yodoo_data_dir():
+    """ Return path to directory in data_dir, where yodoo_client
+        keeps its own data. Create directory if it does not exist.
+    """
+    path = os.path.join(config['data_dir'], 'yodoo_client')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
 def get_yodoo_client_version():
     """ Return version of yodoo_client available on disk
     """
@@ -95,6 +117,138 @@ def get_yodoo_client_version():
         'yodoo_client')['version']
 
 
+class SaaSTokenVerifier(object):
+    """ Verifier of SaaS token hashes sent by Yodoo Cockpit.
+
+        Digests of tokens are computed once, and are compared with received
+        hash in constant time. Multiple tokens could be active at same
+        time, to be able to rotate tokens without downtime:
+        'yodoo_token' is primary token, and 'yodoo_extra_tokens' is
+        coma-separated list of additional accepted tokens.
+
+        Odoo config file is checked for changes at most once per
+        RELOAD_CHECK_INTERVAL seconds, and if it was changed, then
+        tokens are reloaded from it.
+    """
+    RELOAD_CHECK_INTERVAL = 1  # seconds
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rcfile_mtime = self._get_rcfile_mtime()
+        self._checked_at = time.monotonic()
+        self._digests = self._compute_digests(
+            config.get(SAAS_TOKEN_FIELD, False),
+            config.get(SAAS_EXTRA_TOKENS_FIELD, False))
+
+    @staticmethod
+    def _compute_digests(token, extra_tokens):
+        tokens = [token] if token else []
+        if extra_tokens:
+            tokens += [t.strip() for t in extra_tokens.split(',')]
+        return tuple(
+            hashlib.sha256(t.encode('utf8')).hexdigest().encode('ascii')
+            for t in tokens if t)
+
+    def _get_rcfile_mtime(self):
+        try:
+            return os.stat(config.rcfile).st_mtime_ns
+        except (OSError, TypeError):
+            return None
+
+    def _reload(self):
+        """ Read tokens from odoo config file. If config file cannot be
+            read (for example it is removed or being replaced), then
+            previously loaded tokens are kept.
+        """
+        parser = configparser.RawConfigParser()
+        try:
+            if not parser.read([config.rcfile]):
+                _logger.error(
+                    "Cannot reload SaaS tokens: config file %s does not "
+                    "exist or is not readable. Previously loaded tokens "
+                    "are used.", config.rcfile)
+                return
+            token = parser.get('options', SAAS_TOKEN_FIELD, fallback=False)
+            extra_tokens = parser.get(
+                'options', SAAS_EXTRA_TOKENS_FIELD, fallback=False)
+        except (OSError, configparser.Error):
+            _logger.error(
+                "Cannot reload SaaS tokens from %s",
+                config.rcfile, exc_info=True)
+            return
+        # Odoo treats 'False' in config file as False value
+        self._digests = self._compute_digests(
+            str_filter_falsy(token), str_filter_falsy(extra_tokens))
+        _logger.info("SaaS tokens reloaded from %s", config.rcfile)
+
+    def _check_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.RELOAD_CHECK_INTERVAL:
+            return
+        with self._lock:
+            if now - self._checked_at < self.RELOAD_CHECK_INTERVAL:
+                return
+            self._checked_at = now
+            mtime = self._get_rcfile_mtime()
+            if mtime != self._rcfile_mtime:
+                self._rcfile_mtime = mtime
+                self._reload()
+
+    @property
+    def primary_digest(self):
+        """ Hash of primary token (hex string) or False if not configured
+        """
+        self._check_reload()
+        digests = self._digests
+        return digests[0].decode('ascii') if digests else False
+
+    def check(self, token_hash):
+        """ Check that token_hash matches one of active tokens
+
+            :param str token_hash: hash of SaaS token from server
+            :raises werkzeug.exceptions.*: raised in case when no/wrong token
+        """
+        self._check_reload()
+        digests = self._digests
+        if not digests:
+            if self._get_rcfile_mtime() is None:
+                _logger.error(
+                    "SaaS token is not configured: config file %s does "
+                    "not exist", config.rcfile)
+            else:
+                _logger.error(
+                    "SaaS token is not configured: set option '%s' in "
+                    "config file %s", SAAS_TOKEN_FIELD, config.rcfile)
+            raise werkzeug.exceptions.NotFound(
+                description='Token not configured')
+
+        if not isinstance(token_hash, str):
+            token_hash = ''
+        token_hash = token_hash.encode('utf8')
+        # Check all digests without short-circuit to not leak
+        # information via timing
+        valid = False
+        for digest in digests:
+            valid |= hmac.compare_digest(digest, token_hash)
+        if not valid:
+            _logger.info('The hashes of the tokens do not match.')
+            raise werkzeug.exceptions.Forbidden(
+                description='Token not match')
+
+
+_saas_token_verifier = None
+_saas_token_verifier_lock = threading.Lock()
+
+
+def get_saas_token_verifier():
+    global _saas_token_verifier
+    if _saas_token_verifier is None:
+        with _saas_token_verifier_lock:
+            if _saas_token_verifier is None:
+                _saas_token_verifier = SaaSTokenVerifier()
+    return _saas_token_verifier
+
+
 def check_saas_client_token(token_hash):
     """
     Returns True or correct response. Makes logging before returning a response
@@ -103,26 +257,7 @@ def check_saas_client_token(token_hash):
     :return: response or True
     :raises werkzeug.exceptions.*: raised in case when no/wrong token
     """
-    token = config.get(SAAS_TOKEN_FIELD, False)
-    if not token:
-        _logger.info('Instance token does not exist, please configure it.')
-        raise werkzeug.exceptions.NotFound(description='Token not configured')
-
-    token_instance_hash = hashlib.sha256(token.encode('utf8')).hexdigest()
-    if not token_instance_hash == token_hash:
-        _logger.info('The hashes of the tokens do not match.')
-        raise werkzeug.exceptions.Forbidden(description='Token not match')
-
-
-def get_size_storage(start_path):
-    total_size = 0
-    os_path_join = os.path.join
-    os_getsize = os.path.getsize
-    for storage_data in os.walk(start_path):
-        for f in storage_data[2]:
-            fp = os_path_join(storage_data[0], f)
-            total_size += os_getsize(fp)
-    return total_size
+    get_saas_token_verifier().check(token_hash)
 
 
 def get_count_db(user):
@@ -138,49 +273,41 @@ def get_count_db(user):
     return res
 
 
-def prepare_db_statistic_data(db):
-    data_dir = config['data_dir']
-    file_storage_size = get_size_storage(
-        os.path.join(data_dir, 'filestore', db))
-
-    with closing(sql_db.db_connect(db).cursor()) as cr:
-        cr.execute(
-            "SELECT pg_database_size(%s)", (db,))
-        db_storage_size = cr.fetchone()[0]
-
-        cr.execute("""
-            SELECT
-                max(rul.create_date) AS last_login,
-                max(rul.create_date) FILTER (
-                   WHERE ru.share = False) AS last_internal_login
-            FROM res_users_log AS rul
-            LEFT JOIN res_users AS ru ON ru.id = rul.create_uid
-            WHERE ru.active = True
-        """)
-        last_login_date, last_internal_login_date = cr.fetchone()
+def _get_db_usage_statistic_data(cr):
+    """ Compute statistic about users, logins and installed modules
+        of database, that cursor 'cr' is connected to.
+    """
+    cr.execute("""
+        SELECT
+            max(rul.create_date) AS last_login,
+            max(rul.create_date) FILTER (
+               WHERE ru.share = False) AS last_internal_login
+        FROM res_users_log AS rul
+        LEFT JOIN res_users AS ru ON ru.id = rul.create_uid
+        WHERE ru.active = True
+    """)
+    last_login_date, last_internal_login_date = cr.fetchone()
 
-        cr.execute("""
-            SELECT
-                count(*) AS total,
-                count(*) FILTER (WHERE share = True) AS external,
-                count(*) FILTER (WHERE share = False) AS internal
-            FROM res_users
-            WHERE active = True
-        """)
-        active_users = cr.dictfetchone()
+    cr.execute("""
+        SELECT
+            count(*) AS total,
+            count(*) FILTER (WHERE share = True) AS external,
+            count(*) FILTER (WHERE share = False) AS internal
+        FROM res_users
+        WHERE active = True
+    """)
+    active_users = cr.dictfetchone()
 
-        cr.execute("""
-            SELECT
-                count(*) AS total,
-                count(*) FILTER (WHERE application = True) AS apps
-            FROM ir_module_module
-            WHERE state = 'installed'
-        """)
-        installed_modules = cr.dictfetchone()
+    cr.execute("""
+        SELECT
+            count(*) AS total,
+            count(*) FILTER (WHERE application = True) AS apps
+        FROM ir_module_module
+        WHERE state = 'installed'
+    """)
+    installed_modules = cr.dictfetchone()
 
     return {
-        'db_storage': db_storage_size,
-        'file_storage': file_storage_size,
         'users_total_count': active_users['total'],
         'users_internal_count': active_users['internal'],
         'users_external_count': active_users['external'],
@@ -191,10 +318,191 @@ def prepare_db_statistic_data(db):
     }
 
 
+def prepare_db_statistic_data(db):
+    file_storage_size = get_filestore_size(db)
+
+    with closing(sql_db.db_connect(db).cursor()) as cr:
+        cr.execute(
+            "SELECT pg_database_size(%s)", (db,))
+        db_storage_size = cr.fetchone()[0]
+        data = _get_db_usage_statistic_data(cr)
+
+    data.update({
+        'db_storage': db_storage_size,
+        'file_storage': file_storage_size,
+    })
+    return data
+
+
+def iter_concurrent(func, items, max_workers):
+    """ Call func for each item in bounded thread pool.
+
+        :return: iterator over tuples (item, result, error) in order of
+                 completion. If func raised exception, then result is None
+                 and error is the exception.
+    """
+    if not items:
+        return
+    executor = ThreadPoolExecutor(
+        max_workers=max(min(max_workers, len(items)), 1),
+        thread_name_prefix='yodoo-concurrent')
+    futures = {executor.submit(func, item): item for item in items}
+    try:
+        for future in as_completed(futures):
+            error = future.exception()
+            yield (
+                futures[future],
+                None if error else future.result(),
+                error)
+    finally:
+        # If iteration was stopped (for example client disconnected),
+        # then do not start pending calls
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _get_db_statistic_data_for_bulk(db):
+    with closing(sql_db.db_connect(db).cursor()) as cr:
+        data = _get_db_usage_statistic_data(cr)
+    data['file_storage'] = scan_filestore_size(db)
+    return data
+
+
+def get_db_storage_sizes(dbs):
+    """ Compute sizes of multiple databases with single query
+
+        :return: dict {db_name: size_in_bytes}
+    """
+    with closing(sql_db.db_connect('postgres').cursor()) as cr:
+        cr.execute("""
+            SELECT datname, pg_database_size(datname)
+            FROM pg_database
+            WHERE datname = ANY(%s)
+              AND datallowconn;
+        """, (list(dbs),))
+        return dict(cr.fetchall())
+
+
+def iter_db_statistic_data(dbs):
+    """ Compute statistic for multiple databases.
+
+        Cluster-level data (size of databases) is computed with single
+        query, and per-database queries and filestore scans are run
+        concurrently, limited by 'yodoo_db_stat_bulk_connections'
+        config option.
+
+        :param list dbs: list of database names
+        :return: iterator over dicts with statistic of each database
+                 (same as prepare_db_statistic_data, with additional key
+                 'db'). If statistic for database cannot be computed,
+                 then dict contains only 'db' and 'error' keys.
+    """
+    db_storage_sizes = get_db_storage_sizes(dbs)
+    max_connections = config_get_int(
+        'yodoo_db_stat_bulk_connections',
+        DEFAULT_DB_STAT_BULK_CONNECTIONS)
+
+    for db in dbs:
+        if db not in db_storage_sizes:
+            yield {'db': db, 'error': 'Database not found'}
+
+    for db, data, error in iter_concurrent(
+            _get_db_statistic_data_for_bulk,
+            [db for db in dbs if db in db_storage_sizes],
+            max_connections):
+        if error:
+            _logger.warning(
+                "Cannot compute statistic for database %s: %s", db, error)
+            yield {'db': db, 'error': str(error)}
+            continue
+        data.update({
+            'db': db,
+            'db_storage': db_storage_sizes[db],
+        })
+        yield data
+
+
+def _get_server_stat_cache_ttl():
+    return config_get_float(
+        'yodoo_server_stat_cache_ttl', DEFAULT_SERVER_STAT_CACHE_TTL)
+
+
+_server_platform_cache = CachedValue(
+    'server_platform',
+    lambda: platform.uname()._asdict(),
+    ttl=_get_server_stat_cache_ttl())
+_server_disk_usage_cache = CachedValue(
+    'server_disk_usage',
+    lambda: psutil.disk_usage('/')._asdict(),
+    ttl=_get_server_stat_cache_ttl())
+_server_db_count_cache = CachedValue(
+    'server_db_count',
+    lambda: get_count_db(config['db_user']),
+    ttl=_get_server_stat_cache_ttl(),
+    db_lifecycle=True)
+
+
+def _get_connectable_dbs():
+    with closing(sql_db.db_connect('postgres').cursor()) as cr:
+        cr.execute("""
+            SELECT datname
+            FROM pg_database
+            WHERE datallowconn;
+        """)
+        return frozenset(r[0] for r in cr.fetchall())
+
+
+_db_exist_cache = CachedValue(
+    'db_exist',
+    _get_connectable_dbs,
+    ttl=config_get_float(
+        'yodoo_db_exist_cache_ttl', DEFAULT_DB_EXIST_CACHE_TTL),
+    db_lifecycle=True)
+
+
+# Names of databases, that were checked directly and not found. Whole set
+# is dropped when it expires, or when databases are changed.
+_db_missing_cache = CachedValue(
+    'db_missing',
+    set,
+    ttl=config_get_float(
+        'yodoo_db_missing_cache_ttl', DEFAULT_DB_MISSING_CACHE_TTL),
+    db_lifecycle=True)
+
+
+def db_exists(db):
+    """ Check if database exists using cached list of databases.
+
+        If database is not in cache, it could be created recently by other
+        worker, so in this case we check pg_database directly. Databases,
+        that are not found, are remembered for short time, so requests
+        with wrong database name do not query pg_database each time.
+    """
+    if db in _db_exist_cache.get():
+        return True
+    missing = _db_missing_cache.get()
+    if db in missing:
+        return False
+    with closing(sql_db.db_connect('postgres').cursor()) as cr:
+        cr.execute("""
+            SELECT EXISTS (
+                SELECT 1
+                FROM pg_database
+                WHERE datname = %s
+                  AND datallowconn
+            );
+        """, (db,))
+        exists = cr.fetchone()[0]
+    if not exists and len(missing) < DB_MISSING_CACHE_SIZE:
+        missing.add(db)
+    return exists
+
+
 def prepare_server_slow_statistic_data():
-    platform_data = platform.uname()._asdict()
-    disk_data = psutil.disk_usage('/')._asdict()
-    database_count = get_count_db(config['db_user'])
+    platform_data = _server_platform_cache.get()
+    disk_data = _server_disk_usage_cache.get()
+    database_count = _server_db_count_cache.get()
     return {
         'used_disk_space': disk_data['used'],
         'free_disk_space': disk_data['free'],
@@ -236,23 +544,6 @@ def prepare_server_fast_statistic_data():
     }
 
 
-def prepare_saas_module_info_data():
-    """
-    :return: dict {module_name: {
-                                'name': module_name,
-                                'version': module_version,
-                                'author': module_author,
-                                etc...},
-                    etc...}
-    """
-    res = {}
-    for mod in module.get_modules():
-        data = module.load_information_from_description_file(mod)
-        data['auto_install'] = bool(data['auto_install'])
-        res[mod] = data
-    return res
-
-
 def make_addons_to_be_installed(cr, addons):
     """ update addons state to 'to install'
 
@@ -1,17 +1,51 @@
 import os
 import time
 import json
+import fcntl
+import hashlib
 import shutil
 import logging
+import zipfile
 import tempfile
 
 import werkzeug
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 import odoo
 from odoo import http, exceptions
 
 _logger = logging.getLogger(__name__)
 
+# Supported compression codecs and their levels
+COMPRESSION_LEVELS = {
+    'stored': range(0),
+    'deflate': range(0, 10),
+    'zstd': range(1, 23),
+}
+DEFAULT_ZSTD_LEVEL = 3
+
+# Last backup of each database is kept in this directory (in data_dir),
+# and it is reused while database is not changed
+BACKUP_CACHE_DIR = 'yodoo_easy_backup'
+
+# Cached backups, that were not requested during this number of seconds,
+# are removed. Could be changed via 'yodoo_easy_backup_cache_ttl' option
+# in odoo config file.
+DEFAULT_BACKUP_CACHE_TTL = 86400
+
+# Sessions, idle for this time (seconds), have flushed statistics of
+# their transactions to pg_stat_database (PGSTAT_IDLE_INTERVAL of
+# PostgreSQL 15+ with margin)
+DB_STAT_FLUSH_WINDOW = 15
+
+# Max time (seconds) to wait until sessions of database become idle
+# for DB_STAT_FLUSH_WINDOW
+DB_STAT_FLUSH_WAIT = 30
+
 
 class YodooEasyBackup(http.Controller):
 
@@ -38,19 +72,100 @@ class YodooEasyBackup(http.Controller):
         }
         return manifest
 
-    def _yodoo_easy_backup_dump(self, db_name, stream, backup_format='zip'):
+    def _yodoo_easy_backup_parse_compression(self, compression):
+        """ Parse compression in form 'codec' or 'codec:level',
+            where codec is one of 'stored', 'deflate', 'zstd'.
+
+            :return: tuple(codec, level). Level is None if not specified.
+            :raises ValueError: if compression is not supported
+        """
+        if not compression:
+            return None, None
+        codec, __, level = compression.partition(':')
+        codec = codec.strip().lower()
+        if codec not in COMPRESSION_LEVELS:
+            raise ValueError("Unsupported compression: %s" % compression)
+        if codec == 'zstd' and zstandard is None:
+            raise ValueError(
+                "zstd compression is not available: "
+                "python package 'zstandard' is not installed")
+        if not level:
+            return codec, None
+        try:
+            level = int(level)
+        except ValueError:
+            raise ValueError("Wrong compression level: %s" % compression)
+        if level not in COMPRESSION_LEVELS[codec]:
+            raise ValueError("Wrong compression level: %s" % compression)
+        return codec, level
+
+    def _yodoo_easy_backup_zip_dir(self, path, stream, codec, level):
+        """ Same as odoo.tools.osutil.zip_dir, but with configurable
+            compression. dump.sql is placed first in archive.
+        """
+        options = {'compression': zipfile.ZIP_DEFLATED}
+        if codec in ('stored', 'zstd'):
+            # With zstd, archive is compressed as whole
+            options = {'compression': zipfile.ZIP_STORED}
+        elif level is not None:
+            options['compresslevel'] = level
+
+        path = os.path.normpath(path)
+        with zipfile.ZipFile(
+                stream, 'w', allowZip64=True, **options) as zipf:
+            for dirpath, __, filenames in os.walk(path):
+                filenames = sorted(
+                    filenames, key=lambda file_name: file_name != 'dump.sql')
+                for fname in filenames:
+                    fpath = os.path.join(dirpath, fname)
+                    if os.path.isfile(fpath):
+                        zipf.write(fpath, os.path.relpath(fpath, path))
+
+    def _yodoo_easy_backup_zstd_compress(self, src, stream, level):
+        """ Compress content of file-like object 'src' to 'stream'
+            with zstd, using all available CPUs
+        """
+        zstandard.ZstdCompressor(
+            level=DEFAULT_ZSTD_LEVEL if level is None else level,
+            threads=-1,
+        ).copy_stream(src, stream)
+
+    def _yodoo_easy_backup_dump(self, db_name, stream, backup_format='zip',
+                                compression=None):
         """ Just copy of odoo.service.db.dump_db
             implemented here to avoid access error if db_list is False
 
             Dump database `db` into file-like object `stream` if stream is None
             return a file object with the dump
+
+            :param str compression: compression in form 'codec[:level]'
+                where codec is one of 'stored', 'deflate', 'zstd'.
+                With 'zstd', whole backup is compressed by zstd.
         """
 
-        _logger.info('DUMP DB: %s format %s', db_name, backup_format)
+        _logger.info(
+            'DUMP DB: %s format %s compression %s',
+            db_name, backup_format, compression)
+        codec, level = self._yodoo_easy_backup_parse_compression(compression)
 
         cmd = ['pg_dump', '--no-owner']
         cmd.append(db_name)
 
+        if stream is None:
+            t = tempfile.TemporaryFile()
+            self._yodoo_easy_backup_dump(
+                db_name, t, backup_format, compression)
+            t.seek(0)
+            return t
+
+        if codec == 'zstd':
+            with tempfile.TemporaryFile() as t:
+                self._yodoo_easy_backup_dump(
+                    db_name, t, backup_format, 'stored')
+                t.seek(0)
+                self._yodoo_easy_backup_zstd_compress(t, stream, level)
+            return None
+
         if backup_format == 'zip':
             with odoo.tools.osutil.tempdir() as dump_dir:
                 filestore = odoo.tools.config.filestore(db_name)
@@ -64,33 +179,238 @@ class YodooEasyBackup(http.Controller):
                             self._yodoo_easy_backup_manifest(cr), fh, indent=4)
                 cmd.insert(-1, '--file=' + os.path.join(dump_dir, 'dump.sql'))
                 odoo.tools.exec_pg_command(*cmd)
-                if stream:
-                    odoo.tools.osutil.zip_dir(
-                        dump_dir, stream, include_dir=False,
-                        fnct_sort=lambda file_name: file_name != 'dump.sql')
-                else:
-                    t = tempfile.TemporaryFile()
-                    odoo.tools.osutil.zip_dir(
-                        dump_dir, t, include_dir=False,
-                        fnct_sort=lambda file_name: file_name != 'dump.sql')
-                    t.seek(0)
-                    return t
+                self._yodoo_easy_backup_zip_dir(dump_dir, stream, codec, level)
         else:
             cmd.insert(-1, '--format=c')
+            if codec == 'stored':
+                cmd.insert(-1, '--compress=0')
+            elif codec == 'deflate' and level is not None:
+                cmd.insert(-1, '--compress=%d' % level)
             __, stdout = odoo.tools.exec_pg_command_pipe(*cmd)
-            if stream:
-                shutil.copyfileobj(stdout, stream)
-            else:
-                return stdout
+            shutil.copyfileobj(stdout, stream)
         return None
 
+    def _yodoo_easy_backup_db_stat_signature(self, cr, db_name):
+        """ Return signature of database based on its statistic counters
+            of changed rows, or None if counters could be not flushed yet.
+
+            Counters of committed transaction are flushed by session when
+            it becomes idle (forced in 10 seconds), so counters are
+            trusted only if all other sessions connected to database are
+            idle for longer time. Statistic of current session is flushed
+            by finishing its transaction.
+        """
+        cr.execute("SELECT pg_stat_force_next_flush()")
+        cr.commit()
+
+        deadline = time.monotonic() + DB_STAT_FLUSH_WAIT
+        while True:
+            # Statistics are cached till the end of transaction
+            cr.execute("SELECT pg_stat_clear_snapshot()")
+            cr.execute("""
+                SELECT NOT EXISTS (
+                    SELECT 1
+                    FROM pg_stat_activity
+                    WHERE datname = %s
+                      AND pid != pg_backend_pid()
+                      AND (state IS DISTINCT FROM 'idle' OR
+                           state_change > clock_timestamp() -
+                                          make_interval(secs => %s))
+                )
+            """, (db_name, DB_STAT_FLUSH_WINDOW))
+            if cr.fetchone()[0]:
+                break
+            if time.monotonic() > deadline:
+                _logger.info(
+                    "Database %s is in use, changes could be not counted "
+                    "in its statistic yet, so backup is not reused",
+                    db_name)
+                return None
+            time.sleep(1)
+
+        # Database size is included to detect changes that are not
+        # counted in statistics (for example TRUNCATE)
+        cr.execute("""
+            SELECT s.stats_reset,
+                   s.tup_inserted,
+                   s.tup_updated,
+                   s.tup_deleted,
+                   pg_database_size(s.datid)
+            FROM pg_stat_database AS s
+            WHERE s.datname = %s
+        """, (db_name,))
+        row = cr.fetchone()
+        return row and 'db_stat:%s' % ','.join(str(v) for v in row)
+
+    def _yodoo_easy_backup_fingerprint(self, cr, db_name):
+        """ Compute fingerprint of state of database and its filestore.
+            Same fingerprint means that there were no changes in database
+            since previous backup, thus previous backup could be reused.
+
+            On PostgreSQL 15+ database changes are detected via
+            per-database statistic counters, so changes in other
+            databases of cluster do not prevent reuse of backup. On older
+            versions idle sessions could keep counters unflushed for
+            unlimited time, so current WAL insert position is used: it
+            never lags behind commits, but changes on any change in
+            cluster. Filestore changes are detected via modification time
+            of its directories, that changes when files are added or
+            removed.
+
+            :return: fingerprint or None if changes of database could be
+                     not detected yet (backup must not be reused)
+        """
+        cr.execute("SELECT current_setting('server_version_num')::int")
+        if cr.fetchone()[0] >= 150000:
+            db_signature = self._yodoo_easy_backup_db_stat_signature(
+                cr, db_name)
+            if db_signature is None:
+                return None
+        else:
+            cr.execute("SELECT pg_current_wal_insert_lsn()::text")
+            db_signature = 'wal:%s' % cr.fetchone()[0]
+        fingerprint = hashlib.sha256(
+            ('%s;%s;' % (db_name, db_signature)).encode('utf-8'))
+
+        filestore = odoo.tools.config.filestore(db_name)
+        for dirpath, dirnames, __ in os.walk(filestore):
+            dirnames.sort()
+            try:
+                mtime = os.stat(dirpath).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            fingerprint.update(('%s:%s;' % (
+                os.path.relpath(dirpath, filestore), mtime)).encode('utf-8'))
+        return fingerprint.hexdigest()
+
+    def _yodoo_easy_backup_get_cache_ttl(self):
+        try:
+            return float(odoo.tools.config.get(
+                'yodoo_easy_backup_cache_ttl', DEFAULT_BACKUP_CACHE_TTL))
+        except (TypeError, ValueError):
+            _logger.warning(
+                "Config option yodoo_easy_backup_cache_ttl has wrong value, "
+                "using default %r", DEFAULT_BACKUP_CACHE_TTL)
+            return DEFAULT_BACKUP_CACHE_TTL
+
+    def _yodoo_easy_backup_cleanup_cache(self, cache_dir):
+        """ Remove cached backups, that were not requested during
+            'yodoo_easy_backup_cache_ttl' seconds, and temporary files
+            left by interrupted backups.
+
+            Last request time of backup is modification time of its lock
+            file. Backups locked by other request are skipped, and
+            backups that are being sent stay readable via open file
+            until response is finished.
+        """
+        expire = time.time() - self._yodoo_easy_backup_get_cache_ttl()
+        for entry in os.scandir(cache_dir):
+            try:
+                if entry.stat().st_mtime >= expire:
+                    continue
+                if entry.name.endswith('.tmp'):
+                    os.unlink(entry.path)
+                    continue
+                if not entry.name.endswith('.lock'):
+                    continue
+                with open(entry.path, 'a') as lock_file:
+                    try:
+                        fcntl.flock(
+                            lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    # Backup could be requested while we waited for lock
+                    if os.fstat(lock_file.fileno()).st_mtime >= expire:
+                        continue
+                    name = entry.name[:-len('.lock')]
+                    _logger.info("Removing expired cached backup %s", name)
+                    for ext in ('.json', '.data', '.lock'):
+                        try:
+                            os.unlink(os.path.join(cache_dir, name + ext))
+                        except FileNotFoundError:
+                            pass
+            except FileNotFoundError:
+                # Removed by other worker
+                continue
+            except OSError:
+                _logger.warning(
+                    "Cannot cleanup cached backup %s",
+                    entry.path, exc_info=True)
+
+    def _yodoo_easy_backup_get_cached(self, db_name, compression, cr):
+        """ Return metadata of backup of database, reusing previous
+            backup if database was not changed.
+
+            Fingerprint is computed before backup is started, thus changes
+            made during backup will invalidate it.
+
+            Backups of same database with same compression are serialized
+            (across all workers) via lock file, other backups could be
+            made in parallel.
+
+            :return: dict with keys 'file' (backup opened for reading),
+                'created', 'fingerprint'
+        """
+        cache_dir = os.path.join(
+            odoo.tools.config['data_dir'], BACKUP_CACHE_DIR)
+        os.makedirs(cache_dir, exist_ok=True)
+        self._yodoo_easy_backup_cleanup_cache(cache_dir)
+
+        name = '%s-%s' % (db_name, compression or 'default')
+        data_path = os.path.join(cache_dir, '%s.data' % name)
+        meta_path = os.path.join(cache_dir, '%s.json' % name)
+        lock_path = os.path.join(cache_dir, '%s.lock' % name)
+
+        with open(lock_path, 'a') as lock_file:
+            # Mark backup as recently requested before waiting for lock,
+            # so it will not be removed by cleanup
+            os.utime(lock_file.fileno())
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            fingerprint = self._yodoo_easy_backup_fingerprint(cr, db_name)
+            try:
+                with open(meta_path, 'rt') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                meta = None
+            if (fingerprint is not None and meta and
+                    meta['fingerprint'] == fingerprint):
+                try:
+                    meta['file'] = open(data_path, 'rb')
+                except FileNotFoundError:
+                    pass
+                else:
+                    _logger.info(
+                        "Reusing backup of db %s made at %s",
+                        db_name, meta['created'])
+                    return meta
+
+            tmp_path = '%s.%s.tmp' % (data_path, os.getpid())
+            try:
+                with open(tmp_path, 'wb') as f:
+                    self._yodoo_easy_backup_dump(
+                        db_name, f, 'zip', compression)
+                os.replace(tmp_path, data_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+
+            meta = {
+                'fingerprint': fingerprint,
+                'created': time.strftime('%Y-%m-%d--%H-%M-%S'),
+            }
+            with open(meta_path, 'wt') as f:
+                json.dump(meta, f)
+            meta['file'] = open(data_path, 'rb')
+            return meta
+
     @http.route(
         '/yodoo_easy_backup/<token>',
         type='http',
         auth="public",
         methods=['GET'],
         csrf=True)
-    def yodoo_easy_backu(self, token, **params):
+    def yodoo_easy_backu(self, token, compression=None, **params):
         Param = http.request.env['ir.config_parameter'].sudo()
         allow_public = Param.get_param(
             'yodoo_easy_backup.backup_allow_public', False)
@@ -107,36 +427,44 @@ class YodooEasyBackup(http.Controller):
         if backup_token != token:
             raise werkzeug.exceptions.Forbidden()
 
-        backup_format = 'zip'
-        filename = "%s-%s.%s" % (
-            http.request.env.cr.dbname,
-            time.strftime('%Y-%m-%d--%H-%M-%S'),
-            backup_format)
-        headers = [
-            ('Content-Type', 'application/octet-stream; charset=binary'),
-            ('Content-Disposition', http.content_disposition(filename)),
-        ]
+        try:
+            codec, __ = self._yodoo_easy_backup_parse_compression(
+                compression)
+        except ValueError as e:
+            raise werkzeug.exceptions.BadRequest(description=str(e))
 
+        db_name = http.request.env.cr.dbname
         try:
-            stream = tempfile.TemporaryFile()
-            self._yodoo_easy_backup_dump(
-                http.request.env.cr.dbname, stream, backup_format)
+            backup = self._yodoo_easy_backup_get_cached(
+                db_name, compression, http.request.env.cr)
         except exceptions.AccessDenied as e:
             _logger.error(
-                "Cannot backup db %s",
-                http.request.env.cr.dbname, exc_info=True)
+                "Cannot backup db %s", db_name, exc_info=True)
             raise werkzeug.exceptions.Forbidden(
                 description=str(e))
         except Exception as e:
             _logger.error(
-                "Cannot backup db %s",
-                http.request.env.cr.dbname, exc_info=True)
+                "Cannot backup db %s", db_name, exc_info=True)
             raise werkzeug.exceptions.InternalServerError(
                 description=str(e))
-        else:
-            stream.seek(0)
-            response = werkzeug.wrappers.Response(
-                stream,
-                headers=headers,
-                direct_passthrough=True)
-            return response
+
+        filename = "%s-%s.zip" % (db_name, backup['created'])
+        if codec == 'zstd':
+            filename += '.zst'
+        headers = [
+            ('Content-Type', 'application/octet-stream; charset=binary'),
+            ('Content-Disposition', http.content_disposition(filename)),
+        ]
+        httprequest = http.request.httprequest
+        backup_file = backup['file']
+        size = os.fstat(backup_file.fileno()).st_size
+        response = werkzeug.wrappers.Response(
+            werkzeug.wsgi.wrap_file(httprequest.environ, backup_file),
+            headers=headers,
+            direct_passthrough=True)
+        response.content_length = size
+        if backup['fingerprint']:
+            response.set_etag('%s-%s' % (
+                backup['fingerprint'], compression or 'default'))
+        return response.make_conditional(
+            httprequest, accept_ranges=True, complete_length=size)